@@ -0,0 +1,55 @@
+import os
+import time
+import argparse
+import numpy as np
+
+from mdp.solver import Q_value_iteration, VI_METHODS
+from mdp.transition_model import SparseTransitionModel
+from constants import *
+
+
+def load_transition_matrix(use_sparse):
+    sparse_filepath = os.path.splitext(TRAIN_TRANSITION_MATRIX_FILEPATH)[0] + '.npz'
+    if use_sparse and os.path.isfile(sparse_filepath):
+        return SparseTransitionModel.load(sparse_filepath)
+    if os.path.isfile(TRAIN_TRANSITION_MATRIX_FILEPATH):
+        transition_matrix = np.load(TRAIN_TRANSITION_MATRIX_FILEPATH)
+        if use_sparse:
+            return SparseTransitionModel.from_dense(transition_matrix)
+        return transition_matrix
+    if os.path.isfile(sparse_filepath):
+        transition_matrix = SparseTransitionModel.load(sparse_filepath)
+        return transition_matrix if use_sparse else transition_matrix.toarray()
+    raise FileNotFoundError('run main_sepsis.py first to build {}'.format(TRAIN_TRANSITION_MATRIX_FILEPATH))
+
+
+def benchmark(transition_matrix, reward_matrix, theta, gamma):
+    Q_ref = None
+    for method in VI_METHODS:
+        start = time.time()
+        Q, _, num_sweeps = Q_value_iteration(transition_matrix, reward_matrix, theta=theta,
+                                             gamma=gamma, full_output=True, method=method)
+        elapsed = time.time() - start
+        if Q_ref is None:
+            Q_ref = Q
+        print('{:<14}{:>10.3f}s{:>10} sweeps   max |Q - Q_jacobi| {:.2e}'.format(
+              method, elapsed, num_sweeps, np.max(np.abs(Q - Q_ref))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare value iteration backends')
+    parser.add_argument('-t', '--theta', default=1e-2, type=float, dest='theta')
+    parser.add_argument('-g', '--gamma', default=0.99, type=float, dest='gamma')
+    parser.add_argument('-us', '--use_sparse', action='store_true', dest='use_sparse',
+                        help="benchmark on SparseTransitionModel instead of the dense tensor")
+    args = parser.parse_args()
+
+    transition_matrix = load_transition_matrix(args.use_sparse)
+    # same terminal-only reward the experiment manager uses for the mdp-optimal expert
+    reward_matrix = np.zeros((NUM_STATES))
+    reward_matrix[TERMINAL_STATE_ALIVE] = 1.0
+    reward_matrix[TERMINAL_STATE_DEAD] = -1.0
+    # first call of the numba kernels pays the jit compile
+    Q_value_iteration(transition_matrix, reward_matrix, theta=1.0, method='gauss_seidel')
+    Q_value_iteration(transition_matrix, reward_matrix, theta=1.0, method='prioritized')
+    benchmark(transition_matrix, reward_matrix, args.theta, args.gamma)
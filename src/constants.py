@@ -18,23 +18,30 @@ FILEPATH = DATA_PATH + 'sepsis.csv'
 TRAIN_FILEPATH = DATA_PATH + 'Sepsis_imp_train.csv'
 TRAIN_CLEANSED_DATA_FILEPATH = DATA_PATH + 'cleansed_data_train.csv'
 TRAIN_CENTROIDS_DATA_FILEPATH = DATA_PATH + 'centroids_data_train.csv'
+KMEANS_MODEL_FILEPATH = DATA_PATH + 'kmeans_model_train.pkl'
+KMEANS_PCA_MODEL_FILEPATH = DATA_PATH + 'kmeans_pca_model_train.pkl'
+STATE_ENCODER_FILEPATH = DATA_PATH + 'state_encoder.pkl'
+STATE_ENCODER_PCA_FILEPATH = DATA_PATH + 'state_encoder_pca.pkl'
+MODEL_FILEPATHS = [KMEANS_MODEL_FILEPATH, KMEANS_PCA_MODEL_FILEPATH, STATE_ENCODER_FILEPATH, STATE_ENCODER_PCA_FILEPATH]
 
 # PCA starts
-TRAIN_CLEANSED_PCA_DATA_FILEPATH = DATA_PATH + 'cleansed_data_pca_train.csv'
-TRAIN_CENTROIDS_PCA_DATA_FILEPATH = DATA_PATH + 'centroids_data_pca_train.csv'
-VALIDATE_CLEANSED_PCA_DATA_FILEPATH = DATA_PATH + 'cleansed_data_pca_val.csv'
-
-TRAIN_TRAJECTORIES_PCA_FILEPATH = DATA_PATH + 'trajectories_pca_train.npy'
-TRAIN_TRANSITION_MATRIX_PCA_FILEPATH = DATA_PATH + 'transition_pca_matrix_train.npy'
-
-TRAJECTORIES_PCA_FILEPATH = DATA_PATH + 'trajectories_pca.npy'
-TRAJECTORIES_PCA_VASO_FILEPATH = DATA_PATH + 'trajectories_pca_vaso.npy'
-TRAJECTORIES_PCA_VASO_SD_LEFT_FILEPATH = DATA_PATH + 'trajectories_pca_vaso_sd_left.npy'
-TRAJECTORIES_PCA_VASO_SD_RIGHT_FILEPATH = DATA_PATH + 'trajectories_pca_vaso_sd_right.npy'
-TRAJECTORIES_PCA_IV_FILEPATH = DATA_PATH + 'trajectories_pca_iv.npy'
-TRAJECTORIES_PCA_IV_SD_LEFT_FILEPATH = DATA_PATH + 'trajectories_pca_iv_sd_left.npy'
-TRAJECTORIES_PCA_IV_SD_RIGHT_FILEPATH = DATA_PATH + 'trajectories_pca_iv_sd_right.npy'
-TRANSITION_MATRIX_PCA_FILEPATH = DATA_PATH + 'transition_matrix_pca.npy'
+# pca2: the cleansed frames hold the pca states and pc0, pc1, ... features.
+# the old _pca files repeated the kmeans frames, so they are not read anymore
+TRAIN_CLEANSED_PCA_DATA_FILEPATH = DATA_PATH + 'cleansed_data_pca2_train.csv'
+TRAIN_CENTROIDS_PCA_DATA_FILEPATH = DATA_PATH + 'centroids_data_pca2_train.csv'
+VALIDATE_CLEANSED_PCA_DATA_FILEPATH = DATA_PATH + 'cleansed_data_pca2_val.csv'
+
+TRAIN_TRAJECTORIES_PCA_FILEPATH = DATA_PATH + 'trajectories_pca2_train.npy'
+TRAIN_TRANSITION_MATRIX_PCA_FILEPATH = DATA_PATH + 'transition_pca2_matrix_train.npy'
+
+TRAJECTORIES_PCA_FILEPATH = DATA_PATH + 'trajectories_pca2.npy'
+TRAJECTORIES_PCA_VASO_FILEPATH = DATA_PATH + 'trajectories_pca2_vaso.npy'
+TRAJECTORIES_PCA_VASO_SD_LEFT_FILEPATH = DATA_PATH + 'trajectories_pca2_vaso_sd_left.npy'
+TRAJECTORIES_PCA_VASO_SD_RIGHT_FILEPATH = DATA_PATH + 'trajectories_pca2_vaso_sd_right.npy'
+TRAJECTORIES_PCA_IV_FILEPATH = DATA_PATH + 'trajectories_pca2_iv.npy'
+TRAJECTORIES_PCA_IV_SD_LEFT_FILEPATH = DATA_PATH + 'trajectories_pca2_iv_sd_left.npy'
+TRAJECTORIES_PCA_IV_SD_RIGHT_FILEPATH = DATA_PATH + 'trajectories_pca2_iv_sd_right.npy'
+TRANSITION_MATRIX_PCA_FILEPATH = DATA_PATH + 'transition_matrix_pca2.npy'
 # PCA ends
 
 # K prototype starts
@@ -76,6 +83,8 @@ REWARD_MATRIX_FILEPATH = DATA_PATH + 'reward_matrix.npy'
 
 STD_BINS_IV_FILEPATH = DATA_PATH + 'std_bins_iv.csv'
 STD_BINS_VASO_FILEPATH = DATA_PATH + 'std_bins_vaso.csv'
+# content-addressed store for derived artifacts, see utils.cache
+CACHE_PATH = DATA_PATH + 'cache/'
 # since these are experiment-specific, we save them to
 # save_path = data/today_date/
 PHYSICIAN_Q = 'physician_q'
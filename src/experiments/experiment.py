@@ -1,10 +1,13 @@
-from utils.utils import load_data, extract_trajectories, save_Q, initialize_save_data_folder, apply_phi_to_centroids, get_sd_away_bins
+from utils.utils import load_data, extract_trajectories, extract_multi_action_trajectories, save_Q, initialize_save_data_folder, find_save_data_folder, make_phi_matrix, get_sd_away_bins
 from utils.evaluation_utils import plot_KL, plot_avg_LL
+from utils.cache import ArtifactCache
+from utils.shared import SharedArrays, resolve
 from policy.policy import GreedyPolicy, RandomPolicy, StochasticPolicy
 from policy.custom_policy import get_physician_policy
 from mdp.builder import make_mdp
 from mdp.solver import Q_value_iteration, iterate_policy
 from irl.max_margin import run_max_margin
+from irl.max_ent import run_max_ent
 from irl.irl import  make_state_centroid_finder, make_phi, get_initial_state_distribution
 from utils.plot import *
 from constants import *
@@ -12,9 +15,11 @@ import evaluation.log_likelihood as lh
 
 import numpy as np
 import pandas as pd
+import copy
 import time
 import os
 from multiprocessing import Pool
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 class ExperimentManager():
@@ -28,15 +33,26 @@ class ExperimentManager():
         self.svm_penalty = args.svm_penalty
         self.svm_epsilon = args.svm_epsilon
         self.use_pca = args.use_pca
+        self.use_sparse = args.use_sparse
+        self.chunksize = args.chunksize
+        self.num_seeds = args.num_seeds
+        self.num_trial_workers = args.num_trial_workers
         self.clustering_method = args.clustering_method
         self.num_states = args.num_states
         self.generate_new_data = args.generate_new_data
         self.num_bins = args.num_bins
         self.verbose = args.verbose
-        self.experiment_name = time.strftime('%y%m%d_%H%M%S', time.gmtime())
+        # a resumed run keeps the name, and so the checkpoints and the seeds, of the interrupted one
+        self.resume = args.resume
+        self.experiment_name = args.resume or time.strftime('%y%m%d_%H%M%S', time.gmtime())
         self.parallelized = args.parallelized
         self.hyperplane_margin = args.hyperplane_margin
         self.num_exp_trajectories = args.num_exp_trajectories
+        self.exact_feature_expectation = args.exact_feature_expectation
+        self.vi_method = args.vi_method
+        self.opt_method = args.opt_method
+        self.irl_method = args.irl_method
+        self.learning_rate = args.learning_rate
 
         if self.verbose:
             print('num trials', self.num_trials)
@@ -45,9 +61,15 @@ class ExperimentManager():
             print('svm epsilon', self.svm_epsilon)
             print('')
 
+        # derived artifacts are keyed on their inputs, see utils.cache
+        self.cache = ArtifactCache()
+
         # loading data
         self.data = load_data(generate_new_data=self.generate_new_data,
-                              num_states=self.num_states)
+                              num_states=self.num_states,
+                              cache=self.cache,
+                              chunksize=self.chunksize,
+                              num_seeds=self.num_seeds)
         df_label = ''
         if self.clustering_method == 'km':
             df_label += 'kmeans'
@@ -64,9 +86,9 @@ class ExperimentManager():
             bins = ['min', '50%', 'max']
         else:
             bins = ['min', '25%', '50%', '75%', 'max']
-        self.df_phi = apply_phi_to_centroids(self.df_centroids, self.df_train, bins=bins)
-        self.phi = self.df_phi.as_matrix()
-        assert np.all(np.isin(self.phi, [0, 1])), 'phi should be binary matrix'
+        # sparse CSR, one nonzero per centroid column
+        self.phi, self.features = make_phi_matrix(self.df_centroids, self.df_train, bins=bins)
+        assert np.all(self.phi.data == 1), 'phi should be binary matrix'
 
         # some utility stats
         self.avg_mortality_per_state = pd.Series(np.zeros(NUM_PURE_STATES), name='avg_mortality')
@@ -77,7 +99,6 @@ class ExperimentManager():
 
         # build MDP
         # 1. bulld REWARD MATRIX
-        self.features = self.df_phi.columns
         self.num_features = self.phi.shape[1]
         reward_matrix = np.zeros((NUM_STATES))
         reward_matrix[TERMINAL_STATE_ALIVE] = np.sqrt(self.num_features)
@@ -113,16 +134,23 @@ class ExperimentManager():
             self.path_iv = TRAJECTORIES_IV_KP_FILEPATH
         else:
             raise Exception('unsupported combination')
-        trajectories = extract_trajectories(self.df, NUM_PURE_STATES, self.t_path)
+        # full, vaso-only and iv-only trajectories of the same frame in one pass
+        trajectories, trajectories_vaso, trajectories_iv = \
+                extract_multi_action_trajectories(self.df, NUM_PURE_STATES,
+                                                  ['action', 'action_vaso', 'action_iv'],
+                                                  cache=self.cache)
         transition_matrix, _ = \
-                make_mdp(trajectories, NUM_STATES, NUM_ACTIONS, self.tm_path, REWARD_MATRIX_FILEPATH)
+                make_mdp(trajectories, NUM_STATES, NUM_ACTIONS, self.tm_path, REWARD_MATRIX_FILEPATH,
+                         use_sparse=self.use_sparse, cache=self.cache)
         assert np.isclose(np.sum(transition_matrix), NUM_STATES * NUM_ACTIONS), 'something wrong with \ test transition_matrix'
         self.transition_matrix = transition_matrix
 
         # 3. build transition_matrix using only training data
-        trajectories_train = extract_trajectories(self.df_train, NUM_PURE_STATES, self.t_train_path)
+        trajectories_train = extract_trajectories(self.df_train, NUM_PURE_STATES, self.t_train_path,
+                                                  cache=self.cache)
         transition_matrix_train, _ = \
-                make_mdp(trajectories_train, NUM_STATES, NUM_ACTIONS, self.tm_train_path, TRAIN_REWARD_MATRIX_FILEPATH)
+                make_mdp(trajectories_train, NUM_STATES, NUM_ACTIONS, self.tm_train_path, TRAIN_REWARD_MATRIX_FILEPATH,
+                         use_sparse=self.use_sparse, cache=self.cache)
         assert np.isclose(np.sum(transition_matrix), NUM_STATES * NUM_ACTIONS), 'something wrong with \
              train transition_matrix'
         self.transition_matrix_train = transition_matrix_train
@@ -132,9 +160,14 @@ class ExperimentManager():
         self.initial_state_probs = get_initial_state_distribution(self.df_train)
 
         # initalize saving folder
-        self.save_path = initialize_save_data_folder()
+        if self.resume:
+            self.save_path = find_save_data_folder(self.resume)
+        else:
+            self.save_path = initialize_save_data_folder()
         self.img_path = self.save_path + IMG_PATH
         print('will save expriment results to {}'.format(self.save_path))
+        print('run {}, continue it after an interruption with --resume {}'.format(self.experiment_name,
+                                                                               self.experiment_name))
 
         if self.verbose:
             print('number of features', self.num_features)
@@ -154,7 +187,7 @@ class ExperimentManager():
         self.pi_expert_phy_s = get_physician_policy(trajectories, is_stochastic=True)
         save_Q(self.pi_expert_phy_g.Q, self.save_path, self.num_trials, self.num_iterations, PHYSICIAN_Q)
 
-        Q_star = Q_value_iteration(self.transition_matrix, self.reward_matrix)
+        Q_star = Q_value_iteration(self.transition_matrix, self.reward_matrix, method=self.vi_method)
         self.pi_expert_mdp_g = GreedyPolicy(NUM_PURE_STATES, NUM_ACTIONS, Q_star)
         self.pi_expert_mdp_s = StochasticPolicy(NUM_PURE_STATES, NUM_ACTIONS, Q_star)
         save_Q(self.pi_expert_mdp_g.Q, self.save_path, self.num_trials, self.num_iterations, MDP_OPTIMAL_Q)
@@ -162,8 +195,8 @@ class ExperimentManager():
         # experiments
         self.experiments = []
 
-        self.df_vaso_sd, self.df_iv_sd = get_sd_away_bins(self.df)
-        self.pi_phy_vaso, self.pi_phy_iv = self._decompose_phy_action(self.df)
+        self.df_vaso_sd, self.df_iv_sd = get_sd_away_bins(self.df, cache=self.cache)
+        self.pi_phy_vaso, self.pi_phy_iv = self._decompose_phy_action(trajectories_vaso, trajectories_iv)
         self.pi_mdp_vaso_probs, self.pi_mdp_iv_probs = \
             self._decompose_mdp_action_probs(self.df, self.pi_expert_mdp_s)
 
@@ -305,7 +338,7 @@ class ExperimentManager():
                            pi_name = 'MDP')
                 self.ll_kl_mdp_plotted = True
 
-    def _decompose_phy_action(self, df):
+    def _decompose_phy_action(self, traj_vaso, traj_iv):
 
         #path_vaso_sd_l = TRAJECTORIES_PCA_VASO_SD_LEFT_FILEPATH if self.use_pca else TRAJECTORIES_VASO_SD_LEFT_FILEPATH
         #path_vaso_sd_r = TRAJECTORIES_PCA_VASO_SD_RIGHT_FILEPATH if self.use_pca else TRAJECTORIES_VASO_SD_RIGHT_FILEPATH
@@ -313,10 +346,8 @@ class ExperimentManager():
         #path_iv_sd_l = TRAJECTORIES_PCA_IV_SD_LEFT_FILEPATH if self.use_pca else TRAJECTORIES_IV_SD_LEFT_FILEPATH
         #path_iv_sd_r = TRAJECTORIES_PCA_IV_SD_RIGHT_FILEPATH if self.use_pca else TRAJECTORIES_IV_SD_RIGHT_FILEPATH
 
-        traj_vaso = extract_trajectories(self.df, NUM_PURE_STATES, self.path_vaso, 'action_vaso')
         #traj_vaso_sd_l = extract_trajectories(self.df, NUM_PURE_STATES, path_vaso_sd_l, 'action_vaso_sd_left')
         #traj_vaso_sd_r = extract_trajectories(self.df, NUM_PURE_STATES, path_vaso_sd_r, 'action_vaso_sd_right')
-        traj_iv = extract_trajectories(self.df, NUM_PURE_STATES, self.path_iv, 'action_iv')
         #traj_iv_sd_l = extract_trajectories(self.df, NUM_PURE_STATES, path_iv_sd_l, 'action_iv_sd_left')
         #traj_iv_sd_r = extract_trajectories(self.df, NUM_PURE_STATES, path_iv_sd_r, 'action_iv_sd_right')
         num_bins = 5
@@ -385,9 +416,16 @@ class ExperimentManager():
         exp.features = self.features
         exp.verbose = self.verbose
         exp.hyperplane_margin = self.hyperplane_margin
+        exp.exact_feature_expectation = self.exact_feature_expectation
+        exp.vi_method = self.vi_method
+        exp.opt_method = self.opt_method
+        exp.irl_method = self.irl_method
+        exp.learning_rate = self.learning_rate
+        exp.num_trial_workers = self.num_trial_workers
         if self.use_pca:
             exp.experiment_id += '_pca'
             exp.save_file_name += '_pca'
+        exp.checkpoint_path = '{}checkpoints/{}/'.format(self.save_path, exp.experiment_id)
         self.experiments.append(exp)
 
     def _run(self, exp):
@@ -397,16 +435,25 @@ class ExperimentManager():
     def run(self):
         '''
         parallelize the experiments
+        workers receive only the experiment, with its large arrays as SharedArrays handles,
+        and return the results. saving and plotting stay in this process
+        experiments x trial workers (see run_max_margin) is capped at the number of cores
         '''
         if self.parallelized:
-            try:
-                pool = Pool(os.cpu_count() - 1)
-                pool.map(self._run, self.experiments)
-            finally:
-                pool.close()
-                pool.join()
+            num_workers = min(len(self.experiments), max(os.cpu_count() - 1, 1))
+            num_trial_workers = max(1, min(self.num_trial_workers, os.cpu_count() // num_workers))
+            with SharedArrays() as shared, \
+                    ProcessPoolExecutor(num_workers) as executor:
+                futures = {}
+                for e in self.experiments:
+                    e_shared = e.with_shared_arrays(shared)
+                    e_shared.num_trial_workers = num_trial_workers
+                    futures[executor.submit(_run_experiment, e_shared)] = e
+                for future in as_completed(futures):
+                    self.save_experiment(future.result(), futures[future])
         else:
             for e in self.experiments:
+                e.num_trial_workers = min(self.num_trial_workers, os.cpu_count())
                 self._run(e)
 
 
@@ -441,7 +488,15 @@ class ExperimentManager():
         np.save('{}perf_vs_traj_result_{}'.format(self.save_path, cur_t), res)
 
 
+def _run_experiment(exp):
+    return exp.run()
+
+
 class Experiment():
+    # large read-only inputs, handed to worker processes through SharedArrays
+    SHARED_ATTRS = ['transition_matrix_train', 'transition_matrix', 'reward_matrix',
+                    'initial_state_probs', 'phi']
+
     def __init__(self, experiment_id,
                  policy_expert,
                  save_file_name,
@@ -451,13 +506,39 @@ class Experiment():
         self.pi_expert = policy_expert
         self.irl_use_stochastic_policy = irl_use_stochastic_policy
 
+    def with_shared_arrays(self, shared):
+        '''
+        shallow copy whose large inputs are handles of shared (utils.shared.SharedArrays)
+        '''
+        exp = copy.copy(self)
+        for attr in self.SHARED_ATTRS:
+            setattr(exp, attr, shared.share(getattr(self, attr)))
+        return exp
+
     def run(self):
-        res = run_max_margin(self.transition_matrix_train,
-                             self.transition_matrix,
-                             self.reward_matrix,
+        if self.irl_method == 'max_ent':
+            return run_max_ent(resolve(self.transition_matrix_train),
+                               resolve(self.transition_matrix),
+                               resolve(self.reward_matrix),
+                               self.pi_expert,
+                               resolve(self.initial_state_probs),
+                               resolve(self.phi),
+                               self.num_exp_trajectories,
+                               self.learning_rate,
+                               self.svm_epsilon,
+                               self.num_iterations,
+                               self.num_trials,
+                               self.features,
+                               self.verbose,
+                               self.exact_feature_expectation,
+                               self.num_trial_workers,
+                               checkpoint_path=self.checkpoint_path)
+        res = run_max_margin(resolve(self.transition_matrix_train),
+                             resolve(self.transition_matrix),
+                             resolve(self.reward_matrix),
                              self.pi_expert,
-                             self.initial_state_probs,
-                             self.phi,
+                             resolve(self.initial_state_probs),
+                             resolve(self.phi),
                              self.num_exp_trajectories,
                              self.svm_penalty,
                              self.svm_epsilon,
@@ -466,7 +547,12 @@ class Experiment():
                              self.irl_use_stochastic_policy,
                              self.features,
                              self.hyperplane_margin,
-                             self.verbose)
+                             self.verbose,
+                             self.exact_feature_expectation,
+                             self.vi_method,
+                             self.num_trial_workers,
+                             checkpoint_path=self.checkpoint_path,
+                             opt_method=self.opt_method)
 
         return res
 
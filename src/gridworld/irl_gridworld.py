@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 import itertools
 from utils.utils import compute_terminal_state_reward
+from irl.irl import RewardModel
 from gridworld.constants_gridworld import NUM_STATES, NUM_ACTIONS
 
 
@@ -225,6 +226,19 @@ def make_reward_computer(task, W, get_state, phi, goal_reward):
         return np.dot(W, phi(s_cent))
     return compute_reward
 
+def make_reward_model(task, get_state, phi, goal_reward, num_states=NUM_STATES):
+    '''
+    RewardModel with phi applied once to the centroid of every non-terminal state
+    terminal states get goal_reward
+    '''
+    is_terminal = np.array([task.is_terminal(s) for s in range(num_states)])
+    phi_rows = {s: np.asarray(phi(get_state(s)), dtype=float) for s in np.flatnonzero(~is_terminal)}
+    num_features = next(iter(phi_rows.values())).shape[0]
+    phi_matrix = np.zeros((num_states, num_features))
+    for s, phi_s in phi_rows.items():
+        phi_matrix[s] = phi_s
+    return RewardModel(phi_matrix, {s: goal_reward for s in np.flatnonzero(is_terminal)})
+
 # def estimate_v_pi_tilda(W, mu, sample_initial_state, sample_size=100):
 #     v_pi_tilda = np.dot(W, mu)
 #     # remove two terminal_states
@@ -40,6 +40,7 @@ def _max_margin_learner(task, transition_matrix, reward_matrix, pi_expert,
     if verbose:
         print ("reward_matrix initialized:")
         print (reward_matrix.reshape(8,8))
+    reward_model = make_reward_model(task, get_state, phi, goal_reward)
     for trial_i in tqdm(range(num_trials)):
         if verbose:
             print('max margin IRL starting ... with {}th trial'.format(1+trial_i))
@@ -67,8 +68,7 @@ def _max_margin_learner(task, transition_matrix, reward_matrix, pi_expert,
                 break
 
             # step 4: solve mdpr
-            compute_reward = make_reward_computer(task, W, get_state, phi, goal_reward)
-            reward_matrix = np.asarray([compute_reward(task, s) for s in range(NUM_STATES)])
+            reward_matrix = reward_model.rewards(W)
             Q_star = Q_value_iteration(transition_matrix, reward_matrix, verbose)
             pi_tilda = GreedyPolicy(NUM_STATES, NUM_ACTIONS, Q_star)
             pi_tildas.append(pi_tilda)
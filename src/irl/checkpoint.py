@@ -0,0 +1,41 @@
+import os
+import pickle
+import numpy as np
+
+
+def checkpointed_seed(checkpoint_path, seed):
+    '''
+    the root seed of a run. with checkpoints it is stored with them, and a resumed run
+    takes the one of the interrupted run, so the expert estimate and the trial streams match.
+    None takes the seed from the global np.random state
+    '''
+    if checkpoint_path is None:
+        return np.random.randint(2**63 - 1) if seed is None else seed
+    if not os.path.exists(checkpoint_path):
+        os.makedirs(checkpoint_path)
+    seed_path = os.path.join(checkpoint_path, 'seed.pkl')
+    if os.path.isfile(seed_path):
+        return load_checkpoint(seed_path)
+    if seed is None:
+        seed = np.random.randint(2**63 - 1)
+    save_checkpoint(seed_path, seed)
+    return seed
+
+
+def trial_checkpoints(checkpoint_path, num_trials):
+    if checkpoint_path is None:
+        return [None] * num_trials
+    return [os.path.join(checkpoint_path, 'trial_{}.pkl'.format(trial_i)) for trial_i in range(num_trials)]
+
+
+def save_checkpoint(path, state):
+    # write and rename, an interrupt never leaves a half-written checkpoint behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
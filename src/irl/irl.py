@@ -1,11 +1,15 @@
 import numpy as np
 import numba as nb
-import pandas as np
+import pandas as pd
 import itertools
 import multiprocessing as mp
+from scipy import sparse
+from scipy.sparse.linalg import splu
 
 from constants import *
 from utils.utils import is_terminal_state, compute_terminal_state_reward
+from mdp.transition_model import SparseTransitionModel
+from mdp.rollout import BatchRollout
 
 
 def make_initial_state_sampler(df, has_priority=True):
@@ -45,38 +49,42 @@ def estimate_feature_expectation(transition_matrix,
                                  pi,
                                  num_trajectories=300,
                                  gamma=0.99,
-                                 max_iter=1000):
+                                 max_iter=1000,
+                                 exact=False,
+                                 rollout=None,
+                                 rng=np.random):
     '''
     estimate mu_pi and v_pi with monte carlo simulation
+    exact: if True, skip the simulation and solve for mu_pi and v_pi analytically
+           (see compute_feature_expectation)
+    rollout: BatchRollout built on transition_matrix, pass one in to reuse its sampling tables
+    rng: np.random.Generator (or the np.random module) the simulation draws from
     '''
+    if exact:
+        return compute_feature_expectation(transition_matrix, initial_state_probs, phi, pi, gamma)
+    if rollout is None:
+        rollout = BatchRollout(transition_matrix)
 
-    s = sample_state(initial_state_probs)
-    mu = np.zeros((phi.shape[1]))
-    v_sum = 0.0
+    initial_states = rng.choice(len(initial_state_probs), size=num_trajectories,
+                                p=initial_state_probs)
+    states, _, _, new_states, mask = rollout.run(pi, initial_states, max_iter=max_iter + 1, rng=rng)
+    if np.any(mask[:, -1] & ~is_terminal_state(new_states[:, -1])):
+        print('max iter timeout broke')
+
+    # accumulate phi(s) over trajectories
+    # as discounted visit counts per state
+    discounts = np.broadcast_to(gamma ** np.arange(states.shape[1]), states.shape)
+    state_weights = np.bincount(states[mask], weights=discounts[mask], minlength=phi.shape[0])
+    mu = phi.T.dot(state_weights[:phi.shape[0]])
 
-    mus = []
-    vs = []
-    for i in range(num_trajectories):
-        s = sample_state(initial_state_probs)
-        for t in itertools.count():
-            if t > max_iter:
-                print('max iter timeout broke')
-                break
-            # accumulate phi(s) over trajectories
-            mu += gamma**t * phi[s, :]
-            chosen_a = pi.choose_action(s)
-            probs = np.copy(transition_matrix[s, chosen_a, :])
-            # need to renomralize so sum(probs) < 1
-            probs /= np.sum(probs)
-            new_s = np.random.choice(np.arange(len(probs)), p=probs)
-
-            if is_terminal_state(new_s):
-                # there's no phi(terminal_state)
-                # in practice, non-zero rewars for terminal states
-                num_features = mu.shape[0]
-                v_sum += gamma** t * compute_terminal_state_reward(new_s, num_features)
-                break
-            s = new_s
+    # there's no phi(terminal_state)
+    # in practice, non-zero rewars for terminal states
+    num_features = mu.shape[0]
+    is_terminal_step = mask & is_terminal_state(new_states)
+    v_sum = 0.0
+    for s in np.unique(new_states[is_terminal_step]):
+        reached = is_terminal_step & (new_states == s)
+        v_sum += np.sum(discounts[reached]) * compute_terminal_state_reward(s, num_features)
 
     mu = mu / num_trajectories
     # let's not use v estimated here
@@ -85,6 +93,65 @@ def estimate_feature_expectation(transition_matrix,
     return mu, v
 
 
+def compute_feature_expectation(transition_matrix,
+                                initial_state_probs,
+                                phi,
+                                pi,
+                                gamma=0.99):
+    '''
+    exact counterpart of estimate_feature_expectation
+    with P_pi the chain pi induces over non-terminal states, solve
+        (I - gamma P_pi)^T d = rho_0
+    for the discounted occupancy d. then
+        mu_pi = d^T phi
+        v_pi = d^T P_pi,terminal r_terminal
+    terminal rewards are discounted as in the monte carlo estimate,
+    i.e. gamma^t for the step that enters the terminal state
+    '''
+    action_probs = pi.get_action_probs()
+    num_pure_states = action_probs.shape[0]
+    num_features = phi.shape[1]
+    rho = np.zeros(num_pure_states)
+    # initial states are sampled by their index into initial_state_probs
+    rho[:len(initial_state_probs)] = initial_state_probs
+    terminal_states = range(num_pure_states, transition_matrix.shape[0])
+    terminal_rewards = np.array([compute_terminal_state_reward(s, num_features)
+                                 for s in terminal_states])
+
+    if isinstance(transition_matrix, SparseTransitionModel):
+        d, r_pi = _solve_occupancy_sparse(transition_matrix, action_probs, rho,
+                                          terminal_rewards, gamma)
+    else:
+        P_pi = np.einsum('sa,sat->st', action_probs, transition_matrix[:num_pure_states])
+        A = np.identity(num_pure_states) - gamma * P_pi[:, :num_pure_states]
+        d = np.linalg.solve(A.T, rho)
+        r_pi = P_pi[:, num_pure_states:].dot(terminal_rewards)
+
+    mu = phi.T.dot(d)
+    v = d.dot(r_pi)
+    return mu, v
+
+
+def _solve_occupancy_sparse(transition_model, action_probs, rho, terminal_rewards, gamma):
+    '''
+    P_pi = O + f 1^T with O sparse, so (I - gamma P_pi)^T = B^T - gamma f 1^T
+    where B = I - gamma O. the rank one part is handled with Sherman-Morrison
+    on top of a single sparse LU factorization of B^T
+    '''
+    num_pure_states = action_probs.shape[0]
+    observed_pi, floor_pi = transition_model.policy_transition(action_probs)
+    observed_pi = observed_pi.tocsc()
+    O_pure = observed_pi[:, :num_pure_states]
+    B_T = (sparse.identity(num_pure_states, format='csc') - gamma * O_pure).T.tocsc()
+    lu = splu(B_T)
+    x = lu.solve(rho)
+    y = lu.solve(-gamma * np.ones(num_pure_states))
+    d = x - y * floor_pi.dot(x) / (1. + floor_pi.dot(y))
+    r_pi = observed_pi[:, num_pure_states:].dot(terminal_rewards) + \
+            floor_pi * np.sum(terminal_rewards)
+    return d, r_pi
+
+
 def make_phi(df_centroids):
     '''
     don't use this
@@ -125,14 +192,62 @@ def phi(df_centroids):
         return phi_s
     return phi
 
+class RewardModel():
+    '''
+    state rewards phi W, for one weight vector or a stack of them
+
+    phi: (n, num_features) features of states 0..n-1, dense or scipy sparse
+    terminal_rewards: {state: reward}. terminal states may lie past the rows of phi
+                      (sepsis) or among them (gridworld), where their phi rows are ignored
+    W: weights used when rewards() is called without any
+    '''
+    def __init__(self, phi, terminal_rewards=None, W=None):
+        self.phi = phi
+        self.W = W
+        terminal_rewards = terminal_rewards or {}
+        self.terminal_states = np.array(sorted(terminal_rewards), dtype=np.int64)
+        self.terminal_rewards = np.array([terminal_rewards[s] for s in self.terminal_states], dtype=float)
+        self.num_states = max([phi.shape[0]] + [s + 1 for s in terminal_rewards])
+
+    def rewards(self, W=None):
+        '''
+        returns:
+            (num_states,) reward of every state
+        '''
+        if W is None:
+            W = self.W
+        return self.reward_stack(np.asarray(W)[np.newaxis])[0]
+
+    def reward_stack(self, Ws):
+        '''
+        Ws: (k, num_features) weight vectors
+        returns:
+            (k, num_states) rewards, one row per weight vector
+        '''
+        Ws = np.asarray(Ws, dtype=float)
+        R = np.empty((Ws.shape[0], self.num_states))
+        num_rows = self.phi.shape[0]
+        # phi.dot keeps scipy sparse phi sparse
+        R[:, :num_rows] = np.asarray(self.phi.dot(Ws.T)).T
+        R[:, num_rows:] = 0.0
+        R[:, self.terminal_states] = self.terminal_rewards
+        return R
+
+def make_reward_model(phi, W=None):
+    '''
+    RewardModel of the sepsis mdp: phi covers the pure states,
+    the terminal states get +-sqrt(num_features)
+    '''
+    num_features = phi.shape[1]
+    terminal_rewards = {s: compute_terminal_state_reward(s, num_features)
+                        for s in range(NUM_PURE_STATES, NUM_STATES)}
+    return RewardModel(phi, terminal_rewards, W)
+
 def make_reward_computer(W, phi):
+    # every reward at once, phi may be sparse
+    rewards = make_reward_model(phi).rewards(W)
     def compute_reward(state):
-        if is_terminal_state(state):
-            # special case of terminal states
-            # either 1 or -1
-            num_features = W.shape[0]
-            return compute_terminal_state_reward(state, num_features)
-        return np.dot(W, phi[state, :])
+        return rewards[state]
     return compute_reward
 
 def estimate_v_pi_tilda(W, mu, initial_state_probs, sample_size=100):
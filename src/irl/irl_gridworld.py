@@ -1,6 +1,7 @@
 import numpy as np
 import pandas as pd
 import itertools
+from irl.irl import RewardModel
 # from constants import *
 
 def make_initial_state_sampler(df):
@@ -127,6 +128,13 @@ def phi(state_centroid_mock):
     return phi_s
 
 
+def make_reward_model(get_state, phi, num_states):
+    '''
+    RewardModel with phi applied once to the centroid of every state
+    '''
+    return RewardModel(np.array([phi(get_state(s)) for s in range(num_states)], dtype=float))
+
+
 def make_reward_computer(W, get_state, phi):
     def compute_reward(state):
         # if task.is_terminal(state):
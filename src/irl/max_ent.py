@@ -0,0 +1,292 @@
+import os
+import numpy as np
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from mdp.solver import soft_value_iteration
+from mdp.rollout import BatchRollout
+from policy.policy import SoftmaxPolicy
+from irl.irl import estimate_feature_expectation, compute_feature_expectation, make_reward_model
+from irl.checkpoint import checkpointed_seed, trial_checkpoints, save_checkpoint, load_checkpoint
+from utils.shared import SharedArrays, resolve
+from constants import NUM_PURE_STATES, NUM_ACTIONS
+
+
+# armijo line search: a step must gain at least this fraction of its first order increase
+ARMIJO = 1e-4
+MIN_STEP = 1e-8
+LBFGS_MEMORY = 10
+
+
+class MaxEntIRL():
+    '''
+    maximum entropy IRL (Ziebart 2008) on the mdp and phi of run_max_margin
+
+    for rewards phi W the max-ent policy comes from soft value iteration,
+    and its discounted feature expectation mu_pi from the exact forward pass of
+    compute_feature_expectation. the expert log likelihood
+        L(W) = W.mu_expert - rho_0.V_soft(W)
+    is concave with gradient mu_expert - mu_pi, so L-BFGS ascent moves W until
+    the two feature expectations match. both steps are dense linear algebra,
+    no rollouts and no svm
+    '''
+    def __init__(self, transition_matrix, initial_state_probs, phi,
+                 learning_rate=1.0, gamma=0.99, theta=1e-6):
+        '''
+        learning_rate: size of the first step, a gradient step in per-step units
+        theta: soft value iteration tolerance. the line search compares L of nearby W,
+               which a loose tolerance drowns in noise
+        '''
+        self.transition_matrix = transition_matrix
+        self.initial_state_probs = initial_state_probs
+        self.phi = phi
+        self.learning_rate = learning_rate
+        self.gamma = gamma
+        self.theta = theta
+        self.reward_model = make_reward_model(phi)
+
+    def policy(self, W, v_init=None):
+        '''
+        returns:
+            max-ent SoftmaxPolicy for rewards phi W, its (S,) soft values and the sweeps it took
+        '''
+        Q, v, num_sweeps = soft_value_iteration(self.transition_matrix, self.reward_model.rewards(W),
+                                                theta=self.theta, gamma=self.gamma, v_init=v_init,
+                                                full_output=True)
+        return SoftmaxPolicy(NUM_PURE_STATES, NUM_ACTIONS, Q), v, num_sweeps
+
+    def log_likelihood(self, W, v, mu_expert):
+        '''
+        L(W) up to a constant, from the soft values v of W
+        '''
+        return W.dot(mu_expert) - np.dot(self.initial_state_probs, v[:len(self.initial_state_probs)])
+
+    def fit(self, mu_expert, num_iterations, epsilon, W_init=None, verbose=False, checkpoint_path=None):
+        '''
+        epsilon: stop once |mu_expert - mu_pi| < epsilon
+        every iteration takes one L-BFGS step with a backtracking (armijo) line search on L.
+        the first step is learning_rate times the gradient, later ones start at the
+        full quasi-newton step, which the curvature of the last steps scales
+        checkpoint_path: file the loop state is written to after every iteration
+                         and restored from if it exists
+        returns:
+            a run_max_margin trial dict. margins and dist_mus both hold |mu_expert - mu_pi|,
+            weights and Q are those of the closest iteration. num_sweeps counts the
+            soft value iteration sweeps of the line search too
+        '''
+        if checkpoint_path is not None and os.path.isfile(checkpoint_path):
+            checkpoint = load_checkpoint(checkpoint_path)
+            start, done = checkpoint['iteration'], checkpoint['done']
+            margins, v_pis, num_sweeps = checkpoint['margins'], checkpoint['v_pis'], checkpoint['num_sweeps']
+            W, v, sweeps, objective = checkpoint['W'], checkpoint['v'], checkpoint['sweeps'], \
+                    checkpoint['objective']
+            pi = SoftmaxPolicy(NUM_PURE_STATES, NUM_ACTIONS, checkpoint['Q'])
+            history, step, grad_old = checkpoint['history'], checkpoint['step'], checkpoint['grad_old']
+            best = checkpoint['best']
+            if verbose:
+                print('max ent IRL resuming at iteration {}'.format(start))
+        else:
+            start, done = 0, False
+            margins = np.full(num_iterations, 10000.0)
+            v_pis = np.zeros(num_iterations)
+            num_sweeps = np.zeros(num_iterations, dtype=int)
+            W = np.zeros(self.phi.shape[1]) if W_init is None else np.array(W_init, dtype=float)
+            pi, v, sweeps = self.policy(W)
+            objective = self.log_likelihood(W, v, mu_expert)
+            # (W step, gradient change) pairs of the last LBFGS_MEMORY steps
+            history = []
+            step, grad_old = None, None
+            # (iteration, W, Q) of the smallest margin so far
+            best = None
+
+        def checkpoint(iteration, done):
+            if checkpoint_path is not None:
+                save_checkpoint(checkpoint_path, {
+                    'iteration': iteration, 'done': done,
+                    'margins': margins, 'v_pis': v_pis, 'num_sweeps': num_sweeps,
+                    'W': W, 'v': v, 'sweeps': sweeps, 'objective': objective, 'Q': pi.Q,
+                    'history': history, 'step': step, 'grad_old': grad_old, 'best': best})
+
+        for i in range(start, num_iterations):
+            if done:
+                break
+            mu_pi, v_pis[i] = compute_feature_expectation(self.transition_matrix, self.initial_state_probs,
+                                                          self.phi, pi, self.gamma)
+            grad = mu_expert - mu_pi
+            margins[i] = np.linalg.norm(grad, 2)
+            num_sweeps[i] = sweeps
+            if verbose:
+                print('iteration', i, 'dist_mu', margins[i], 'v_pi', v_pis[i],
+                      'soft value iteration sweeps', num_sweeps[i])
+            if best is None or margins[i] < margins[best[0]]:
+                best = (i, np.copy(W), pi.Q)
+            if margins[i] < epsilon:
+                print('feature expectations matched with', margins[i])
+                checkpoint(i + 1, True)
+                break
+            if i + 1 == num_iterations:
+                checkpoint(i + 1, True)
+                break
+            if grad_old is not None:
+                # L is concave, so s.y > 0 up to the value iteration tolerance. other pairs are skipped
+                y = grad_old - grad
+                if step.dot(y) > 1e-10:
+                    history = history[-(LBFGS_MEMORY - 1):] + [(step, y)]
+            if history:
+                direction, t = _lbfgs_direction(grad, history), 1.0
+            else:
+                # discounted feature expectations are O(1 / (1 - gamma)), the first step uses per-step units
+                direction, t = (1. - self.gamma) * grad, self.learning_rate
+            sweeps = 0
+            while True:
+                W_new = W + t * direction
+                # soft values change little with W, so the last V warm starts the next solve
+                pi_new, v_new, n = self.policy(W_new, v_init=v)
+                sweeps += n
+                objective_new = self.log_likelihood(W_new, v_new, mu_expert)
+                if objective_new >= objective + ARMIJO * t * direction.dot(grad) or t < MIN_STEP:
+                    break
+                t *= 0.5
+            step, grad_old = W_new - W, grad
+            W, pi, v, objective = W_new, pi_new, v_new, objective_new
+            checkpoint(i + 1, False)
+        return {'margins': margins,
+                'dist_mus': np.copy(margins),
+                'v_pis': v_pis,
+                'num_sweeps': num_sweeps,
+                'weights': best[1],
+                'Q': best[2]}
+
+
+def _lbfgs_direction(grad, history):
+    '''
+    two-loop recursion (Nocedal & Wright, algorithm 7.4) for the ascent direction H grad,
+    H the L-BFGS estimate of the inverse of -hessian(L) from history's (s, y) pairs
+    '''
+    q = np.copy(grad)
+    alphas = []
+    for s, y in reversed(history):
+        alpha = s.dot(q) / s.dot(y)
+        q -= alpha * y
+        alphas.append(alpha)
+    s, y = history[-1]
+    q *= s.dot(y) / y.dot(y)
+    for (s, y), alpha in zip(history, reversed(alphas)):
+        beta = y.dot(q) / s.dot(y)
+        q += (alpha - beta) * s
+    return q
+
+
+def run_max_ent(transition_matrix_train,
+                transition_matrix,
+                reward_matrix,
+                pi_expert,
+                initial_state_probs,
+                phi,
+                num_exp_trajectories,
+                learning_rate,
+                epsilon,
+                num_iterations,
+                num_trials,
+                features,
+                verbose,
+                exact_feature_expectation=False,
+                num_workers=1,
+                seed=None,
+                checkpoint_path=None):
+    '''
+    MaxEntIRL with the inputs and the results dict of run_max_margin,
+    so ExperimentManager.save_experiment and the plots take either
+    the expert feature expectation is estimated the same way as in run_max_margin.
+    trials start from different random weights
+    num_workers, seed, checkpoint_path: see run_max_margin
+    '''
+    seed = checkpointed_seed(checkpoint_path, seed)
+    expert_seed, *trial_seeds = np.random.SeedSequence(seed).spawn(num_trials + 1)
+    rollout = None if exact_feature_expectation else BatchRollout(transition_matrix)
+    mu_pi_expert, v_pi_expert = estimate_feature_expectation(transition_matrix,
+                                                             initial_state_probs,
+                                                             phi,
+                                                             pi_expert,
+                                                             num_trajectories=num_exp_trajectories,
+                                                             exact=exact_feature_expectation,
+                                                             rollout=rollout,
+                                                             rng=np.random.default_rng(expert_seed))
+    if verbose:
+        print('objective: get close to ->')
+        print('avg mu_pi_expert', np.mean(mu_pi_expert))
+        print('v_pi_expert', v_pi_expert)
+        print('')
+
+    margins = np.full((num_trials, num_iterations), 10000.0)
+    dist_mus = np.full((num_trials, num_iterations), 10000.0)
+    v_pis = np.zeros((num_trials, num_iterations))
+    num_sweeps = np.zeros((num_trials, num_iterations), dtype=int)
+    approx_exp_weights = np.array([None] * num_trials)
+    approx_exp_policies = np.array([None] * num_trials)
+
+    trial_args = (mu_pi_expert, num_iterations, epsilon, learning_rate, verbose)
+    checkpoint_paths = trial_checkpoints(checkpoint_path, num_trials)
+    num_workers = min(num_workers, num_trials)
+    if num_workers > 1:
+        with SharedArrays() as shared, ProcessPoolExecutor(num_workers) as executor:
+            shared_args = [shared.share(a) for a in (transition_matrix_train, initial_state_probs, phi)]
+            futures = {executor.submit(_run_trial, trial_i, trial_seed, *shared_args, *trial_args,
+                                       checkpoint_paths[trial_i]): trial_i
+                       for trial_i, trial_seed in enumerate(trial_seeds)}
+            trials = {futures[f]: f.result() for f in tqdm(as_completed(futures), total=num_trials)}
+    else:
+        trials = {trial_i: _run_trial(trial_i, trial_seed, transition_matrix_train, initial_state_probs, phi,
+                                      *trial_args, checkpoint_paths[trial_i])
+                  for trial_i, trial_seed in tqdm(enumerate(trial_seeds), total=num_trials)}
+
+    for trial_i, trial in trials.items():
+        margins[trial_i] = trial['margins']
+        dist_mus[trial_i] = trial['dist_mus']
+        v_pis[trial_i] = trial['v_pis']
+        num_sweeps[trial_i] = trial['num_sweeps']
+        approx_exp_weights[trial_i] = trial['weights']
+        approx_exp_policies[trial_i] = trial['Q']
+
+    approx_expert_weights = np.mean(approx_exp_weights, axis=0)
+    intermediate_reward_matrix = make_reward_model(phi).rewards(approx_expert_weights)[:NUM_PURE_STATES]
+    approx_expert_Q = np.mean(approx_exp_policies, axis=0)
+    feature_importances = sorted(zip(features, approx_expert_weights), key=lambda x: x[1], reverse=True)
+    results = {'margins': margins,
+               'dist_mus': dist_mus,
+               'v_pis': v_pis,
+               'v_pi_expert': v_pi_expert,
+               'svm_penlaty': None,
+               'svm_epsilon': epsilon,
+               'learning_rate': learning_rate,
+               'intermediate_rewards': intermediate_reward_matrix,
+               'approx_expert_weights': approx_expert_weights,
+               'feature_imp': feature_importances,
+               'num_exp_trajectories': num_exp_trajectories,
+               'approx_expert_Q': approx_expert_Q,
+               'num_sweeps': num_sweeps
+              }
+    return results
+
+
+def _run_trial(trial_i,
+               seed,
+               transition_matrix_train,
+               initial_state_probs,
+               phi,
+               mu_pi_expert,
+               num_iterations,
+               epsilon,
+               learning_rate,
+               verbose,
+               checkpoint_path=None):
+    '''
+    one max ent trial from random weights. arrays may be utils.shared handles
+    '''
+    phi = resolve(phi)
+    learner = MaxEntIRL(resolve(transition_matrix_train), resolve(initial_state_probs), phi,
+                        learning_rate=learning_rate)
+    if verbose:
+        print('max ent IRL starting ... with {}th trial'.format(1+trial_i))
+    W_init = np.random.default_rng(seed).normal(0, 0.1, phi.shape[1])
+    return learner.fit(mu_pi_expert, num_iterations, epsilon, W_init=W_init, verbose=verbose,
+                       checkpoint_path=checkpoint_path)
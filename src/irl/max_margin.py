@@ -1,10 +1,16 @@
+import os
 import numpy as np
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from mdp.solver import Q_value_iteration
+from mdp.rollout import BatchRollout
+from mdp.transition_model import SparseTransitionModel
 from policy.custom_policy import get_physician_policy
 from policy.policy import GreedyPolicy, RandomPolicy, StochasticPolicy
 from irl.irl import *
 from optimize.quad_opt import QuadOpt
+from utils.shared import SharedArrays, resolve
+from irl.checkpoint import checkpointed_seed, trial_checkpoints, save_checkpoint, load_checkpoint
 from constants import NUM_STATES, NUM_ACTIONS, DATA_PATH
 
 class MaxMarginLearner():
@@ -42,7 +48,13 @@ def run_max_margin(transition_matrix_train,
                     use_stochastic_policy,
                     features,
                     hyperplane_margin,
-                    verbose):
+                    verbose,
+                    exact_feature_expectation=False,
+                    vi_method='jacobi',
+                    num_workers=1,
+                    seed=None,
+                    checkpoint_path=None,
+                    opt_method='svm'):
 
     '''
     reproduced maximum margin IRL algorithm
@@ -57,16 +69,36 @@ def run_max_margin(transition_matrix_train,
                'svm_epsilon': svm_epsilon,
                'approx_expert_weights': approx_expert_weights,
                'num_exp_trajectories': num_exp_trajectories,
-               'approx_expert_Q': approx_expert_Q
+               'approx_expert_Q': approx_expert_Q,
+               'num_sweeps': num_sweeps
               }
     it is important we use only transition_matrix_train for training
     when testing, we will use transition_matrix, which is a better approximation of the world
+    exact_feature_expectation: solve for mu_pi and v_pi instead of monte carlo rollouts
+    vi_method: value iteration backend, one of mdp.solver.VI_METHODS
+    opt_method: weight update, one of optimize.quad_opt.OPT_METHODS
+    num_workers: processes the trials are spread over. the large inputs reach them
+                 as utils.shared.SharedArrays handles
+    seed: root of the random streams. the expert estimate and every trial draw from their own
+          child of np.random.SeedSequence(seed), so results do not depend on num_workers.
+          None takes the seed from the global np.random state
+    checkpoint_path: directory for per-iteration checkpoints of every trial. a run pointed at
+                     the checkpoints of an interrupted run continues exactly where it stopped
     '''
+    seed = checkpointed_seed(checkpoint_path, seed)
+    expert_seed, *trial_seeds = np.random.SeedSequence(seed).spawn(num_trials + 1)
+    if exact_feature_expectation:
+        rollout = None
+    else:
+        rollout = BatchRollout(transition_matrix)
     mu_pi_expert, v_pi_expert = estimate_feature_expectation(transition_matrix,
                                                              initial_state_probs,
                                                              phi,
                                                              pi_expert,
-                                                             num_trajectories=num_exp_trajectories)
+                                                             num_trajectories=num_exp_trajectories,
+                                                             exact=exact_feature_expectation,
+                                                             rollout=rollout,
+                                                             rng=np.random.default_rng(expert_seed))
     if verbose:
         print('objective: get close to ->')
         print('avg mu_pi_expert', np.mean(mu_pi_expert))
@@ -79,92 +111,38 @@ def run_max_margin(transition_matrix_train,
     margins = np.full((num_trials, num_iterations), 10000.0)
     dist_mus = np.full((num_trials, num_iterations), 10000.0)
     v_pis = np.zeros((num_trials, num_iterations))
-    intermediate_reward_matrix = np.zeros((reward_matrix.shape))
+    num_sweeps = np.zeros((num_trials, num_iterations), dtype=int)
     approx_exp_policies = np.array([None] * num_trials)
     approx_exp_weights = np.array([None] * num_trials)
 
+    trial_args = (mu_pi_expert, num_iterations, svm_penalty, svm_epsilon,
+                  use_stochastic_policy, hyperplane_margin, verbose, exact_feature_expectation, vi_method,
+                  opt_method)
+    checkpoint_paths = trial_checkpoints(checkpoint_path, num_trials)
+    num_workers = min(num_workers, num_trials)
+    if num_workers > 1:
+        with SharedArrays() as shared, ProcessPoolExecutor(num_workers) as executor:
+            shared_args = [shared.share(a) for a in (transition_matrix_train, initial_state_probs, phi)]
+            futures = {executor.submit(_run_trial, trial_i, trial_seed, *shared_args, *trial_args,
+                                       checkpoint_paths[trial_i]): trial_i
+                       for trial_i, trial_seed in enumerate(trial_seeds)}
+            trials = {futures[f]: f.result() for f in tqdm(as_completed(futures), total=num_trials)}
+    else:
+        trials = {trial_i: _run_trial(trial_i, trial_seed, transition_matrix_train, initial_state_probs, phi,
+                                      *trial_args, checkpoint_paths[trial_i])
+                  for trial_i, trial_seed in tqdm(enumerate(trial_seeds), total=num_trials)}
 
-    for trial_i in tqdm(range(num_trials)):
-        if verbose:
-            print('max margin IRL starting ... with {}th trial'.format(1+trial_i))
-
-        # step 1: initialize pi_tilda and mu_pi_tilda
-        pi_tilda = RandomPolicy(NUM_PURE_STATES, NUM_ACTIONS)
-        mu_pi_tilda, v_pi_tilda = estimate_feature_expectation(transition_matrix_train,
-                                                           initial_state_probs,
-                                                           phi, pi_tilda)
-        opt = QuadOpt(epsilon=svm_epsilon,
-                      penalty=svm_penalty,
-                      hyperplane_margin=hyperplane_margin)
-        best_actions_old = None
-        W_old = None
-        pi_tildas = np.array([None]*num_iterations)
-        weights = np.array([None]*num_iterations)
-        for i in range(num_iterations):
-            # step 2: solve qp
-            W, converged, margin = opt.optimize(mu_pi_expert, mu_pi_tilda)
-            # step 3: terminate if margin <= epsilon
-            if converged:
-                print('margin coverged with', margin)
-                break
-
-            weights[i] = W
-            # step 4: solve mdpr
-            compute_reward = make_reward_computer(W, phi)
-            reward_matrix = np.asarray([compute_reward(s) for s in range(NUM_STATES)])
-            Q_star = Q_value_iteration(transition_matrix_train, reward_matrix)
-            if use_stochastic_policy:
-                pi_tilda = StochasticPolicy(NUM_PURE_STATES, NUM_ACTIONS, Q_star)
-            else:
-                pi_tilda = GreedyPolicy(NUM_PURE_STATES, NUM_ACTIONS, Q_star)
-            pi_tildas[i] = pi_tilda
-            # step 5: estimate mu pi tilda
-            mu_pi_tilda, v_pi_tilda = estimate_feature_expectation(
-                                   transition_matrix_train,
-                                   initial_state_probs,
-                                   phi, pi_tilda)
-            dist_mu = np.linalg.norm(mu_pi_tilda - mu_pi_expert, 2)
-            if verbose:
-                # intermediate reeport for debugging
-                print('max intermediate rewards: ', np.max(reward_matrix[:-2]))
-                print('avg intermediate rewards: ', np.mean(reward_matrix[:-2]))
-                print('min intermediate rewards: ', np.min(reward_matrix[:-2]))
-                print('sd intermediate rewards: ', np.std(reward_matrix[:-2]))
-                best_actions = np.argmax(Q_star, axis=1)
-                if best_actions_old is not None:
-                    actions_diff = np.sum(best_actions != best_actions_old)
-                    actions_diff /= best_actions.shape[0]
-                    print('(approx.) argmax Q changed (%)', 100*actions_diff)
-                    best_actions_old = best_actions
-
-                if W_old is not None:
-                    print('weight difference (l2 norm)', np.linalg.norm(W_old - W, 2))
-                W_old = W
-                print('avg mu_pi_tilda', np.mean(mu_pi_tilda))
-                print('dist_mu', dist_mu)
-                print('margin', margin)
-                print('v_pi', v_pi_tilda)
-                print('')
-
-            # step 6: saving plotting vars
-            dist_mus[trial_i, i] = dist_mu
-            margins[trial_i, i] = margin
-            v_pis[trial_i, i] = v_pi_tilda
-            intermediate_reward_matrix += reward_matrix
-        # find a near-optimal policy from a policy reservoir
-        # taken from Abbeel (2004)
-        # TODO: retrieve near-optimal expert policy
-        min_margin_iter_idx = np.argmin(margins[trial_i])
-        approx_exp_weights[trial_i] = weights[min_margin_iter_idx]
-        approx_exp_policies[trial_i] = pi_tildas[min_margin_iter_idx].Q
-        if verbose:
-            print('best weights at {}th trial'.format(trial_i), weights[min_margin_iter_idx])
-            print('best Q at {}th trial'.format(trial_i), pi_tildas[min_margin_iter_idx].Q)
+    for trial_i, trial in trials.items():
+        margins[trial_i] = trial['margins']
+        dist_mus[trial_i] = trial['dist_mus']
+        v_pis[trial_i] = trial['v_pis']
+        num_sweeps[trial_i] = trial['num_sweeps']
+        approx_exp_weights[trial_i] = trial['weights']
+        approx_exp_policies[trial_i] = trial['Q']
 
     # there will be a better way to do a policy selection
     approx_expert_weights = np.mean(approx_exp_weights, axis=0)
-    compute_reward = make_reward_computer(approx_expert_weights, phi)
-    intermediate_reward_matrix = np.asarray([compute_reward(s) for s in range(NUM_PURE_STATES)])
+    intermediate_reward_matrix = make_reward_model(phi).rewards(approx_expert_weights)[:NUM_PURE_STATES]
     approx_expert_Q = np.mean(approx_exp_policies, axis=0)
     feature_importances = sorted(zip(features, approx_expert_weights), key=lambda x: x[1], reverse=True)
     results = {'margins': margins,
@@ -177,8 +155,177 @@ def run_max_margin(transition_matrix_train,
                'approx_expert_weights': approx_expert_weights,
                'feature_imp': feature_importances,
                'num_exp_trajectories': num_exp_trajectories,
-               'approx_expert_Q': approx_expert_Q
+               'approx_expert_Q': approx_expert_Q,
+               'num_sweeps': num_sweeps
               }
     return results
 
 
+def _run_trial(trial_i,
+               seed,
+               transition_matrix_train,
+               initial_state_probs,
+               phi,
+               mu_pi_expert,
+               num_iterations,
+               svm_penalty,
+               svm_epsilon,
+               use_stochastic_policy,
+               hyperplane_margin,
+               verbose,
+               exact_feature_expectation,
+               vi_method,
+               opt_method,
+               checkpoint_path=None):
+    '''
+    one max margin trial. arrays may be utils.shared handles
+    returns the trial's rows of margins, dist_mus, v_pis and num_sweeps
+    and the weights and Q of its smallest-margin iteration
+    checkpoint_path: file the loop state is written to after every iteration
+                     and restored from if it exists
+    '''
+    transition_matrix_train = resolve(transition_matrix_train)
+    initial_state_probs = resolve(initial_state_probs)
+    phi = resolve(phi)
+    rng = np.random.default_rng(seed)
+    if exact_feature_expectation:
+        rollout_train = None
+    else:
+        # sampling tables are built once and shared by every estimate below
+        rollout_train = BatchRollout(transition_matrix_train)
+    # the in-place solvers run on the sparse form, so a dense tensor is converted once per trial
+    # instead of on every Q_value_iteration call. jacobi sweeps the dense tensor as is
+    if vi_method == 'jacobi' or isinstance(transition_matrix_train, SparseTransitionModel):
+        vi_transition_matrix = transition_matrix_train
+    else:
+        vi_transition_matrix = SparseTransitionModel.from_dense(transition_matrix_train)
+    reward_model = make_reward_model(phi)
+    margins = np.full(num_iterations, 10000.0)
+    dist_mus = np.full(num_iterations, 10000.0)
+    v_pis = np.zeros(num_iterations)
+    num_sweeps = np.zeros(num_iterations, dtype=int)
+    # W changes little between iterations, so the last V*
+    # is a good starting point for the next value iteration
+    v_star = None
+
+    opt = QuadOpt(epsilon=svm_epsilon,
+                  penalty=svm_penalty,
+                  hyperplane_margin=hyperplane_margin,
+                  method=opt_method)
+    best_actions_old = None
+    W_old = None
+    # only the smallest-margin iteration is returned, so only its W and Q are kept.
+    # this also keeps the checkpoints the same size at every iteration
+    best_i, best_W, best_Q = None, None, None
+    start = 0
+    done = False
+
+    if checkpoint_path is not None and os.path.isfile(checkpoint_path):
+        checkpoint = load_checkpoint(checkpoint_path)
+        start, done = checkpoint['iteration'], checkpoint['done']
+        margins, dist_mus, v_pis, num_sweeps = checkpoint['margins'], checkpoint['dist_mus'], \
+                checkpoint['v_pis'], checkpoint['num_sweeps']
+        best_i, best_W, best_Q = checkpoint['best_i'], checkpoint['best_W'], checkpoint['best_Q']
+        mu_pi_tilda, v_pi_tilda, v_star = checkpoint['mu_pi_tilda'], checkpoint['v_pi_tilda'], checkpoint['v_star']
+        best_actions_old, W_old = checkpoint['best_actions_old'], checkpoint['W_old']
+        opt.set_state(checkpoint['opt'])
+        rng.bit_generator.state = checkpoint['rng']
+        if verbose:
+            print('max margin IRL resuming {}th trial at iteration {}'.format(1+trial_i, start))
+    else:
+        if verbose:
+            print('max margin IRL starting ... with {}th trial'.format(1+trial_i))
+
+        # step 1: initialize pi_tilda and mu_pi_tilda
+        pi_tilda = RandomPolicy(NUM_PURE_STATES, NUM_ACTIONS)
+        mu_pi_tilda, v_pi_tilda = estimate_feature_expectation(transition_matrix_train,
+                                                           initial_state_probs,
+                                                           phi, pi_tilda,
+                                                           exact=exact_feature_expectation,
+                                                           rollout=rollout_train,
+                                                           rng=rng)
+
+    def checkpoint(iteration, done):
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, {
+                'iteration': iteration, 'done': done,
+                'margins': margins, 'dist_mus': dist_mus, 'v_pis': v_pis, 'num_sweeps': num_sweeps,
+                'best_i': best_i, 'best_W': best_W, 'best_Q': best_Q,
+                'mu_pi_tilda': mu_pi_tilda, 'v_pi_tilda': v_pi_tilda, 'v_star': v_star,
+                'best_actions_old': best_actions_old, 'W_old': W_old,
+                'opt': opt.get_state(), 'rng': rng.bit_generator.state})
+
+    for i in range(start, num_iterations):
+        if done:
+            break
+        # step 2: solve qp
+        W, converged, margin = opt.optimize(mu_pi_expert, mu_pi_tilda)
+        # step 3: terminate if margin <= epsilon
+        if converged:
+            print('margin coverged with', margin)
+            checkpoint(i, True)
+            break
+
+        # step 4: solve mdpr
+        reward_matrix = reward_model.rewards(W)
+        Q_star, v_star, num_sweeps[i] = Q_value_iteration(vi_transition_matrix,
+                                                          reward_matrix,
+                                                          v_init=v_star,
+                                                          full_output=True,
+                                                          method=vi_method)
+        if use_stochastic_policy:
+            pi_tilda = StochasticPolicy(NUM_PURE_STATES, NUM_ACTIONS, Q_star)
+        else:
+            pi_tilda = GreedyPolicy(NUM_PURE_STATES, NUM_ACTIONS, Q_star)
+        # step 5: estimate mu pi tilda
+        mu_pi_tilda, v_pi_tilda = estimate_feature_expectation(
+                               transition_matrix_train,
+                               initial_state_probs,
+                               phi, pi_tilda,
+                               exact=exact_feature_expectation,
+                               rollout=rollout_train,
+                               rng=rng)
+        dist_mu = np.linalg.norm(mu_pi_tilda - mu_pi_expert, 2)
+        if verbose:
+            # intermediate reeport for debugging
+            print('max intermediate rewards: ', np.max(reward_matrix[:-2]))
+            print('avg intermediate rewards: ', np.mean(reward_matrix[:-2]))
+            print('min intermediate rewards: ', np.min(reward_matrix[:-2]))
+            print('sd intermediate rewards: ', np.std(reward_matrix[:-2]))
+            best_actions = np.argmax(Q_star, axis=1)
+            if best_actions_old is not None:
+                actions_diff = np.sum(best_actions != best_actions_old)
+                actions_diff /= best_actions.shape[0]
+                print('(approx.) argmax Q changed (%)', 100*actions_diff)
+                best_actions_old = best_actions
+
+            if W_old is not None:
+                print('weight difference (l2 norm)', np.linalg.norm(W_old - W, 2))
+            W_old = W
+            print('avg mu_pi_tilda', np.mean(mu_pi_tilda))
+            print('dist_mu', dist_mu)
+            print('margin', margin)
+            print('v_pi', v_pi_tilda)
+            print('value iteration sweeps', num_sweeps[i])
+            print('')
+
+        # step 6: saving plotting vars
+        dist_mus[i] = dist_mu
+        margins[i] = margin
+        v_pis[i] = v_pi_tilda
+        # first smallest margin, as np.argmin(margins) after the loop
+        if best_i is None or margin < margins[best_i]:
+            best_i, best_W, best_Q = i, W, Q_star
+        checkpoint(i + 1, i + 1 == num_iterations)
+    # find a near-optimal policy from a policy reservoir
+    # taken from Abbeel (2004)
+    # TODO: retrieve near-optimal expert policy
+    if verbose:
+        print('best weights at {}th trial'.format(trial_i), best_W)
+        print('best Q at {}th trial'.format(trial_i), best_Q)
+    return {'margins': margins,
+            'dist_mus': dist_mus,
+            'v_pis': v_pis,
+            'num_sweeps': num_sweeps,
+            'weights': best_W,
+            'Q': best_Q}
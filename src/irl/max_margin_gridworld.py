@@ -29,6 +29,7 @@ def max_margin_learner(task, NUM_STATES, NUM_ACTIONS, transition_matrix, reward_
 
     # get_state = make_state_centroid_finder(df_centroids, feature_columns) # get state centroid
     get_state = make_state_centroid_finder_mock(task, NUM_STATES)
+    reward_model = make_reward_model(get_state, phi, NUM_STATES)
 
     # phi = make_phi(task) # 
     opt = QuadOpt(epsilon)
@@ -70,8 +71,7 @@ def max_margin_learner(task, NUM_STATES, NUM_ACTIONS, transition_matrix, reward_
         # step 3: terminate if margin <= epsilon
         if not converged:
             # step 4: solve mdpr
-            compute_reward = make_reward_computer(W_tilda, get_state, phi)
-            reward_matrix = np.asarray([compute_reward(s) for s in range(NUM_STATES)])
+            reward_matrix = reward_model.rewards(W_tilda)
             pi_tilda, Q_table = Q_learning_solver_for_irl(task, transition_matrix, reward_matrix, NUM_STATES, NUM_ACTIONS)
             # pi_tilda = solve_mdp(transition_matrix, reward_matrix)
             # pi_tilda = pi_expert
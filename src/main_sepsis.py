@@ -1,4 +1,6 @@
 from experiments.experiment import ExperimentManager, Experiment
+from mdp.solver import VI_METHODS
+from optimize.quad_opt import OPT_METHODS
 from constants import *
 
 import numpy as np
@@ -14,14 +16,25 @@ def get_arg_parser():
     parser.set_defaults(verbose=False)
     parser.add_argument('-up', '--use_pca', action='store_true', dest='use_pca')
     parser.set_defaults(use_pca=False)
+    parser.add_argument('-us', '--use_sparse', action='store_true', dest='use_sparse',
+                        help="keep transition matrices as sparse CSR models")
+    parser.set_defaults(use_sparse=False)
+    parser.add_argument('-cs', '--chunksize', default=None, type=int, dest='chunksize',
+                        help="preprocess the raw csv files out of core in chunks of this many rows")
     parser.add_argument('-cm', '--clustering_method', default='km', type=str,
                         help="kmeans or kprototype (cao, huang)",
                         dest="clustering_method", choices=['km', 'kp'])
     parser.add_argument('-ns', '--num_states', default=750, type=int, dest='num_states')
+    parser.add_argument('-nsd', '--num_seeds', default=1, type=int, dest='num_seeds',
+                        help="k-means seeds fitted in parallel, the best held-out fit is kept")
     parser.add_argument('-p', '--parallelized', action='store_true', dest='parallelized')
     parser.set_defaults(parallelized=False)
     parser.add_argument('-nt', '--num_trials', default=2, type=int, dest='num_trials')
     parser.add_argument('-ni', '--num_iterations', default=10, type=int, dest='num_iterations')
+    parser.add_argument('-r', '--resume', default=None, type=str, dest='resume',
+                        help="name of an interrupted run to continue from its checkpoints")
+    parser.add_argument('-ntw', '--num_trial_workers', default=1, type=int, dest='num_trial_workers',
+                        help="processes the trials of one experiment run on, capped at the core count")
 
     parser.add_argument('-nb', '--num_bins', type=int, choices=[2, 4], dest='num_bins')
     # optimizer stuff
@@ -31,6 +44,17 @@ def get_arg_parser():
     parser.add_argument('-hm', '--hyperplane_margin', action='store_true', dest='hyperplane_margin')
     parser.set_defaults(hyperplane_margin=False)
     parser.add_argument('-net', '--num_expert_trajectories', default=1500, dest='num_exp_trajectories')
+    parser.add_argument('-efe', '--exact_feature_expectation', action='store_true', dest='exact_feature_expectation',
+                        help="solve for feature expectations instead of monte carlo rollouts")
+    parser.set_defaults(exact_feature_expectation=False)
+    parser.add_argument('-vm', '--vi_method', default='jacobi', type=str, dest='vi_method',
+                        choices=VI_METHODS, help="value iteration backend")
+    parser.add_argument('-im', '--irl_method', default='max_margin', type=str, dest='irl_method',
+                        choices=['max_margin', 'max_ent'], help="max margin apprenticeship learning or max-ent IRL")
+    parser.add_argument('-lr', '--learning_rate', default=1.0, type=float, dest='learning_rate',
+                        help="first step of max-ent IRL, in per-step feature units. it stops at svm_epsilon")
+    parser.add_argument('-om', '--opt_method', default='svm', type=str, dest='opt_method',
+                        choices=OPT_METHODS, help="weight update: max margin svm or projection")
     return parser
 
 if __name__ == '__main__':
@@ -38,7 +62,7 @@ if __name__ == '__main__':
     exps = []
     em = ExperimentManager(args)
 
-    cur_t = time.strftime('%y%m%d_%H%M%S', time.gmtime())
+    cur_t = em.experiment_name
     exp1 = Experiment(
         experiment_id =  cur_t + '_' + 'irl_greedy_physician_greedy',
         policy_expert = em.pi_expert_phy_g,
@@ -2,24 +2,48 @@ import numpy as np
 import numba as nb
 import pandas as pd
 import os
+from scipy import sparse
 from constants import *
 from utils.utils import *
+from mdp.transition_model import SparseTransitionModel
 
 
-def make_mdp(trajectories, num_states, num_actions, transition_filepath, reward_filepath):
+def make_mdp(trajectories, num_states, num_actions, transition_filepath, reward_filepath,
+             use_sparse=False, cache=None):
     '''
     build states by running k-means clustering
     Note: we exclude nominal categorical columns from clustering.
     the columns to be excluded are: chartime, icustyaid, bloc
+    use_sparse: if True, return a SparseTransitionModel instead of a dense (S, A, S) array
+            and cache it as .npz next to transition_filepath
+    cache: utils.cache.ArtifactCache. if given, the mdp is keyed on trajectories and
+           the parameters, and both filepaths are ignored
     '''
+    if cache is not None:
+        build = _make_sparse_mdp if use_sparse else _make_mdp
+        return cache.get_or_compute('mdp',
+                                    lambda: build(trajectories, num_states, num_actions),
+                                    params={'num_states': num_states,
+                                            'num_actions': num_actions,
+                                            'use_sparse': use_sparse},
+                                    deps=[trajectories])
+    if use_sparse:
+        transition_filepath = os.path.splitext(transition_filepath)[0] + '.npz'
     if os.path.isfile(transition_filepath) and \
             os.path.isfile(reward_filepath):
-        transition_matrix = np.load(transition_filepath)
+        if use_sparse:
+            transition_matrix = SparseTransitionModel.load(transition_filepath)
+        else:
+            transition_matrix = np.load(transition_filepath)
         reward_matrix = np.load(reward_filepath)
     else:
         print('making mdp')
-        transition_matrix, reward_matrix = _make_mdp(trajectories, num_states, num_actions)
-        np.save(transition_filepath, transition_matrix)
+        if use_sparse:
+            transition_matrix, reward_matrix = _make_sparse_mdp(trajectories, num_states, num_actions)
+            transition_matrix.save(transition_filepath)
+        else:
+            transition_matrix, reward_matrix = _make_mdp(trajectories, num_states, num_actions)
+            np.save(transition_filepath, transition_matrix)
         np.save(reward_filepath, reward_matrix)
     return transition_matrix, reward_matrix
 
@@ -32,49 +56,50 @@ def _make_mdp(trajectories, num_states, num_actions):
     TRANSITION_PROB_UNVISITED_SAS = eps / num_states
     # if (s, a) never observed, we naively assume uniform transition
     TRANSITION_PROB_UNVISITED_SA = 1.0 / num_states
-    REWARD_UNVISITED_SA = 0.0
 
-    # create dataframe for easy tallying
-    cols = ['s', 'a', 'r', 'new_s']
-    df = pd.DataFrame(trajectories[:,1:], columns=cols)
-    groups_sas = df.groupby(['s', 'a', 'new_s'])
-    groups_sa = df.groupby(['s', 'a'])
-    avg_reward_sa = groups_sa['r'].mean()
-    transition_count_sa = groups_sa.size()
-    transition_count_sas = groups_sas.size()
-    
-    # TODO: vectorize this
-    i = 0
-    print('this is a loop of length', num_states**2 * num_actions)
-    for s in range(num_states):
-        if s == (num_states - 1) or s == (num_states - 2):
-            # TODO: fix this hardcoding
-            # if terminal states, must be absorbing
-            transition_matrix[s, :, s] = 1.0
-            continue
-        for a in range(num_actions):
-            # store empirical reward
-            #if (s, a) in avg_reward_sa:
-            #    #reward_matrix[s, a] = avg_reward_sa[(s, a)]
-            #    reward_matrix[s, a] = REWARD_UNVISITED_SA
-            #else:
-            #    reward_matrix[s, a] = REWARD_UNVISITED_SA
-            # store empirical transitions
-            if (s, a) in transition_count_sa:
-                # give small trans. prob to every next state
-                transition_matrix[s, a, :] = TRANSITION_PROB_UNVISITED_SAS
-                num_sa = transition_count_sa[(s, a)]
-                for new_s in range(num_states):
-                    i+=1
-                    if i % 100000 == 0:
-                        print('patience is a virtue. state: {}'.format(s, a))
-                    if (s, a, new_s) in transition_count_sas:
-                        num_sas = transition_count_sas[(s, a, new_s)]
-                        transition_matrix[s, a, new_s] += (1 - eps)*num_sas / num_sa
-            else:
-                # if (s, a) never observed, we naively assume uniform transition
-                transition_matrix[s, a, :] = TRANSITION_PROB_UNVISITED_SA
+    # tally (s, a, s') in one pass over flattened indices
+    s = trajectories[:, 1].astype(np.int64)
+    a = trajectories[:, 2].astype(np.int64)
+    new_s = trajectories[:, 4].astype(np.int64)
+    sas_idx = (s * num_actions + a) * num_states + new_s
+    transition_count_sas = np.bincount(sas_idx, minlength=num_states * num_actions * num_states)
+    transition_count_sas = transition_count_sas.reshape((num_states, num_actions, num_states))
+    transition_count_sa = transition_count_sas.sum(axis=2)
+    visited_sa = transition_count_sa > 0
+
+    # give small trans. prob to every next state of a visited (s, a)
+    # order of operations kept as eps/S + (1 - eps)*N_sas / N_sa
+    # so that the numbers match the old looped builder bit for bit
+    num_sa = np.where(visited_sa, transition_count_sa, 1)[:, :, np.newaxis]
+    transition_matrix[visited_sa] = TRANSITION_PROB_UNVISITED_SAS + \
+        ((1 - eps) * transition_count_sas / num_sa)[visited_sa]
+    # if (s, a) never observed, we naively assume uniform transition
+    transition_matrix[~visited_sa] = TRANSITION_PROB_UNVISITED_SA
+
+    # TODO: fix this hardcoding
+    # if terminal states, must be absorbing
+    terminal_states = [num_states - 2, num_states - 1]
+    for s_term in terminal_states:
+        transition_matrix[s_term, :, :] = 0.0
+        transition_matrix[s_term, :, s_term] = 1.0
+    return transition_matrix, reward_matrix
 
+def _make_sparse_mdp(trajectories, num_states, num_actions):
+    '''
+    same model as _make_mdp but only the observed (s, a) -> s' counts are stored
+    the eps smoothing and the uniform fallback for unvisited (s, a) stay implicit
+    '''
+    reward_matrix = np.zeros((num_states, num_actions))
+    eps = 1e-2
+    s = trajectories[:, 1].astype(np.int64)
+    a = trajectories[:, 2].astype(np.int64)
+    new_s = trajectories[:, 4].astype(np.int64)
+    counts = sparse.coo_matrix((np.ones(s.shape[0]), (s * num_actions + a, new_s)),
+                               shape=(num_states * num_actions, num_states)).tocsr()
+    # TODO: fix this hardcoding
+    terminal_states = [num_states - 2, num_states - 1]
+    transition_matrix = SparseTransitionModel.from_counts(counts, num_states, num_actions,
+                                                          eps=eps, terminal_states=terminal_states)
     return transition_matrix, reward_matrix
 
 def build_reward_matrix(reward_fn, num_states):
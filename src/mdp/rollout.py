@@ -0,0 +1,92 @@
+import numpy as np
+from mdp.transition_model import SparseTransitionModel
+from utils.utils import is_terminal_state
+from policy.policy import sample_from_cdf
+
+
+class BatchRollout():
+    '''
+    simulates many trajectories in lockstep
+
+    next states are drawn by vectorized inverse-CDF sampling on
+    per-(s, a) cumulative distributions that are computed once per
+    transition matrix. dense tensors are split into their uniform floor
+    and the sparse mass above it (see SparseTransitionModel.from_dense)
+    so the cumulative tables stay small.
+    build one instance per transition matrix and reuse it across calls
+    '''
+    def __init__(self, transition_matrix, max_iter=1000):
+        if isinstance(transition_matrix, SparseTransitionModel):
+            self.transition_model = transition_matrix
+        else:
+            self.transition_model = SparseTransitionModel.from_dense(transition_matrix)
+        self.num_states = self.transition_model.num_states
+        self.num_actions = self.transition_model.num_actions
+        self.max_iter = max_iter
+
+    def sample_actions(self, action_cdf, states, rng=np.random):
+        '''
+        action_cdf: (n, A) cumulative action probabilities of a policy
+        states outside the policy's table (i.e. terminal states) take action 0
+        '''
+        return sample_from_cdf(action_cdf, states, rng)
+
+    def run(self, pi, initial_states, reward_matrix=None, include_terminal=False,
+            max_iter=None, rng=np.random):
+        '''
+        pi: policy exposing choose_actions(states, rng) (see policy.policy) or get_action_probs()
+        initial_states: (N,) starting state of every trajectory
+        reward_matrix: (S,) state rewards. r_t = reward_matrix[s_t]
+        include_terminal: if False, a trajectory ends with the step that enters a terminal state.
+                          if True, the terminal state itself is also recorded as a final step
+        returns:
+            states, actions, rewards, new_states: (N, T) arrays
+            mask: (N, T) boolean, True where the step was actually taken
+        '''
+        if max_iter is None:
+            max_iter = self.max_iter
+        if hasattr(pi, 'choose_actions'):
+            choose_actions = pi.choose_actions
+        else:
+            action_cdf = np.cumsum(pi.get_action_probs(), axis=1)
+            choose_actions = lambda states, rng: self.sample_actions(action_cdf, states, rng)
+        s = np.asarray(initial_states, dtype=np.int64).copy()
+        num_trajectories = s.shape[0]
+        if include_terminal:
+            done = np.zeros(num_trajectories, dtype=bool)
+        else:
+            done = is_terminal_state(s)
+
+        states, actions, new_states, masks = [], [], [], []
+        for t in range(max_iter):
+            if np.all(done):
+                break
+            active = np.flatnonzero(~done)
+            a = np.zeros(num_trajectories, dtype=np.int64)
+            new_s = s.copy()
+            a[active] = choose_actions(s[active], rng)
+            new_s[active] = self.transition_model.sample_next_states(s[active], a[active], rng)
+
+            states.append(s)
+            actions.append(a)
+            new_states.append(new_s)
+            masks.append(~done)
+
+            if include_terminal:
+                done = done | is_terminal_state(s)
+            else:
+                done = done | is_terminal_state(new_s)
+            s = new_s
+
+        if len(masks) == 0:
+            empty = np.zeros((num_trajectories, 0), dtype=np.int64)
+            return empty, empty, np.zeros((num_trajectories, 0)), empty, empty.astype(bool)
+        states = np.stack(states, axis=1)
+        actions = np.stack(actions, axis=1)
+        new_states = np.stack(new_states, axis=1)
+        mask = np.stack(masks, axis=1)
+        if reward_matrix is None:
+            rewards = np.zeros(states.shape)
+        else:
+            rewards = np.where(mask, np.asarray(reward_matrix)[states], 0.0)
+        return states, actions, rewards, new_states, mask
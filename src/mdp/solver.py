@@ -2,8 +2,14 @@ import numpy as np
 import numba as nb
 import logging
 import itertools
+import heapq
+from scipy import sparse
+from scipy.sparse.linalg import splu
+from scipy.optimize import linprog
 from policy.policy import EpsilonGreedyPolicy, GreedyPolicy
 from learners.monte_carlo_on_policy import run_mc_actor
+from mdp.rollout import BatchRollout
+from mdp.transition_model import SparseTransitionModel
 from constants import TERMINAL_STATE_ALIVE, TERMINAL_STATE_DEAD
 from utils.utils import is_terminal_state, compute_terminal_state_reward
 
@@ -63,174 +69,493 @@ def Q_learning_solver_for_irl(task, transition_matrix, reward_matrix, NUM_STATES
     return optimal_policy, Q_table
 
 def evaluate_policy_mc(transition_matrix, reward_matrix, sample_initial_state, pi,
-                                 gamma=0.99, num_trajectories=300, max_iter=500):
+                                 gamma=0.99, num_trajectories=300, max_iter=500, rollout=None):
     '''
     estimate mu_pi and v_pi with monte carlo simulation
     with reward_matrix whose only non-zero rewards are terminal rewards
     '''
-
-    v_sum = 0.0
-    for i in range(num_trajectories):
-        s = sample_initial_state()
-        for t in itertools.count():
-            if t > max_iter:
-                print('max iter timeout broke')
-                break
-            if is_terminal_state(s):
-                v_sum += gamma** t * reward_matrix[s]
-                break
-            # sample action
-            a = pi.choose_action(s)
-            # sample next state
-            probs = np.copy(transition_matrix[s, a, :])
-            probs /= np.sum(probs)
-            s = np.random.choice(np.arange(len(probs)), p=probs)
+    if rollout is None:
+        rollout = BatchRollout(transition_matrix)
+    initial_states = np.array([sample_initial_state() for _ in range(num_trajectories)])
+    _, _, _, new_states, mask = rollout.run(pi, initial_states, max_iter=max_iter)
+    if np.any(mask[:, -1] & ~is_terminal_state(new_states[:, -1])):
+        print('max iter timeout broke')
+    # a terminal state entered at step t is reached at time t + 1
+    discounts = gamma ** np.arange(1, new_states.shape[1] + 1)
+    is_terminal_step = mask & is_terminal_state(new_states)
+    v_sum = np.sum((discounts * is_terminal_step) * reward_matrix[new_states])
+    # initial states that are already terminal
+    v_sum += np.sum([reward_matrix[s] for s in initial_states if is_terminal_state(s)])
     v =  v_sum / num_trajectories
     return v
 
 def evaluate_policy_monte_carlo(pi, sample_initial_state, transition_matrix, reward_matrix,
-                                gamma=0.99, num_episodes=700):
-    '''
-    too slow
-    '''
-    rewards = []
-    for _ in range(num_episodes):
-        exps = run_mc_actor(pi, sample_initial_state, transition_matrix, reward_matrix, max_local_iter=500)
-        G = np.sum([(gamma**t)*e[2] for t, e in enumerate(exps)])
-        rewards.append(G)
-    return np.mean(rewards)
-
-def run_mc_actor(pi, sample_initial_state, transition_matrix, reward_matrix, max_local_iter=500):
-    '''
-    violates DRY principle but let's keep it here also
-    and too slow
-    '''
-    exps = []
-    s = sample_initial_state()
-    a = pi.choose_action(s)
-    iter_i = 0
-    while iter_i < max_local_iter:
-        r = reward_matrix[s]
-        #print('took {} at {} got {}'.format(a, s, r))
-        # get the next state
-        probs = np.copy(transition_matrix[s, a, :])
-        # need to renomralize so sum(probs) < 1
-        probs /= np.sum(probs)
-        new_s = np.random.choice(np.arange(len(probs)), p=probs)
-        # get the next action
-        exps.append((s, a, r, new_s))
-        if is_terminal_state(s):
-            print('reward', r)
-            #print('reached terminal state after {} steps'.format(iter_i))
-            break
-        else:
-            s = new_s
-            a = pi.choose_action(new_s)
-        iter_i += 1
-    #print('Monte Carlo On Policy episode ended at ', iter_i)
+                                gamma=0.99, num_episodes=700, rollout=None):
+    if rollout is None:
+        rollout = BatchRollout(transition_matrix)
+    initial_states = np.array([sample_initial_state() for _ in range(num_episodes)])
+    _, _, rewards, _, _ = rollout.run(pi, initial_states, reward_matrix, include_terminal=True,
+                                      max_iter=500)
+    G = rewards.dot(gamma ** np.arange(rewards.shape[1]))
+    return np.mean(G)
+
+def run_mc_actor(pi, sample_initial_state, transition_matrix, reward_matrix, max_local_iter=500,
+                 rollout=None):
+    '''
+    a single episode as a list of (s, a, r, new_s)
+    evaluate_policy_monte_carlo simulates episodes in batch instead
+    '''
+    if rollout is None:
+        rollout = BatchRollout(transition_matrix)
+    states, actions, rewards, new_states, mask = rollout.run(pi,
+                                                             np.array([sample_initial_state()]),
+                                                             reward_matrix,
+                                                             include_terminal=True,
+                                                             max_iter=max_local_iter)
+    steps = mask[0]
+    exps = list(zip(states[0, steps], actions[0, steps], rewards[0, steps], new_states[0, steps]))
     return exps
 
-@nb.jit
-def iterate_value(Q_table, transition_matrix, reward_table, gamma=0.95, theta=0.1, max_iter=100):
-    # TODO: fix this. does not work now
-    num_states = Q.shape[0]
-    v = np.zeros(num_states)
+def greedy_actions(Q, incumbent=None):
+    '''
+    deterministic argmax over actions: ties go to the incumbent action if it is
+    among the best, otherwise to the lowest action index
+    Q: (S, A), incumbent: (S,) current actions or None
+    '''
+    best = np.argmax(Q, axis=1)
+    if incumbent is not None:
+        rows = np.arange(Q.shape[0])
+        keep = Q[rows, incumbent] == Q[rows, best]
+        best[keep] = incumbent[keep]
+    return best
+
+def evaluate_policy(actions, transition_matrix, reward_matrix, gamma=0.99, theta=1e-6,
+                    v_init=None, max_sweeps=100000, exact=False, full_output=False):
+    '''
+    v_pi of the deterministic policy s -> actions[s] for state rewards r(s)
+    actions: (S,) or (S - 2,) action per state. terminal states are absorbing,
+             so any action can stand in for them (0 if left out)
+    exact: if True, solve (I - gamma P_pi) v = r directly with a sparse LU
+           otherwise run in-place sweeps (_evaluate_policy_kernel) until the
+           largest change is below theta
+    full_output: if True, return (v, num_sweeps). num_sweeps is 0 for the exact solve
+    '''
+    model = _as_transition_model(transition_matrix)
+    actions = _pad_actions(actions, model.num_states)
+    reward_matrix = np.asarray(reward_matrix, dtype=float)
+    if exact:
+        v, num_sweeps = _solve_policy_values(model, actions, reward_matrix, gamma), 0
+    else:
+        v = np.zeros(model.num_states) if v_init is None else np.array(v_init, dtype=float)
+        observed = model.observed
+        num_sweeps = _evaluate_policy_kernel(observed.indptr, observed.indices, observed.data, model.floor,
+                                             reward_matrix, actions, v, gamma, theta, max_sweeps,
+                                             model.num_actions)
+    if full_output:
+        return v, num_sweeps
+    return v
+
+def iterate_policy(transition_matrix, reward_matrix, gamma=0.99, theta=1e-2, num_eval_sweeps=20,
+                   v_init=None, max_iter=10000, full_output=False):
+    '''
+    modified policy iteration
+    every iteration improves the policy greedily (see greedy_actions) and then
+    evaluates it partially with at most num_eval_sweeps in-place sweeps, warm
+    started from the previous values. num_eval_sweeps=1 is value iteration,
+    a large num_eval_sweeps is classic policy iteration.
+    stops once the Bellman residual max_s |max_a Q(s, a) - v(s)| is below theta,
+    the same test Q_value_iteration uses
+    v_init: (S,) starting value vector. zeros if None
+    returns Q of shape (S - 2, A) like Q_value_iteration.
+    if full_output, returns (Q, v, num_sweeps) with num_sweeps counting the
+    improvement steps plus all evaluation sweeps
+    '''
+    model = _as_transition_model(transition_matrix)
+    observed = model.observed
+    reward_matrix = np.asarray(reward_matrix, dtype=float)
+    v = np.zeros(model.num_states) if v_init is None else np.array(v_init, dtype=float)
+    actions = None
+    num_sweeps = 0
     for n in range(max_iter):
-        v_temp = v
-        # s a  a
-        Q = transition_matrix.dot(np.expand_dims(reward_table, axis=1) + gamma * Q)
-        if np.abs(v_temp - v).max() < theta:
-            print('policy evaluated after {} steps'.format(n))
+        Q = np.expand_dims(reward_matrix, axis=1) + model.dot(gamma * v)
+        num_sweeps += 1
+        if np.max(np.abs(np.max(Q, axis=1) - v)) < theta:
             break
-    return v
+        actions = greedy_actions(Q, actions)
+        num_sweeps += _evaluate_policy_kernel(observed.indptr, observed.indices, observed.data, model.floor,
+                                              reward_matrix, actions, v, gamma, theta, num_eval_sweeps,
+                                              model.num_actions)
+    else:
+        logging.warning('policy iteration did not converge in {} iterations'.format(max_iter))
+    if full_output:
+        return Q[:-2, :], v, num_sweeps
+    return Q[:-2, :]
 
+def _as_transition_model(transition_matrix):
+    if isinstance(transition_matrix, SparseTransitionModel):
+        return transition_matrix
+    return SparseTransitionModel.from_dense(transition_matrix)
 
-@nb.jit
-def evaluate_policy(Q, transition_matrix, reward_table, gamma=0.99, theta=1e-1, max_iter=300):
-    num_states = Q.shape[0]
-    v = np.zeros(num_states)
-    for n in range(max_iter):
-        v_temp = v
-        v = np.zeros(num_states)
+def _pad_actions(actions, num_states):
+    padded = np.zeros(num_states, dtype=np.int64)
+    padded[:len(actions)] = actions
+    return padded
+
+def evaluate_policy_Q(action_probs, transition_matrix, reward_table, gamma=0.99):
+    '''
+    exact Q_pi and v_pi of a stochastic policy for state-action rewards r(s, a)
+    action_probs: (n, A) pi(a|s) of the first n states, the rest take action 0
+    reward_table: (S, A)
+    returns:
+        Q: (S, A) r(s, a) + gamma T(s, a, .) v, v: (S,) sum_a pi(a|s) Q(s, a)
+    '''
+    model = _as_transition_model(transition_matrix)
+    reward_table = np.asarray(reward_table, dtype=float)
+    probs = np.zeros((model.num_states, model.num_actions))
+    probs[:, 0] = 1.0
+    probs[:action_probs.shape[0]] = action_probs
+    v = _solve_stochastic_policy_values(model, probs, np.sum(probs * reward_table, axis=1), gamma)
+    Q = reward_table + model.dot(gamma * v)
+    return Q, v
+
+def _solve_policy_values(model, actions, reward_matrix, gamma):
+    num_states = model.num_states
+    action_probs = np.zeros((num_states, model.num_actions))
+    action_probs[np.arange(num_states), actions] = 1.0
+    return _solve_stochastic_policy_values(model, action_probs, reward_matrix, gamma)
+
+def _solve_stochastic_policy_values(model, action_probs, reward_matrix, gamma):
+    '''
+    P_pi = O + f 1^T with O sparse, so I - gamma P_pi = B - gamma f 1^T with B = I - gamma O.
+    one sparse LU of B plus a Sherman-Morrison correction for the floor
+    action_probs: (S, A)
+    '''
+    num_states = model.num_states
+    observed_pi, floor_pi = model.policy_transition(action_probs)
+    B = (sparse.identity(num_states, format='csc') - gamma * observed_pi).tocsc()
+    lu = splu(B)
+    x = lu.solve(reward_matrix)
+    y = lu.solve(-gamma * floor_pi)
+    return x - y * np.sum(x) / (1. + np.sum(y))
+
+@nb.njit(cache=True)
+def _evaluate_policy_kernel(indptr, indices, data, floor, reward, actions, v, gamma, theta, max_sweeps,
+                            num_actions):
+    '''
+    in-place sweeps of v_s = r_s + gamma T[s, actions[s], :] v, with the self
+    transition solved in closed form as in _backup
+    v is updated in place. returns the number of sweeps
+    '''
+    num_states = v.shape[0]
+    for sweep in range(max_sweeps):
+        v_sum = np.sum(v)
+        max_delta = 0.0
         for s in range(num_states):
-            # evaluate this policy's action choices
-            ties = np.flatnonzero(Q[s, :] == Q[s, :].max())
-            a = np.random.choice(ties)
-            r = reward_table[s]
-            v[s] = r + gamma * transition_matrix[s, a, :].dot(v_temp)
-        max_delta = np.linalg.norm(v_temp - v, np.inf)
+            row = s * num_actions + actions[s]
+            acc = floor[row] * v_sum
+            p_self = floor[row]
+            for k in range(indptr[row], indptr[row + 1]):
+                acc += data[k] * v[indices[k]]
+                if indices[k] == s:
+                    p_self += data[k]
+            new_v = (reward[s] + gamma * (acc - p_self * v[s])) / (1. - gamma * p_self)
+            delta = abs(new_v - v[s])
+            v_sum += new_v - v[s]
+            v[s] = new_v
+            if delta > max_delta:
+                max_delta = delta
         if max_delta < theta:
-            print('policy evaluated after {} steps'.format(n))
-            break
-    return v
+            return sweep + 1
+    return max_sweeps
 
-@nb.jit
-def iterate_policy(Q, transition_matrix, reward_matrix, gamma=0.99, theta=1e-2, strict_mode=False, max_iter=100):
-    reward_matrix = np.expand_dims(reward_matrix, axis=1)
-    for n in range(max_iter):
-        print('iterating policy at ', n)
-        old_best_a = np.argmax(Q, 1)
-        v_pi = evaluate_policy(Q, transition_matrix, reward_matrix, gamma, theta)
-        # assumes r = r(s) not r(s,a)
-        # r(s,a)
-        Q = reward_matrix + gamma * transition_matrix.dot(v_pi)
-        best_a = np.argmax(Q, 1)
-        if strict_mode:
-            if np.all(best_a == old_best_a):
-                print('policy stabilized at: ', n)
-                break
-        else:
-           match_proportion = np.sum(best_a == old_best_a)/best_a.shape[0]
-           if match_proportion > 0.99:
-               break
-            # the latter condition required to handle an edge case where there are ties
-    return Q
-
-def Q_value_iteration(transition_matrix, reward_matrix, theta=1e-2, gamma=0.99):
+def Q_value_iteration(transition_matrix, reward_matrix, theta=1e-2, gamma=0.99,
+                      v_init=None, full_output=False, method='jacobi'):
     '''
     a simplified version of Q value iteration
     reference: slide 9 of http://rll.berkeley.edu/deeprlcourse/f17docs/lecture_6_value_functions.pdf
+    v_init: (S,) starting value vector, e.g. V* of a nearby reward. zeros if None
+    full_output: if True, return (Q, v, num_sweeps) so v can warm start the next call
+    method: one of VI_METHODS
+        'jacobi': every sweep backs up all states from the previous V
+        'gauss_seidel': in-place sweeps, see _gauss_seidel_kernel
+        'prioritized': prioritized sweeping on Bellman residuals, see _prioritized_sweeping_kernel.
+                       fewest backups, but each one re-scores every predecessor, so it pays
+                       off only when states have few observed predecessors
+        'policy_iteration': modified policy iteration, see iterate_policy
+        'lp': exact linear program, see solve_mdp. ignores theta and v_init, reports 0 sweeps
+    '''
+    if method == 'jacobi':
+        if v_init is not None:
+            v_init = np.expand_dims(v_init, axis=0)
+        Q, v, num_sweeps = Q_value_iteration_batch(transition_matrix,
+                                                   np.expand_dims(reward_matrix, axis=0),
+                                                   theta, gamma, v_init=v_init, full_output=True)
+        Q, v, num_sweeps = Q[0], v[0], num_sweeps[0]
+    elif method == 'lp':
+        Q, v = solve_mdp(transition_matrix, reward_matrix, gamma)
+        num_sweeps = 0
+    elif method == 'policy_iteration':
+        Q, v, num_sweeps = iterate_policy(transition_matrix, reward_matrix, gamma, theta,
+                                          v_init=v_init, full_output=True)
+    elif method in VI_METHODS:
+        Q, v, num_sweeps = _Q_value_iteration_in_place(transition_matrix, reward_matrix, theta, gamma,
+                                                       v_init, method)
+    else:
+        raise Exception('unsupported value iteration method: {}'.format(method))
+    if full_output:
+        return Q, v, num_sweeps
+    return Q
+
+def Q_value_iteration_batch(transition_matrix, reward_matrices, theta=1e-2, gamma=0.99,
+                            v_init=None, full_output=False):
+    '''
+    Q_value_iteration for a (K, S) stack of state rewards sharing one transition matrix
+    every sweep is one (S*A, S) x (S, K) product over the columns still running,
+    and each column stops on its own convergence test
+    v_init: (K, S) starting value vectors. zeros if None
+    returns:
+        (K, S - 2, A) stack of Q tables
+        if full_output, also the (K, S) value vectors and the (K,) sweep counts
     '''
     num_states = transition_matrix.shape[0]
     num_actions = transition_matrix.shape[1]
-    reward_matrix = np.expand_dims(reward_matrix, axis=1)
-    v_old = np.zeros((num_states))
+    reward_matrices = np.atleast_2d(reward_matrices)
+    num_rewards = reward_matrices.shape[0]
+    # (S, 1, K) so rewards broadcast over actions
+    rewards = np.expand_dims(reward_matrices.T, axis=1)
+    if v_init is None:
+        v_old = np.zeros((num_states, num_rewards))
+    else:
+        v_old = np.array(np.atleast_2d(v_init).T, dtype=float)
+    Q = np.zeros((num_states, num_actions, num_rewards))
+    num_sweeps = np.zeros(num_rewards, dtype=int)
+    active = np.arange(num_rewards)
     for t in itertools.count():
-        Q = reward_matrix + transition_matrix.dot(gamma * v_old)
-        v = np.max(Q, axis=1)
-        #v[TERMINAL_STATE_ALIVE] = 0
-        #v[TERMINAL_STATE_DEAD] = 0
-        #Q[TERMINAL_STATE_ALIVE, :] = 0
-        #Q[TERMINAL_STATE_DEAD, :] = 0
-        max_delta= np.linalg.norm(v_old - v, np.inf)
-        if max_delta < theta:
-            #print('value converged after {} steps'.format(t))
+        if active.shape[0] == 0:
             break
+        Q_active = rewards[:, :, active] + _transition_dot(transition_matrix, gamma * v_old[:, active])
+        v = np.max(Q_active, axis=1)
+        max_delta = np.max(np.abs(v_old[:, active] - v), axis=0)
+        converged = max_delta < theta
+        Q[:, :, active[converged]] = Q_active[:, :, converged]
+        num_sweeps[active[converged]] = t + 1
+        v_old[:, active] = v
+        active = active[~converged]
+    Q = np.transpose(Q, (2, 0, 1))[:, :-2, :]
+    if full_output:
+        return Q, v_old.T, num_sweeps
+    return Q
+
+def _transition_dot(transition_matrix, v):
+    '''
+    T . v for v of shape (S, K) -> (S, A, K)
+    '''
+    if isinstance(transition_matrix, np.ndarray):
+        num_states, num_actions, _ = transition_matrix.shape
+        T = transition_matrix.reshape((num_states * num_actions, num_states))
+        return T.dot(v).reshape((num_states, num_actions, v.shape[1]))
+    return transition_matrix.dot(v)
+
+VI_METHODS = ['jacobi', 'gauss_seidel', 'prioritized', 'policy_iteration', 'lp']
+
+def soft_value_iteration(transition_matrix, reward_matrix, theta=1e-3, gamma=0.99,
+                         v_init=None, full_output=False, max_sweeps=100000):
+    '''
+    maximum entropy counterpart of Q_value_iteration (Ziebart 2008)
+        Q(s, a) = r(s) + gamma T(s, a, :) V
+        V(s) = log sum_a exp Q(s, a)
+    the softmax of Q is the max-ent policy for r. the two terminal states take
+    the max instead: all their actions are the same, and log sum exp would
+    credit them log(num_actions) per step
+    v_init: (S,) starting value vector, e.g. V of a nearby reward. zeros if None
+    returns:
+        (S - 2, A) soft Q table
+        if full_output, also the (S,) value vector and the number of sweeps
+    '''
+    reward_matrix = np.asarray(reward_matrix, dtype=float)
+    if v_init is None:
+        v_old = np.zeros(reward_matrix.shape[0])
+    else:
+        v_old = np.array(v_init, dtype=float)
+    num_sweeps = max_sweeps
+    for t in range(max_sweeps):
+        Q = np.expand_dims(reward_matrix, axis=1) + \
+                _transition_dot(transition_matrix, gamma * v_old[:, np.newaxis])[:, :, 0]
+        Q_max = np.max(Q, axis=1)
+        v = Q_max.copy()
+        v[:-2] += np.log(np.sum(np.exp(Q[:-2] - Q_max[:-2, np.newaxis]), axis=1))
+        max_delta = np.max(np.abs(v - v_old))
         v_old = v
+        if max_delta < theta:
+            num_sweeps = t + 1
+            break
+    if full_output:
+        return Q[:-2, :], v_old, num_sweeps
     return Q[:-2, :]
 
-def solve_mdp(transition_matrix, reward_matrix, gamma=1.0):
+def _Q_value_iteration_in_place(transition_matrix, reward_matrix, theta, gamma, v_init, method):
     '''
-    solve bellman equation by inverting matrix
-    essentially finding a fixed point in one-step
-    this approach does not work very well, though computationally fast
-    hard to pin down why but it feels wrong right?
+    runs the numba backends on the (observed CSR, uniform floor) form of the transition matrix.
+    pass a SparseTransitionModel to skip the conversion of a dense tensor
     '''
-    #reward_matrix = [0 for i in range(81)]
-    #reward_matrix[50] = 50
-    num_states = transition_matrix.shape[0]
-    num_actions = transition_matrix.shape[1]
-    # to make transition_matrix compatible with reward function
-    # we squash action dimension so T = s x s'
-    transition_matrix_ss = np.sum(transition_matrix, axis=1)
-    # solve bellman equation
-    # A v = b
-    A = np.identity(num_states) - gamma*transition_matrix_ss
-    #A = (np.identity(transition_matrix_ss.shape[0]) - gamma*transition_matrix_ss)
-    b = np.dot(transition_matrix_ss, reward_matrix)
-    v_star = np.linalg.solve(A, b)
-    # recover pi_star
-    Q = compute_Q_from_v_star(v_star, transition_matrix, reward_matrix, gamma)
-    pi = GreedyPolicy(num_states, num_actions, Q)
-    #pi = EpsilonGreedyPolicy(num_states, num_actions, Q, epsilon=0.01)
-    return pi
+    model = _as_transition_model(transition_matrix)
+    num_states, num_actions = model.num_states, model.num_actions
+    observed = model.observed
+    reward_matrix = np.asarray(reward_matrix, dtype=float)
+    if v_init is None:
+        v = np.zeros(num_states)
+    else:
+        v = np.array(v_init, dtype=float)
+    max_sweeps = 100000
+    if method == 'gauss_seidel':
+        num_sweeps = _gauss_seidel_kernel(observed.indptr, observed.indices, observed.data, model.floor,
+                                          reward_matrix, v, gamma, theta, max_sweeps, num_actions)
+    else:
+        predecessors = _make_predecessors(model)
+        num_backups = _prioritized_sweeping_kernel(observed.indptr, observed.indices, observed.data,
+                                                   model.floor, reward_matrix, v, gamma, theta,
+                                                   max_sweeps * num_states, num_actions,
+                                                   predecessors.indptr, predecessors.indices)
+        # report work in full-sweep equivalents
+        num_sweeps = int(np.ceil(num_backups / float(num_states)))
+    Q = np.expand_dims(reward_matrix, axis=1) + model.dot(gamma * v)
+    return Q[:-2, :], v, num_sweeps
+
+def _make_predecessors(model):
+    '''
+    CSR matrix whose row s' lists the states s with observed mass on s -> s'
+    the uniform floor links every pair of states and is left out on purpose
+    '''
+    observed = model.observed.tocoo()
+    adjacency = sparse.csr_matrix((np.ones(observed.nnz), (observed.row // model.num_actions, observed.col)),
+                                  shape=(model.num_states, model.num_states))
+    predecessors = adjacency.T.tocsr()
+    predecessors.sum_duplicates()
+    return predecessors
+
+@nb.njit(cache=True)
+def _backup(s, indptr, indices, data, floor, reward, v, v_sum, gamma, num_actions):
+    '''
+    max_a backup of state s, with the self transition solved in closed form:
+        v_s = max_a (r_s + gamma sum_{s' != s} p_a(s') v_s') / (1 - gamma p_a(s))
+    (the fixed point in v_s with every other state held still). without it
+    absorbing states converge only at rate gamma no matter how states are ordered
+    '''
+    best = -np.inf
+    for a in range(num_actions):
+        row = s * num_actions + a
+        acc = floor[row] * v_sum
+        p_self = floor[row]
+        for k in range(indptr[row], indptr[row + 1]):
+            acc += data[k] * v[indices[k]]
+            if indices[k] == s:
+                p_self += data[k]
+        q = (reward[s] + gamma * (acc - p_self * v[s])) / (1. - gamma * p_self)
+        if q > best:
+            best = q
+    return best
+
+@nb.njit(cache=True)
+def _gauss_seidel_kernel(indptr, indices, data, floor, reward, v, gamma, theta, max_sweeps, num_actions):
+    '''
+    in-place sweeps: a state's backup already sees the values updated earlier in the sweep
+    v is updated in place. returns the number of sweeps
+    '''
+    num_states = v.shape[0]
+    for sweep in range(max_sweeps):
+        v_sum = np.sum(v)
+        max_delta = 0.0
+        for s in range(num_states):
+            new_v = _backup(s, indptr, indices, data, floor, reward, v, v_sum, gamma, num_actions)
+            delta = abs(new_v - v[s])
+            v_sum += new_v - v[s]
+            v[s] = new_v
+            if delta > max_delta:
+                max_delta = delta
+        if max_delta < theta:
+            return sweep + 1
+    return max_sweeps
+
+@nb.njit(cache=True)
+def _prioritized_sweeping_kernel(indptr, indices, data, floor, reward, v, gamma, theta, max_backups,
+                                 num_actions, pred_indptr, pred_indices):
+    '''
+    always backs up the state with the largest Bellman residual (max-heap with lazy deletion)
+    and then refreshes the residuals of its predecessors only.
+    the floor couples every pair of states a little, so once the heap drains
+    a full residual pass checks convergence and reseeds the heap if needed
+    v is updated in place. returns the number of state backups
+    '''
+    num_states = v.shape[0]
+    priority = np.zeros(num_states)
+    num_backups = 0
+    while num_backups < max_backups:
+        # full residual pass
+        v_sum = np.sum(v)
+        heap = [(0.0, -1)]
+        max_residual = 0.0
+        for s in range(num_states):
+            priority[s] = abs(_backup(s, indptr, indices, data, floor, reward, v, v_sum, gamma, num_actions) - v[s])
+            if priority[s] >= theta:
+                heapq.heappush(heap, (-priority[s], s))
+            if priority[s] > max_residual:
+                max_residual = priority[s]
+        if max_residual < theta:
+            break
+        while len(heap) > 0 and num_backups < max_backups:
+            neg_p, s = heapq.heappop(heap)
+            if s < 0 or -neg_p != priority[s]:
+                # sentinel or stale entry
+                continue
+            new_v = _backup(s, indptr, indices, data, floor, reward, v, v_sum, gamma, num_actions)
+            v_sum += new_v - v[s]
+            v[s] = new_v
+            priority[s] = 0.0
+            num_backups += 1
+            for k in range(pred_indptr[s], pred_indptr[s + 1]):
+                p = np.int64(pred_indices[k])
+                residual = abs(_backup(p, indptr, indices, data, floor, reward, v, v_sum, gamma, num_actions) - v[p])
+                if residual != priority[p]:
+                    priority[p] = residual
+                    if residual >= theta:
+                        heapq.heappush(heap, (-residual, p))
+    return num_backups
+
+def solve_mdp(transition_matrix, reward_matrix, gamma=0.99, full_output=False):
+    '''
+    exact V* and Q* from the linear program of the Bellman optimality equations
+        min sum_s v_s  s.t.  v_s >= r_s + gamma sum_s' T[s, a, s'] v_s'  for all (s, a)
+    solved with scipy's HiGHS backend. with T = O + f 1^T the floor term is
+    gamma f_sa * w for one extra variable w = sum_s v_s, so the constraint matrix
+    keeps the sparsity of O instead of becoming dense (S * A, S).
+    the LP solution is then polished by an exact evaluation of its greedy policy
+    returns (Q, v) with Q of shape (S - 2, A) like Q_value_iteration and v of shape (S,)
+    if full_output, also returns scipy's OptimizeResult
+    '''
+    model = _as_transition_model(transition_matrix)
+    num_states, num_actions = model.num_states, model.num_actions
+    reward_matrix = np.asarray(reward_matrix, dtype=float)
+    num_rows = num_states * num_actions
+    sa = np.arange(num_rows)
+    # gamma O v + gamma f w - v_s <= -r_s
+    A_ub = sparse.hstack([gamma * model.observed - sparse.csr_matrix((np.ones(num_rows), (sa, sa // num_actions)),
+                                                                     shape=(num_rows, num_states)),
+                          sparse.csr_matrix(gamma * model.floor[:, np.newaxis])]).tocsr()
+    b_ub = -np.repeat(reward_matrix, num_actions)
+    # sum_s v_s - w = 0
+    A_eq = sparse.csr_matrix(np.append(np.ones(num_states), -1.0)[np.newaxis, :])
+    c = np.append(np.ones(num_states), 0.0)
+    res = linprog(c, A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=[0.0], bounds=(None, None), method='highs')
+    if not res.success:
+        raise Exception('linear program failed: {}'.format(res.message))
+    v = res.x[:num_states]
+    Q = np.expand_dims(reward_matrix, axis=1) + model.dot(gamma * v)
+    # the LP is only solved to HiGHS' feasibility tolerance. the greedy policy
+    # is optimal, so solving for its values directly recovers v* to machine precision
+    v_pi = _solve_policy_values(model, greedy_actions(Q), reward_matrix, gamma)
+    if np.all(v_pi >= v - 1e-6 * (1. + np.abs(v))):
+        v = v_pi
+        Q = np.expand_dims(reward_matrix, axis=1) + model.dot(gamma * v)
+    if full_output:
+        return Q[:-2, :], v, res
+    return Q[:-2, :], v
@@ -0,0 +1,195 @@
+import numpy as np
+from scipy import sparse
+
+
+class SparseTransitionModel():
+    '''
+    sparse stand-in for the dense (S, A, S) transition tensor
+
+    every row of the tensor is kept as
+        T[s, a, :] = observed[s * A + a, :] + floor[s * A + a]
+    observed: CSR matrix of shape (S * A, S) with the empirical (s, a) -> s' mass
+    floor: implicit uniform smoothing term given to every next state
+
+    the model duck-types the parts of np.ndarray the solvers rely on
+    (shape, dot, [s, a, :] indexing, sum) so it can be passed wherever
+    a dense transition_matrix is expected
+    '''
+    def __init__(self, observed, floor, num_states, num_actions):
+        self.num_states = num_states
+        self.num_actions = num_actions
+        self.observed = sparse.csr_matrix(observed, dtype=float)
+        self.floor = np.asarray(floor, dtype=float)
+        assert self.observed.shape == (num_states * num_actions, num_states)
+        assert self.floor.shape == (num_states * num_actions,)
+        self._cdf = None
+
+    @classmethod
+    def from_counts(cls, counts, num_states, num_actions, eps=1e-2,
+                    terminal_states=(), uniform_unvisited=True):
+        '''
+        counts: (S * A, S) matrix of (s, a) -> s' visit counts
+        mirrors mdp.builder._make_mdp:
+            visited (s, a): eps/S + (1 - eps)*N_sas/N_sa
+            unvisited (s, a): 1/S if uniform_unvisited else 0
+            terminal states: absorbing
+        '''
+        counts = sparse.csr_matrix(counts, dtype=float)
+        counts.sum_duplicates()
+        num_sa = np.asarray(counts.sum(axis=1)).ravel()
+        visited_sa = num_sa > 0
+        # same order of operations as the dense builder so toarray() matches it exactly
+        row_idx = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+        counts.data = (1 - eps) * counts.data / num_sa[row_idx]
+        floor = np.zeros(num_states * num_actions)
+        floor[visited_sa] = eps / num_states
+        if uniform_unvisited:
+            floor[~visited_sa] = 1.0 / num_states
+
+        if len(terminal_states) > 0:
+            # if terminal states, must be absorbing
+            terminal_rows = np.asarray([s * num_actions + a for s in terminal_states
+                                                              for a in range(num_actions)])
+            keep = np.ones(counts.shape[0])
+            keep[terminal_rows] = 0.0
+            counts = sparse.diags(keep).dot(counts).tocsr()
+            counts.eliminate_zeros()
+            absorbing = sparse.csr_matrix((np.ones(len(terminal_rows)),
+                                           (terminal_rows, terminal_rows // num_actions)),
+                                          shape=counts.shape)
+            counts = counts + absorbing
+            floor[terminal_rows] = 0.0
+        return cls(counts, floor, num_states, num_actions)
+
+    @classmethod
+    def from_dense(cls, transition_matrix):
+        '''
+        split a dense tensor into its per-row minimum (floor) and the sparse mass above it
+        '''
+        num_states, num_actions, _ = transition_matrix.shape
+        T = transition_matrix.reshape((num_states * num_actions, num_states))
+        floor = T.min(axis=1)
+        observed = sparse.csr_matrix(T - floor[:, np.newaxis])
+        return cls(observed, floor, num_states, num_actions)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            num_states, num_actions = f['shape']
+            observed = sparse.csr_matrix((f['data'], f['indices'], f['indptr']),
+                                         shape=(num_states * num_actions, num_states))
+            return cls(observed, f['floor'], int(num_states), int(num_actions))
+
+    def save(self, path):
+        np.savez(path,
+                 data=self.observed.data,
+                 indices=self.observed.indices,
+                 indptr=self.observed.indptr,
+                 floor=self.floor,
+                 shape=np.array([self.num_states, self.num_actions]))
+
+    @property
+    def shape(self):
+        return (self.num_states, self.num_actions, self.num_states)
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def nbytes(self):
+        return self.observed.data.nbytes + self.observed.indices.nbytes + \
+                self.observed.indptr.nbytes + self.floor.nbytes
+
+    def dot(self, v):
+        '''
+        same semantics as np.ndarray.dot on the dense tensor
+        v: (S,) -> (S, A) or (S, K) -> (S, A, K)
+        '''
+        v = np.asarray(v)
+        res = self.observed.dot(v)
+        v_sum = np.sum(v, axis=0)
+        if v.ndim == 1:
+            res = res + self.floor * v_sum
+            return res.reshape((self.num_states, self.num_actions))
+        res = res + np.outer(self.floor, v_sum)
+        return res.reshape((self.num_states, self.num_actions, v.shape[1]))
+
+    def policy_transition(self, action_probs):
+        '''
+        chain induced by a policy over its first n states
+        action_probs: (n, A) pi(a|s)
+        returns:
+            observed_pi: (n, S) CSR with sum_a pi(a|s) observed[s, a, :]
+            floor_pi: (n,) uniform term, P_pi[s, :] = observed_pi[s, :] + floor_pi[s]
+        '''
+        num_rows = action_probs.shape[0]
+        sa = np.arange(num_rows * self.num_actions)
+        weights = sparse.csr_matrix((np.ravel(action_probs), (sa // self.num_actions, sa)),
+                                    shape=(num_rows, self.num_states * self.num_actions))
+        observed_pi = weights.dot(self.observed).tocsr()
+        floor_pi = np.sum(action_probs * self.floor[:num_rows * self.num_actions].reshape(action_probs.shape),
+                          axis=1)
+        return observed_pi, floor_pi
+
+    def row(self, s, a):
+        i = s * self.num_actions + a
+        start, end = self.observed.indptr[i], self.observed.indptr[i + 1]
+        probs = np.full(self.num_states, self.floor[i])
+        probs[self.observed.indices[start:end]] += self.observed.data[start:end]
+        return probs
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) >= 2 and np.isscalar(key[0]) and np.isscalar(key[1]):
+            return self.row(key[0], key[1])[key[2:]]
+        # fall back to a dense copy. expensive, avoid in hot loops
+        return self.toarray()[key]
+
+    def sum(self, axis=None, out=None):
+        if axis is None:
+            return self.observed.sum() + np.sum(self.floor) * self.num_states
+        return np.sum(self.toarray(), axis=axis)
+
+    def toarray(self):
+        T = self.observed.toarray() + self.floor[:, np.newaxis]
+        return T.reshape(self.shape)
+
+    def _build_cdf(self):
+        # cumulative observed mass laid out along the CSR data array
+        # so rows can be searched without densifying them
+        cum = np.cumsum(self.observed.data)
+        row_start = np.concatenate([[0.0], cum])[self.observed.indptr[:-1]]
+        row_mass = np.asarray(self.observed.sum(axis=1)).ravel()
+        self._cdf = (cum, row_start, row_mass)
+
+    def sample_next_states(self, states, actions, rng=np.random):
+        '''
+        vectorized draw of s' ~ T[s, a, :] for arrays of states and actions
+        '''
+        if self._cdf is None:
+            self._build_cdf()
+        cum, row_start, row_mass = self._cdf
+        states = np.asarray(states)
+        rows = states * self.num_actions + np.asarray(actions)
+        total_mass = row_mass[rows] + self.floor[rows] * self.num_states
+        u = rng.random(rows.shape) * total_mass
+        # smoothing floor first: u falls into the uniform part with prob floor*S / total
+        floor_mass = self.floor[rows] * self.num_states
+        is_uniform = u < floor_mass
+        new_states = np.empty(rows.shape, dtype=np.int64)
+        if np.any(is_uniform):
+            uniform_u = u[is_uniform] / floor_mass[is_uniform]
+            new_states[is_uniform] = np.minimum((uniform_u * self.num_states).astype(np.int64),
+                                                self.num_states - 1)
+        observed_rows = rows[~is_uniform]
+        if observed_rows.shape[0] > 0:
+            target = row_start[observed_rows] + (u[~is_uniform] - floor_mass[~is_uniform])
+            k = np.searchsorted(cum, target, side='right')
+            k = np.clip(k, self.observed.indptr[observed_rows], self.observed.indptr[observed_rows + 1] - 1)
+            new_states[~is_uniform] = self.observed.indices[k]
+        return new_states
+
+    def sample_next_state(self, s, a, rng=np.random):
+        return int(self.sample_next_states(np.array([s]), np.array([a]), rng)[0])
@@ -1,39 +1,105 @@
 import numpy as np
-from sklearn.svm import LinearSVC, SVC
+
+# svm: max margin QP of Abbeel & Ng (2004), as a warm-started squared hinge svm
+# projection: the closed-form projection method of the same paper, O(d) per iteration
+OPT_METHODS = ['svm', 'projection']
 
 
 class QuadOpt():
-    def __init__(self, epsilon=0.01, penalty=1.0, hyperplane_margin=False):
-        self.mus = []
+    def __init__(self, epsilon=0.01, penalty=1.0, hyperplane_margin=False,
+                 method='svm', tol=1e-10, max_iter=100):
+        '''
+        method: one of OPT_METHODS
+        tol, max_iter: stopping rule of the newton solver
+
+        the mu history lives in a preallocated array that doubles when full.
+        the svm starts from the previous W. its dual variables are 2 C times the
+        margin violations of W, so W carries them over and a new mu only changes
+        the solution where it violates the margin
+        '''
+        if method not in OPT_METHODS:
+            raise Exception('unknown optimization method {}'.format(method))
         self.epsilon = epsilon
         self.penalty = penalty
         self.hyperplane_margin = hyperplane_margin
+        self.method = method
+        self.tol = tol
+        self.max_iter = max_iter
+        self.num_mus = 0
+        # row 0: target mu, rows 1..num_mus: mus. the last column is the constant
+        # intercept feature, regularized like the weights as in liblinear
+        self._data = None
+        self._labels = None
+        # weights of the augmented features [mu, 1], i.e. W and the intercept
+        self._w = None
+        # projection method: projection of the target onto the mus seen so far
+        self._mu_bar = None
+
+    @property
+    def mus(self):
+        if self._data is None:
+            return np.zeros((0, 0))
+        return self._data[1:self.num_mus + 1, :-1]
+
+    def get_state(self):
+        '''
+        everything optimize() depends on besides its arguments, for checkpoints
+        '''
+        return {'mus': np.copy(self.mus),
+                'w': None if self._w is None else np.copy(self._w),
+                'mu_bar': None if self._mu_bar is None else np.copy(self._mu_bar)}
 
-    def transform_data(self, target_mu, cur_mu):
-        X = np.array(self.mus + [target_mu])
-        y = np.empty(len(X))
-        y.fill(-1)
-        # target mu is labeled +1
-        y[-1] = 1
-        return X, y
+    def set_state(self, state):
+        self._data = None
+        self.num_mus = 0
+        for mu in state['mus']:
+            self._append(mu)
+        self._w = None if state['w'] is None else np.copy(state['w'])
+        self._mu_bar = None if state['mu_bar'] is None else np.copy(state['mu_bar'])
+
+    def _append(self, mu):
+        mu = np.asarray(mu, dtype=float)
+        if self._data is None:
+            self._data = np.ones((16, mu.shape[0] + 1))
+            self._labels = np.full(16, -1.0)
+            # target mu is labeled +1
+            self._labels[0] = 1
+        elif self.num_mus + 1 == self._data.shape[0]:
+            self._data = np.concatenate([self._data, np.ones_like(self._data)])
+            self._labels = np.concatenate([self._labels, np.full(self._labels.shape[0], -1.0)])
+        self.num_mus += 1
+        self._data[self.num_mus, :-1] = mu
+
+    def transform_data(self, target_mu):
+        '''
+        views of the svm inputs, target first and with the intercept column
+        '''
+        self._data[0, :-1] = target_mu
+        return self._data[:self.num_mus + 1], self._labels[:self.num_mus + 1]
 
     def optimize(self, target_mu, cur_mu, normalize=True):
-        self.mus.append(cur_mu)
-        X,y = self.transform_data(target_mu, cur_mu)
-        clf = LinearSVC(C=self.penalty)
-        #clf = SVC(kernel='linear', C=self.penalty)
-        clf.fit(X,y)
+        target_mu = np.asarray(target_mu, dtype=float)
+        self._append(cur_mu)
+        if self.method == 'projection':
+            return self._project(target_mu, normalize)
+
+        if self._w is None:
+            self._w = np.zeros(target_mu.shape[0] + 1)
+        X, y = self.transform_data(target_mu)
+        self._w = _fit_squared_hinge_svm(X, y, self._w, self.penalty, self.tol, self.max_iter)
         # since decision hyperplane is W^T mu = 0
         # coefficients is a normal vector to hyperplane
-        W = clf.coef_[0]
+        W = self._w[:-1]
         norm = np.linalg.norm(W, 2)
         # TODO: I think this is wrong
         # margin = 1 / weight_norm
         if normalize:
             W = W / norm
+        else:
+            W = np.copy(W)
         # taken from Abbeel (2004)
         # dist from a support vector to mu_expert
-        diffs = target_mu - np.array(self.mus)
+        diffs = target_mu - self.mus
         # TODO: check if abs can be applied
         # otherwise margin can be negative
         if self.hyperplane_margin:
@@ -43,3 +109,59 @@ class QuadOpt():
         converged = (margin < self.epsilon)
         return W, converged, margin
 
+    def _project(self, target_mu, normalize):
+        '''
+        projection method of Abbeel & Ng (2004)
+        mu_bar moves to the point closest to the target on the line to the newest mu,
+        W = target_mu - mu_bar and the margin is |W|
+        '''
+        mu = self.mus[-1]
+        if self._mu_bar is None:
+            self._mu_bar = np.copy(mu)
+        else:
+            step = mu - self._mu_bar
+            step_sq = step.dot(step)
+            if step_sq > 0:
+                self._mu_bar += step * (step.dot(target_mu - self._mu_bar) / step_sq)
+        W = target_mu - self._mu_bar
+        margin = np.linalg.norm(W, 2)
+        if normalize and margin > 0:
+            W = W / margin
+        converged = (margin < self.epsilon)
+        return W, converged, margin
+
+
+def _fit_squared_hinge_svm(X, y, w, C, tol, max_iter):
+    '''
+    finite newton method (Keerthi & DeCoste 2005) for the squared hinge loss svm
+        min_w |w|^2 / 2 + C sum_i max(0, 1 - y_i w.x_i)^2
+    which is LinearSVC's problem when X carries its intercept column.
+    starts from w. every step solves the least squares problem of the current
+    margin violators, so a warm start whose violators do not change stops after one step
+    '''
+    def objective(w):
+        slack = np.maximum(1.0 - y * X.dot(w), 0.0)
+        return 0.5 * w.dot(w) + C * slack.dot(slack)
+
+    eye = np.eye(X.shape[1])
+    f = objective(w)
+    active = y * X.dot(w) < 1.0
+    for _ in range(max_iter):
+        X_active = X[active]
+        H = eye + 2.0 * C * X_active.T.dot(X_active)
+        step = np.linalg.solve(H, 2.0 * C * X_active.T.dot(y[active])) - w
+        # backtrack until the objective does not increase, the step is a descent direction
+        t = 1.0
+        f_new = objective(w + step)
+        while f_new > f and t > 1e-10:
+            t *= 0.5
+            f_new = objective(w + t * step)
+        if f_new > f:
+            # no step length decreases the objective, keep w
+            break
+        w = w + t * step
+        new_active = y * X.dot(w) < 1.0
+        if (t == 1.0 and np.array_equal(new_active, active)) or f - f_new <= tol * max(f_new, 1.0):
+            break
+        f, active = f_new, new_active
+    return w
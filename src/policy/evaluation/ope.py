@@ -0,0 +1,274 @@
+import numpy as np
+from scipy import sparse
+from mdp.transition_model import SparseTransitionModel
+from mdp.solver import evaluate_policy_Q
+
+ESTIMATORS = ['is', 'wis', 'pdis', 'wpdis', 'dr', 'wdr']
+
+
+class Trajectories():
+    '''
+    N episodes padded to the longest one, T steps. every array is (N, T)
+    and steps past the end of an episode are masked out (mask False, zeros elsewhere)
+    behavior_probs: pi_b(a_t|s_t) of the logged actions, 1 on padding
+    '''
+    def __init__(self, states, actions, rewards, new_states, mask, behavior_probs):
+        self.states = states
+        self.actions = actions
+        self.rewards = rewards
+        self.new_states = new_states
+        self.mask = mask
+        self.behavior_probs = behavior_probs
+
+    @property
+    def num_episodes(self):
+        return self.mask.shape[0]
+
+    @property
+    def lengths(self):
+        return np.sum(self.mask, axis=1)
+
+    def head(self, n):
+        '''
+        the first n episodes, still padded to T
+        '''
+        return Trajectories(self.states[:n], self.actions[:n], self.rewards[:n],
+                            self.new_states[:n], self.mask[:n], self.behavior_probs[:n])
+
+    def steps(self, episodes=slice(None)):
+        '''
+        (n, 4) s, a, r, new_s rows of the given episodes, the layout of make_approximate_model_builder
+        '''
+        mask = self.mask[episodes]
+        return np.stack([self.states[episodes][mask], self.actions[episodes][mask],
+                         self.rewards[episodes][mask], self.new_states[episodes][mask]], axis=1)
+
+    @classmethod
+    def from_steps(cls, episode_ids, s, a, r, new_s, behavior_policy):
+        '''
+        one row per step. rows of an episode must be in time order, the episodes
+        themselves can be interleaved. N, T come from a stable sort, no python loop
+        behavior_policy: (S, A) table or policy (see action_prob_table) shared by all episodes,
+                         or (n,) pi_b(a|s) of every row
+        '''
+        episode_ids = np.asarray(episode_ids)
+        order = np.argsort(episode_ids, kind='stable')
+        _, episode, lengths = np.unique(episode_ids[order], return_inverse=True, return_counts=True)
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        t = np.arange(len(order)) - starts[episode]
+        shape = (len(lengths), np.max(lengths, initial=0))
+
+        def pad(values, fill, dtype):
+            padded = np.full(shape, fill, dtype=dtype)
+            padded[episode, t] = np.asarray(values)[order]
+            return padded
+
+        states = pad(s, 0, np.int64)
+        actions = pad(a, 0, np.int64)
+        mask = pad(np.ones(len(order), dtype=bool), False, bool)
+        if np.ndim(behavior_policy) == 1:
+            behavior_probs = pad(behavior_policy, 1.0, float)
+        else:
+            behavior_probs = gather_probs(action_prob_table(behavior_policy), states, actions, mask)
+        return cls(states, actions, pad(r, 0.0, float), pad(new_s, 0, np.int64), mask, behavior_probs)
+
+    @classmethod
+    def from_trajectory_array(cls, trajectories, behavior_policy):
+        '''
+        trajectories: (n, 5) icustayid, s, a, r, new_s rows of utils.extract_trajectories,
+                      rows of a stay in time order (df sorted by icustayid, bloc)
+        '''
+        return cls.from_steps(trajectories[:, 0], trajectories[:, 1], trajectories[:, 2],
+                              trajectories[:, 3], trajectories[:, 4], behavior_policy)
+
+    @classmethod
+    def from_episodes(cls, D):
+        '''
+        D: list of (H_i, pi_behavior_i), H_i a list of (s, a, r, new_s) and
+           pi_behavior_i the (S, A) behavior table of the episode, as in the eval_* functions
+        '''
+        if len(D) == 0:
+            empty = np.zeros((0, 0), dtype=np.int64)
+            return cls(empty, empty, empty.astype(float), empty, empty.astype(bool), np.ones((0, 0)))
+        lengths = np.array([len(H_i) for H_i, _ in D], dtype=np.int64)
+        steps = np.concatenate([np.asarray(H_i, dtype=float).reshape((-1, 4)) for H_i, _ in D])
+        s, a = steps[:, 0].astype(np.int64), steps[:, 1].astype(np.int64)
+        episode_ids = np.repeat(np.arange(len(D)), lengths)
+        # behavior tables are often one object shared by every episode, gather each distinct one once
+        behavior_probs = np.empty(len(steps))
+        tables = {}
+        for i, (_, pi_behavior_i) in enumerate(D):
+            tables.setdefault(id(pi_behavior_i), (pi_behavior_i, []))[1].append(i)
+        for pi_behavior, episodes in tables.values():
+            rows = np.isin(episode_ids, episodes)
+            behavior_probs[rows] = np.asarray(pi_behavior)[s[rows], a[rows]]
+        return cls.from_steps(episode_ids, s, a, steps[:, 2], steps[:, 3].astype(np.int64), behavior_probs)
+
+
+def action_prob_table(pi):
+    '''
+    (S, A) pi(a|s) of a policy.policy policy (cached get_action_probs) or of an array
+    '''
+    if hasattr(pi, 'get_action_probs'):
+        return pi.get_action_probs()
+    return np.asarray(pi, dtype=float)
+
+def gather_probs(table, states, actions, mask):
+    '''
+    table[states, actions] for all (N, T) steps at once, 1 on padding
+    states outside the table (i.e. terminal states) take probability 1
+    '''
+    covered = mask & (states < table.shape[0])
+    probs = np.ones(states.shape)
+    probs[covered] = table[states[covered], actions[covered]]
+    return probs
+
+def importance_ratios(evaluation_probs, behavior_probs, mask, eps=0.0, clip=None):
+    '''
+    cumulative ratios rho_t = prod_{k<=t} (pi_e + eps) / (pi_b + eps), (N, T)
+    padding has ratio 1, so rho stays at its last value past the end of an episode
+    clip: (low, high) bounds of the cumulative ratio, applied after every step
+          as in the legacy estimators. this makes the ratios a python loop over T
+          (still vectorized over N), without it they are a single cumprod
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = np.where(mask, (evaluation_probs + eps) / (behavior_probs + eps), 1.0)
+    # pi_b = 0 and pi_e = 0 would be 0 / 0, the action was impossible under both
+    ratios[np.isnan(ratios)] = 0.0
+    if clip is None:
+        return np.cumprod(ratios, axis=1)
+    rho = np.empty_like(ratios)
+    running = np.ones(ratios.shape[0])
+    for t in range(ratios.shape[1]):
+        running = np.clip(running * ratios[:, t], clip[0], clip[1])
+        rho[:, t] = running
+    return rho
+
+def fit_approximate_model(trajectories, num_states, num_actions):
+    '''
+    T_hat (SparseTransitionModel) and R_hat (S, A) of all the steps, see make_approximate_model_builder
+    '''
+    return make_approximate_model_builder(num_states, num_actions, use_sparse=True)(trajectories.steps())
+
+def make_approximate_model_builder(num_states, num_actions, use_sparse=False):
+    '''
+    use_sparse: if True, T_hat is returned as a SparseTransitionModel
+    '''
+    transition_count_table = sparse.csr_matrix((num_states * num_actions, num_states))
+    reward_sum_table = np.zeros((num_states, num_actions))
+ 
+    def build_approximate_model(episode):
+        nonlocal transition_count_table
+        # replay experiences and build N_sas and R_sa
+        episode = np.asarray(episode, dtype=float).reshape((-1, 4))
+        s = episode[:, 0].astype(int)
+        a = episode[:, 1].astype(int)
+        new_s = episode[:, 3].astype(int)
+        transition_count_table = transition_count_table + \
+                sparse.coo_matrix((np.ones(s.shape[0]), (s * num_actions + a, new_s)),
+                                  shape=transition_count_table.shape).tocsr()
+        np.add.at(reward_sum_table, (s, a), episode[:, 2])
+
+        # build T_hat and R_hat
+        # if never visited, no reward, no transition
+        T_hat = SparseTransitionModel.from_counts(transition_count_table, num_states, num_actions,
+                                                  eps=0.0, uniform_unvisited=False)
+        N_sa = np.asarray(transition_count_table.sum(axis=1)).reshape((num_states, num_actions))
+        reward_table = np.zeros((num_states, num_actions))
+        visited_sa = N_sa > 0
+        reward_table[visited_sa] = reward_sum_table[visited_sa] / N_sa[visited_sa]
+        if use_sparse:
+            return T_hat, reward_table
+        return T_hat.toarray(), reward_table
+    
+    return build_approximate_model
+
+def off_policy_evaluation(trajectories, pi_evaluation, gamma, Q_hat=None, V_hat=None,
+                          eps=0.0, clip=None, running=False):
+    '''
+    every estimator of ESTIMATORS from one (N, T) ratio tensor
+        is, wis: trajectory-wise (weighted) importance sampling, rho_T G
+        pdis, wpdis: per-decision (weighted) importance sampling, sum_t gamma^t rho_t r_t
+        dr: doubly robust of Jiang & Li (2016)
+            sum_t gamma^t (w_t (r_t - Q_hat(s_t, a_t)) + w_{t-1} V_hat(s_t))
+        wdr: weighted doubly robust of Thomas & Brunskill (2016), the same sum with
+             w_t normalized over the episodes at every t
+    w_t = rho_t / N for the unweighted and rho_t / sum_n rho_t for the weighted estimators,
+    with rho_{-1} = 1. episodes that ended keep their last rho and contribute nothing
+    pi_evaluation: policy or (S, A) table, see action_prob_table
+    Q_hat, V_hat: (S, A) and (S,) model estimates of pi_e. dr and wdr are left out without them
+    running: if True, every estimate is an (N,) array whose n-th entry uses the first n + 1 episodes,
+             from prefix sums over N
+    returns:
+        dict estimator -> estimate
+    '''
+    mask = trajectories.mask
+    states, actions = trajectories.states, trajectories.actions
+    num_episodes, horizon = mask.shape
+    evaluation_probs = gather_probs(action_prob_table(pi_evaluation), states, actions, mask)
+    rho = importance_ratios(evaluation_probs, trajectories.behavior_probs, mask, eps, clip)
+    discounted_rewards = (gamma ** np.arange(horizon)) * trajectories.rewards
+
+    if running:
+        # n -> sum over the first n + 1 episodes
+        def total(x):
+            return np.cumsum(x, axis=0)
+        counts = np.arange(1, num_episodes + 1)
+    else:
+        def total(x):
+            return np.sum(x, axis=0)
+        counts = num_episodes
+
+    def normalize(numerator, denominator):
+        return np.divide(numerator, denominator, out=np.zeros(np.broadcast(numerator, denominator).shape),
+                         where=denominator != 0)
+
+    rho_T = rho[:, -1] if horizon > 0 else np.ones(num_episodes)
+    returns = np.sum(discounted_rewards, axis=1)
+    estimates = {'is': total(rho_T * returns) / counts,
+                 'wis': normalize(total(rho_T * returns), total(rho_T))}
+    # per-decision weights: sum over t of the (prefix) sums over episodes at t
+    rho_sum = total(rho)
+    estimates['pdis'] = np.sum(total(rho * discounted_rewards), axis=-1) / counts
+    estimates['wpdis'] = np.sum(normalize(total(rho * discounted_rewards), rho_sum), axis=-1)
+
+    if Q_hat is not None and V_hat is not None:
+        # padded steps index state 0, the mask zeroes them
+        discounts = np.where(mask, gamma ** np.arange(horizon), 0.0)
+        q = discounts * Q_hat[states, actions]
+        v = discounts * V_hat[states]
+        rho_prev = np.concatenate([np.ones((num_episodes, 1)), rho[:, :-1]], axis=1)
+        rho_prev_sum = total(rho_prev)
+        correction = rho * (discounted_rewards - q)
+        baseline = rho_prev * v
+        estimates['dr'] = np.sum(total(correction + baseline), axis=-1) / counts
+        estimates['wdr'] = np.sum(normalize(total(correction), rho_sum) +
+                                  normalize(total(baseline), rho_prev_sum), axis=-1)
+    return estimates
+
+def doubly_robust_estimates(trajectories, pi_evaluation, gamma, num_states, num_actions,
+                            eps=0.0, clip=None, running=False):
+    '''
+    off_policy_evaluation with Q_hat and V_hat of pi_e on the approximate model of the trajectories,
+    one sparse LU solve per model, see mdp.solver.evaluate_policy_Q
+    running: the n-th dr and wdr estimates use a model of the first n + 1 episodes only, so no
+             estimate looks ahead. the counts are accumulated episode by episode as in
+             make_approximate_model_builder, one solve per episode
+    '''
+    pi_table = action_prob_table(pi_evaluation)
+    if not running:
+        T_hat, R_hat = fit_approximate_model(trajectories, num_states, num_actions)
+        Q_hat, V_hat = evaluate_policy_Q(pi_table, T_hat, R_hat, gamma)
+        return off_policy_evaluation(trajectories, pi_table, gamma, Q_hat=Q_hat, V_hat=V_hat,
+                                     eps=eps, clip=clip)
+    estimates = off_policy_evaluation(trajectories, pi_table, gamma, eps=eps, clip=clip, running=True)
+    build_approximate_model = make_approximate_model_builder(num_states, num_actions, use_sparse=True)
+    estimates['dr'] = np.empty(trajectories.num_episodes)
+    estimates['wdr'] = np.empty(trajectories.num_episodes)
+    for n in range(trajectories.num_episodes):
+        T_hat, R_hat = build_approximate_model(trajectories.steps(n))
+        Q_hat, V_hat = evaluate_policy_Q(pi_table, T_hat, R_hat, gamma)
+        prefix = off_policy_evaluation(trajectories.head(n + 1), pi_table, gamma, Q_hat=Q_hat, V_hat=V_hat,
+                                       eps=eps, clip=clip)
+        estimates['dr'][n], estimates['wdr'][n] = prefix['dr'], prefix['wdr']
+    return estimates
@@ -1,7 +1,80 @@
 import numpy as np
 import numba as nb
 
-class EpsilonGreedyPolicy:
+
+def sample_from_cdf(action_cdf, states, rng=np.random):
+    '''
+    one action per state by inverse-CDF sampling, all states at once
+    action_cdf: (num_states, num_actions) cumulative action probabilities
+    states outside the table (i.e. terminal states) take action 0
+    '''
+    states = np.asarray(states, dtype=np.int64)
+    num_policy_states, num_actions = action_cdf.shape
+    actions = np.zeros(states.shape, dtype=np.int64)
+    covered = states < num_policy_states
+    cdf = action_cdf[states[covered]]
+    u = rng.random(cdf.shape[0]) * cdf[:, -1]
+    a = np.sum(cdf <= u[:, np.newaxis], axis=1)
+    actions[covered] = np.minimum(a, num_actions - 1)
+    return actions
+
+
+class _CachedProbs:
+    '''
+    caches the (S, A) action probabilities of a policy and their cumulative table
+    subclasses implement _compute_action_probs. the cache is dropped by update_Q_val,
+    so a Q modified in place through the array passed to __init__ is not noticed
+    '''
+    _probs = None
+    _cdf = None
+
+    def _action_probs(self):
+        if self._probs is None:
+            self._probs = self._compute_action_probs()
+        return self._probs
+
+    def get_action_cdf(self):
+        '''
+        returns:
+            (num_states, num_actions) cumulative action probabilities, cached. do not modify
+        '''
+        if self._cdf is None:
+            self._cdf = np.cumsum(self._action_probs(), axis=1)
+        return self._cdf
+
+    def get_action_probs(self):
+        return np.copy(self._action_probs())
+
+    def query_Q_probs(self, s=None, a=None):
+        '''
+        returns:
+            pi(a|s), pi(.|s) or the whole (num_states, num_actions) table, from the cache
+        '''
+        Q_probs = self._action_probs()
+        if s is None and a is None:
+            return np.copy(Q_probs)
+        elif a is None:
+            return np.copy(Q_probs[s, :])
+        else:
+            return Q_probs[s, a]
+
+    def choose_action(self, s, rng=np.random):
+        return sample_from_cdf(self.get_action_cdf(), np.array([s]), rng)[0]
+
+    def choose_actions(self, states, rng=np.random):
+        '''
+        states: (n,) states, sampled independently
+        returns:
+            (n,) actions. states outside the policy (i.e. terminal states) take action 0
+        '''
+        return sample_from_cdf(self.get_action_cdf(), states, rng)
+
+    def update_Q_val(self, s, a, val):
+        self._Q[s,a] = val
+        self._probs = None
+        self._cdf = None
+
+class EpsilonGreedyPolicy(_CachedProbs):
     '''
     TODO: refactor this 
     '''
@@ -17,39 +90,18 @@ class EpsilonGreedyPolicy:
         # support read-only
         return np.copy(self._Q)
     
-    def query_Q_probs(self, s=None, a=None):
-        Q_probs = np.zeros(self._Q.shape)
-        for s in range(self._Q.shape[0]):
-            Q_probs[s, :] = self.query_Q_probs(s)
-        if s is None and a is None:
-            return Q_probs
-        elif a is None:
-            return Q_probs[s, :]
-        else:
-            return Q_probs[s, a]
-
-    
-    def _query_Q_probs(self, s, a=None):
+    def _compute_action_probs(self):
+        '''
+        returns:
+            (num_states, num_actions) probabilities choose_action samples from
+            ties share the greedy mass evenly
+        '''
         num_actions = self._Q.shape[1]
-        probs = np.ones(num_actions, dtype=float) * self._eps / num_actions
-        ties = np.flatnonzero(self._Q[s, :] == self._Q[s, :].max())
-        if a is None:
-            best_a = np.random.choice(ties)
-            probs[best_a] += 1. - self._eps
-            return probs
-        else:
-            if a in ties:
-                probs[a] += 1. - self._eps
-            return probs[a]
-
-    def choose_action(self, s):
-        probs = self._query_Q_probs(s)
-        return np.random.choice(len(probs), p=probs)
+        ties = (self._Q == np.max(self._Q, axis=1, keepdims=True)).astype(float)
+        greedy_probs = ties / np.sum(ties, axis=1, keepdims=True)
+        return self._eps / num_actions + (1. - self._eps) * greedy_probs
 
-    def update_Q_val(self, s, a, val):
-        self._Q[s,a] = val
-
-class GreedyPolicy:
+class GreedyPolicy(_CachedProbs):
     def __init__(self, num_states, num_actions, Q=None):
         if Q is None:
             # start with random policy
@@ -63,33 +115,19 @@ class GreedyPolicy:
         # support read-only
         return np.copy(self._Q)
     
-    def query_Q_probs(self, s=None, a=None):
-        Q_probs = np.zeros(self._Q.shape).astype(np.float)
-        for s in range(self._Q.shape[0]):
-            ties = np.flatnonzero(self._Q[s, :] == self._Q[s, :].max())
-            a = np.random.choice(ties)
-            Q_probs[s, a] = 1.0
-        if s is None and a is None:
-            return Q_probs
-        elif a is None:
-            return Q_probs[s, :]
-        else:
-            return Q_probs[s, a]
+    def _compute_action_probs(self):
+        '''
+        returns:
+            (num_states, num_actions) probabilities choose_action samples from
+            i.e. uniform over the tied argmax actions
+        '''
+        ties = (self._Q == np.max(self._Q, axis=1, keepdims=True)).astype(float)
+        return ties / np.sum(ties, axis=1, keepdims=True)
 
-    def choose_action(self, s):
-        ties = np.flatnonzero(self._Q[s, :] == self._Q[s, :].max())
-        return np.random.choice(ties)
-    
-    def get_opt_actions(self):
-        opt_actions = np.zeros(self._Q.shape[0])
-        for s in range(opt_actions.shape[0]):
-            opt_actions[s] = self.choose_action(s)
-        return opt_actions
-    
-    def update_Q_val(self, s, a, val):
-        self._Q[s,a] = val
+    def get_opt_actions(self, rng=np.random):
+        return self.choose_actions(np.arange(self._Q.shape[0]), rng).astype(float)
 
-class StochasticPolicy:
+class StochasticPolicy(_CachedProbs):
     def __init__(self, num_states, num_actions, Q=None):
         if Q is None:
             # start with random policy
@@ -109,6 +147,18 @@ class StochasticPolicy:
         returns:
             probability distribution of actions over all states
         '''
+        if laplacian_smoothing:
+            Q_probs = self._action_probs()
+        else:
+            Q_probs = self._compute_action_probs(laplacian_smoothing=False)
+        if s is None and a is None:
+            return np.copy(Q_probs)
+        elif a is None:
+            return np.copy(Q_probs[s, :])
+        else:
+            return Q_probs[s, a]
+
+    def _compute_action_probs(self, laplacian_smoothing=True):
         if laplacian_smoothing:
             LAPLACIAN_SMOOTHER = 0.01
             L = (np.max(self._Q, axis=1) - np.min(self._Q, axis=1))* LAPLACIAN_SMOOTHER
@@ -116,29 +166,43 @@ class StochasticPolicy:
         else:
             Q = self._Q - np.expand_dims(np.min(self._Q, axis=1), axis=1)
         Q_sum = np.sum(Q, axis=1)
-        # if zero, we give uniform probs with some gaussian noise
+        # if zero, we give uniform probs
         num_actions = self._Q.shape[1]
         Q[Q_sum==0, :] = 1.
         Q_sum[Q_sum==0] = num_actions
-        Q_probs = Q / np.expand_dims(Q_sum, axis=1)
-        Q_probs[Q_sum==0, :] += np.random.normal(0, 1e-4, num_actions)
+        return Q / np.expand_dims(Q_sum, axis=1)
 
-        if s is None and a is None:
-            return Q_probs
-        elif a is None:
-            return Q_probs[s, :]
-        else:
-            return Q_probs[s, a]
+    def get_action_probs(self, laplacian_smoothing=True):
+        return self.query_Q_probs(laplacian_smoothing=laplacian_smoothing)
+
+    def choose_action(self, s, laplacian_smoothing=True, rng=np.random):
+        if laplacian_smoothing:
+            return super().choose_action(s, rng)
+        probs = self._compute_action_probs(laplacian_smoothing=False)[s]
+        return sample_from_cdf(np.cumsum(probs)[np.newaxis], np.array([0]), rng)[0]
 
+class SoftmaxPolicy(_CachedProbs):
+    '''
+    pi(a|s) proportional to exp(Q(s, a) / temperature), e.g. the max-ent policy of a soft Q
+    '''
+    def __init__(self, num_states, num_actions, Q=None, temperature=1.0):
+        if Q is None:
+            self._Q = np.zeros((num_states, num_actions))
+        else:
+            self._Q = Q
+        self._temperature = temperature
 
-    def choose_action(self, s, laplacian_smoothing=True):
-        probs = self.query_Q_probs(s, laplacian_smoothing=laplacian_smoothing)
-        return np.random.choice(len(probs), p=probs)
+    @property
+    def Q(self):
+        # support read-only
+        return np.copy(self._Q)
 
-    def update_Q_val(self, s, a, val):
-        self._Q[s,a] = val
+    def _compute_action_probs(self):
+        logits = self._Q / self._temperature
+        probs = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+        return probs / np.sum(probs, axis=1, keepdims=True)
 
-class RandomPolicy:
+class RandomPolicy(_CachedProbs):
     def __init__(self, num_states, num_actions):
         self._Q_probs = np.ones((num_states, num_actions), dtype=float) / num_actions
 
@@ -147,6 +211,5 @@ class RandomPolicy:
         # support read-only
         return np.copy(self._Q)
 
-    def choose_action(self, s):
-        probs = self._Q_probs[s, :]
-        return np.random.choice(len(probs), p=probs)
+    def _compute_action_probs(self):
+        return self._Q_probs
@@ -0,0 +1,22 @@
+import argparse
+
+from utils.utils import load_data, select_clustering
+from constants import *
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='score k-means state spaces over k and seeds')
+    parser.add_argument('-k', '--ks', default=[150, 300, 750], type=int, nargs='+', dest='ks')
+    parser.add_argument('-nsd', '--num_seeds', default=4, type=int, dest='num_seeds')
+    parser.add_argument('-np', '--num_processes', default=None, type=int, dest='num_processes')
+    parser.add_argument('-up', '--use_pca', action='store_true', dest='use_pca')
+    parser.set_defaults(use_pca=False)
+    args = parser.parse_args()
+
+    data = load_data()['kmeans_pca' if args.use_pca else 'kmeans']
+    # the centroid columns are the clustered features
+    cols = data['centroids'].columns
+    report, _ = select_clustering(data['train'][cols], data['val'][cols], args.ks,
+                                  range(args.num_seeds), num_processes=args.num_processes)
+    print(report.to_string(index=False))
+    print(report.groupby('k')[['train_inertia', 'val_inertia', 'stability']].mean())
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import hashlib
+import weakref
+import numpy as np
+import pandas as pd
+from mdp.transition_model import SparseTransitionModel
+from utils.storage import save_frame, load_frame, FRAME_EXT
+from constants import CACHE_PATH
+
+
+class ArtifactCache():
+    '''
+    content-addressed on-disk store for derived artifacts (trajectories, mdps, processed frames)
+
+    an artifact's key is a hash of the stage that produced it, its parameters
+    and the keys of its upstream inputs. changing num_states, the clustering
+    method or any upstream artifact therefore changes every downstream key,
+    and only the stages whose key changed are recomputed.
+
+    deps can be
+        str: used verbatim, e.g. another artifact's key or file_dep(path)
+        objects previously returned by this cache: resolved to their key
+        anything else (DataFrame, ndarray, SparseTransitionModel): hashed by content
+
+    arrays are stored as .npy, SparseTransitionModel as .npz and DataFrames
+    in the columnar format of utils.storage.
+    manifest.json in the cache root records stage, params and deps of every key
+    '''
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, root=CACHE_PATH, verbose=True, mmap=False):
+        '''
+        mmap: memory-map cached arrays and frames instead of reading them into memory
+        '''
+        self.root = root
+        self.verbose = verbose
+        self.mmap = mmap
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self.manifest_path = os.path.join(root, self.MANIFEST)
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {}
+        # id(obj) -> (weakref to obj, key) for artifacts handed out by this cache
+        self._lineage = {}
+
+    @staticmethod
+    def file_dep(path):
+        '''
+        dependency string for a raw input file, invalidated when the file changes
+        '''
+        stat = os.stat(path)
+        return 'file:{}:{}:{}'.format(os.path.abspath(path), stat.st_size, int(stat.st_mtime))
+
+    def key(self, stage, params=None, deps=()):
+        h = hashlib.sha1()
+        h.update(stage.encode())
+        h.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+        for dep in deps:
+            h.update(self.fingerprint(dep).encode())
+        return '{}-{}'.format(stage, h.hexdigest()[:16])
+
+    def fingerprint(self, obj):
+        if isinstance(obj, str):
+            return obj
+        entry = self._lineage.get(id(obj))
+        if entry is not None and entry[0]() is obj:
+            return entry[1]
+        h = hashlib.sha1()
+        if isinstance(obj, pd.DataFrame):
+            h.update(json.dumps([str(c) for c in obj.columns]).encode())
+            h.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+        elif isinstance(obj, SparseTransitionModel):
+            for a in [obj.observed.data, obj.observed.indices, obj.observed.indptr, obj.floor]:
+                h.update(np.ascontiguousarray(a).tobytes())
+        else:
+            a = np.ascontiguousarray(obj)
+            h.update(str((a.dtype, a.shape)).encode())
+            h.update(a.tobytes())
+        return 'content:' + h.hexdigest()
+
+    def __contains__(self, key):
+        entry = self.manifest.get(key)
+        return entry is not None and \
+                all(os.path.isfile(os.path.join(self.root, part['file'])) for part in entry['parts'])
+
+    def get_or_compute(self, stage, compute, params=None, deps=(), force=False):
+        '''
+        load the artifact for (stage, params, deps) or build it with compute()
+        compute may return a single artifact or a tuple of them
+        force: recompute and overwrite even if the key is cached
+        '''
+        key = self.key(stage, params, deps)
+        if not force and key in self:
+            if self.verbose:
+                print('loading cached {}'.format(key))
+            value = self.load(key)
+        else:
+            if self.verbose:
+                print('computing {}'.format(key))
+            value = compute()
+            self.save(key, value, stage, params, deps)
+        self._register(key, value)
+        return value
+
+    def get_or_write(self, stage, write, kinds, params=None, deps=(), force=False):
+        '''
+        get_or_compute for stages that write their artifacts to disk themselves,
+        e.g. out-of-core pipelines whose output does not fit in memory
+        write(paths) must create every path. kinds: kind of every part, e.g. ['frame', 'array']
+        returns the key. the parts are read with load_part
+        '''
+        key = self.key(stage, params, deps)
+        if not force and key in self:
+            return key
+        if self.verbose:
+            print('computing {}'.format(key))
+        exts = {'frame': FRAME_EXT, 'sparse_transition': '.npz', 'array': '.npy'}
+        files = ['{}_{}{}'.format(key, i, exts[kind]) for i, kind in enumerate(kinds)]
+        write([os.path.join(self.root, file_name) for file_name in files])
+        self._add_entry(key, [{'file': f, 'kind': kind} for f, kind in zip(files, kinds)],
+                        True, stage, params, deps)
+        return key
+
+    def load(self, key):
+        entry = self.manifest[key]
+        parts = [self._load_part(os.path.join(self.root, part['file']), part['kind'])
+                 for part in entry['parts']]
+        if entry['is_tuple']:
+            return tuple(parts)
+        return parts[0]
+
+    def load_part(self, key, i):
+        '''
+        only the i-th artifact of a tuple-valued key
+        '''
+        entry = self.manifest[key]
+        part = entry['parts'][i]
+        value = self._load_part(os.path.join(self.root, part['file']), part['kind'])
+        self._register_part(self._part_key(key, i, len(entry['parts'])), value)
+        return value
+
+    def save(self, key, value, stage='', params=None, deps=()):
+        is_tuple = isinstance(value, tuple)
+        values = value if is_tuple else (value,)
+        parts = []
+        for i, v in enumerate(values):
+            kind, ext = self._kind(v)
+            file_name = '{}_{}{}'.format(key, i, ext)
+            self._save_part(os.path.join(self.root, file_name), v, kind)
+            parts.append({'file': file_name, 'kind': kind})
+        self._add_entry(key, parts, is_tuple, stage, params, deps)
+
+    def _add_entry(self, key, parts, is_tuple, stage, params, deps):
+        self.manifest[key] = {
+            'stage': stage,
+            'params': json.loads(json.dumps(params or {}, default=str)),
+            'deps': [self.fingerprint(dep) for dep in deps],
+            'parts': parts,
+            'is_tuple': is_tuple,
+            'created': time.strftime('%y%m%d_%H%M%S', time.gmtime())
+        }
+        self._write_manifest()
+
+    def _register(self, key, value):
+        values = value if isinstance(value, tuple) else (value,)
+        for i, v in enumerate(values):
+            self._register_part(self._part_key(key, i, len(values)), v)
+
+    def _register_part(self, part_key, value):
+        try:
+            self._lineage[id(value)] = (weakref.ref(value), part_key)
+        except TypeError:
+            # not weak-referenceable, falls back to content hashing
+            pass
+
+    @staticmethod
+    def _part_key(key, i, num_parts):
+        return key if num_parts == 1 else '{}/{}'.format(key, i)
+
+    def __getstate__(self):
+        # weak references do not pickle. a copy in another process starts without lineage
+        state = self.__dict__.copy()
+        state['_lineage'] = {}
+        return state
+
+    def _write_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def _kind(value):
+        if isinstance(value, SparseTransitionModel):
+            return 'sparse_transition', '.npz'
+        if isinstance(value, pd.DataFrame):
+            return 'frame', FRAME_EXT
+        return 'array', '.npy'
+
+    @staticmethod
+    def _save_part(path, value, kind):
+        if kind == 'sparse_transition':
+            value.save(path)
+        elif kind == 'frame':
+            save_frame(value, path)
+        else:
+            np.save(path, value)
+
+    def _load_part(self, path, kind):
+        if kind == 'sparse_transition':
+            return SparseTransitionModel.load(path)
+        if kind == 'frame':
+            return load_frame(path, self.mmap)
+        return np.load(path, mmap_mode='r' if self.mmap else None)
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from scipy import sparse
+from mdp.transition_model import SparseTransitionModel
+
+
+class SharedArrays():
+    '''
+    read-only arrays handed to worker processes as small picklable handles
+
+    every array is written once to a .npy file in a temporary directory and
+    workers memory-map it, so all processes read the same page cache copy
+    instead of each unpickling a private one. files rather than multiprocessing.shared_memory
+    because before python 3.13 the resource tracker unlinks a segment as soon as
+    the first worker that attached to it exits
+
+        with SharedArrays() as shared:
+            handle = shared.share(transition_matrix)
+            ... pass handle to a worker, which calls resolve(handle) ...
+    '''
+    def __init__(self, root=None):
+        self.root = tempfile.mkdtemp(prefix='shared_arrays_', dir=root)
+        # id(value) -> (value, handle). keeps value alive so the id is not reused
+        self._handles = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def share(self, value):
+        '''
+        handle for an ndarray or a SparseTransitionModel. anything else is returned as is
+        sharing the same object twice returns the same handle
+        '''
+        entry = self._handles.get(id(value))
+        if entry is not None:
+            return entry[1]
+        if isinstance(value, SparseTransitionModel):
+            observed = value.observed
+            handle = SharedTransitionModel(self._write(observed.data), self._write(observed.indices),
+                                           self._write(observed.indptr), self._write(value.floor),
+                                           value.num_states, value.num_actions)
+        elif _is_npy_memmap(value):
+            # already a whole .npy on disk, e.g. resolved from another SharedArrays
+            handle = SharedArray(value.filename)
+        elif isinstance(value, np.ndarray):
+            handle = self._write(value)
+        else:
+            return value
+        self._handles[id(value)] = (value, handle)
+        return handle
+
+    def close(self):
+        self._handles = {}
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _write(self, array):
+        path = os.path.join(self.root, '{}.npy'.format(len(os.listdir(self.root))))
+        np.save(path, np.ascontiguousarray(array))
+        return SharedArray(path)
+
+
+class SharedArray():
+    def __init__(self, path):
+        self.path = path
+
+    def get(self):
+        return np.load(self.path, mmap_mode='r')
+
+
+class SharedTransitionModel():
+    def __init__(self, data, indices, indptr, floor, num_states, num_actions):
+        self.arrays = (data, indices, indptr, floor)
+        self.num_states = num_states
+        self.num_actions = num_actions
+
+    def get(self):
+        data, indices, indptr, floor = [a.get() for a in self.arrays]
+        observed = sparse.csr_matrix((data, indices, indptr),
+                                     shape=(self.num_states * self.num_actions, self.num_states))
+        return SparseTransitionModel(observed, floor, self.num_states, self.num_actions)
+
+
+def _is_npy_memmap(value):
+    if not isinstance(value, np.memmap) or value.filename is None or not value.filename.endswith('.npy'):
+        return False
+    with open(value.filename, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    return value.offset == offset and value.shape == shape and value.dtype == dtype and \
+            value.flags.c_contiguous and not fortran_order
+
+
+def resolve(value):
+    '''
+    the array behind a handle of SharedArrays, anything else as is
+    '''
+    if isinstance(value, (SharedArray, SharedTransitionModel)):
+        return value.get()
+    return value
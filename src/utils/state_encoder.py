@@ -0,0 +1,162 @@
+import copy
+import pickle
+import numpy as np
+from scipy.spatial import cKDTree
+from constants import *
+from utils.streaming import CLUSTER_COLS, NORMALIZED_COLS
+
+
+class StateEncoder():
+    '''
+    maps raw observation rows (columns as in the raw csv) onto the states of a fitted clustering
+
+    bundles the train-time preprocessing of utils._process_data:
+    sedation clip, 1%/99% clip and log of COLS_TO_BE_LOGGED, normalization,
+    the optional pca and the centroids. new rows always get the train finite
+    minimum of the logged columns. _process_data clips val with its own minimum,
+    which only matters for val rows at the bottom of the train range
+
+    the nearest centroid comes from argmin_c |c|^2 - 2 x.c, computed with one
+    matrix product per batch. use_kdtree queries a cKDTree instead, which
+    only pays off for low-dimensional (e.g. truncated pca) features
+    '''
+    def __init__(self, clip_low, clip_high, finite_min, norm_means, norm_stds,
+                 centroids=None, pca=None, use_kdtree=False, batch_size=4096):
+        self.clip_low = np.asarray(clip_low, dtype=float)
+        self.clip_high = np.asarray(clip_high, dtype=float)
+        self.finite_min = np.asarray(finite_min, dtype=float)
+        self.norm_means = np.asarray(norm_means, dtype=float)
+        self.norm_stds = np.asarray(norm_stds, dtype=float)
+        self.use_kdtree = use_kdtree
+        self.batch_size = batch_size
+        self._logged_idx = np.array([CLUSTER_COLS.index(c) for c in COLS_TO_BE_LOGGED])
+        self._normalized_idx = np.array([CLUSTER_COLS.index(c) for c in NORMALIZED_COLS])
+        self._sedation_idx = CLUSTER_COLS.index('sedation')
+        self.centroids = None
+        self.pca = None
+        if centroids is not None:
+            self._set_centroids(centroids, pca)
+
+    @classmethod
+    def fit(cls, df_train):
+        '''
+        train-time transforms of correct_data and normalize_data, computed from the raw train frame
+        the returned encoder has no centroids yet, see with_centroids
+        '''
+        sedation = df_train['sedation'].clip(0.0)
+        bounds = df_train[COLS_TO_BE_LOGGED].quantile([.01, .99])
+        clip_low, clip_high = bounds.loc[.01].values, bounds.loc[.99].values
+        with np.errstate(divide='ignore'):
+            logged = np.log(np.clip(df_train[COLS_TO_BE_LOGGED].values, clip_low, clip_high))
+        finite_min = np.where(np.isfinite(logged), logged, np.inf).min(axis=0)
+        logged = np.maximum(logged, finite_min)
+        columns = []
+        for c in NORMALIZED_COLS:
+            if c in COLS_TO_BE_LOGGED:
+                columns.append(logged[:, COLS_TO_BE_LOGGED.index(c)])
+            elif c == 'sedation':
+                columns.append(sedation.values)
+            else:
+                columns.append(df_train[c].values)
+        corrected = np.stack(columns, axis=1).astype(float)
+        return cls(clip_low, clip_high, finite_min, corrected.mean(axis=0), corrected.std(axis=0))
+
+    @classmethod
+    def from_preprocessor(cls, preprocessor, pca=False):
+        '''
+        encoder of a fitted utils.streaming.StreamingPreprocessor
+        '''
+        encoder = cls(preprocessor.clip_low, preprocessor.clip_high, preprocessor.finite_min['train'],
+                      preprocessor.norm_means, preprocessor.norm_stds)
+        if pca:
+            return encoder.with_centroids(preprocessor.kmeans_pca.cluster_centers_, preprocessor.pca)
+        return encoder.with_centroids(preprocessor.kmeans.cluster_centers_)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    def with_centroids(self, centroids, pca=None):
+        '''
+        copy of the encoder that assigns to centroids, (k, d) array or the centroids DataFrame
+        pca: fitted sklearn PCA if the centroids live in pca space
+        a DataFrame also fixes the feature order, an array is taken to be in the order of
+        utils.streaming.CLUSTER_COLS. pca centroids take the pca input order instead
+        (feature_names_in_ of a PCA fitted on a DataFrame, else CLUSTER_COLS)
+        '''
+        encoder = copy.copy(self)
+        encoder._set_centroids(centroids, pca)
+        return encoder
+
+    def _set_centroids(self, centroids, pca):
+        if pca is not None:
+            columns = list(getattr(pca, 'feature_names_in_', CLUSTER_COLS))
+        elif hasattr(centroids, 'columns'):
+            columns = list(centroids.columns)
+        else:
+            columns = CLUSTER_COLS
+        self._order = np.array([CLUSTER_COLS.index(c) for c in columns])
+        self.centroids = np.ascontiguousarray(np.asarray(centroids, dtype=float))
+        self.pca = pca
+        self._centroid_sq_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        self._tree = cKDTree(self.centroids) if self.use_kdtree else None
+
+    def __getstate__(self):
+        # the tree is rebuilt on load
+        state = self.__dict__.copy()
+        state['_tree'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.use_kdtree and self.centroids is not None:
+            self._tree = cKDTree(self.centroids)
+
+    @property
+    def num_states(self):
+        return self.centroids.shape[0]
+
+    def transform(self, df):
+        '''
+        features the centroids live in, (n, d)
+        df: raw rows with at least the clustered columns (utils.streaming.CLUSTER_COLS)
+        '''
+        X = df[CLUSTER_COLS].to_numpy(dtype=float, copy=True)
+        X[:, self._sedation_idx] = np.maximum(X[:, self._sedation_idx], 0.0)
+        with np.errstate(divide='ignore'):
+            logged = np.log(np.clip(X[:, self._logged_idx], self.clip_low, self.clip_high))
+        X[:, self._logged_idx] = np.maximum(logged, self.finite_min)
+        X[:, self._normalized_idx] = (X[:, self._normalized_idx] - self.norm_means) / self.norm_stds
+        X = X[:, self._order]
+        if self.pca is not None:
+            # pca.transform without its feature-name checks, PCA and IncrementalPCA alike
+            X = (X - self.pca.mean_).dot(self.pca.components_.T)
+            if self.pca.whiten:
+                X /= np.sqrt(self.pca.explained_variance_)
+        return X
+
+    def assign(self, X):
+        '''
+        index of the nearest centroid for every row of the transformed features X
+        '''
+        X = np.asarray(X, dtype=float)
+        if self._tree is not None:
+            return self._tree.query(X)[1]
+        states = np.empty(X.shape[0], dtype=np.int64)
+        for start in range(0, X.shape[0], self.batch_size):
+            batch = X[start:start + self.batch_size]
+            # |x|^2 is the same for every centroid, so it does not change the argmin
+            distances = self._centroid_sq_norms - 2.0 * batch.dot(self.centroids.T)
+            states[start:start + self.batch_size] = np.argmin(distances, axis=1)
+        return states
+
+    def encode(self, df):
+        '''
+        states of raw rows
+        '''
+        return self.assign(self.transform(df))
@@ -0,0 +1,187 @@
+import os
+import json
+import struct
+import zipfile
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+# typed columnar storage for DataFrames
+# Feather when pyarrow is installed, otherwise an uncompressed .npz with one array per column
+FRAME_EXT = '.feather' if feather is not None else '.npz'
+
+
+def frame_path(path):
+    '''
+    columnar counterpart of a (csv) path, e.g. data/cleansed_data_train.csv -> data/cleansed_data_train.npz
+    '''
+    return os.path.splitext(path)[0] + FRAME_EXT
+
+
+def save_frame(df, path):
+    '''
+    write df with its column dtypes and index. the format follows the extension of path
+    '''
+    if path.endswith('.feather'):
+        if feather is None:
+            raise Exception('pyarrow is required to write {}'.format(path))
+        table = pyarrow.Table.from_pandas(df, preserve_index=True)
+        feather.write_feather(table, path, compression='uncompressed')
+        return
+    schema = {
+        'columns': [str(c) for c in df.columns],
+        'index_name': df.index.name
+    }
+    columns = {'c{}'.format(i): _to_storable(df[c].values) for i, c in enumerate(df.columns)}
+    np.savez(path, __schema__=np.array(json.dumps(schema)),
+             __index__=_to_storable(df.index.values), **columns)
+
+
+def load_frame(path, mmap=False):
+    '''
+    mmap: memory-map the column buffers instead of reading them into memory.
+          columns are then read-only views on the file
+    '''
+    if path.endswith('.feather'):
+        if feather is None:
+            raise Exception('pyarrow is required to read {}'.format(path))
+        return feather.read_table(path, memory_map=mmap).to_pandas()
+    with np.load(path) as f:
+        schema = json.loads(str(f['__schema__']))
+        names = ['__index__'] + ['c{}'.format(i) for i in range(len(schema['columns']))]
+        if mmap:
+            arrays = [_npz_memmap(path, name) for name in names]
+            arrays = [f[name] if a is None else a for name, a in zip(names, arrays)]
+        else:
+            arrays = [f[name] for name in names]
+    index = pd.Index(arrays[0], name=schema['index_name'])
+    data = dict(zip(schema['columns'], arrays[1:]))
+    return pd.DataFrame(data, columns=schema['columns'], index=index, copy=False)
+
+
+def _to_storable(values):
+    values = np.asarray(values)
+    if values.dtype == object:
+        # keep the file loadable without pickle
+        return values.astype(str)
+    return values
+
+
+def _npz_memmap(path, name):
+    '''
+    np.load ignores mmap_mode for .npz. np.savez stores members uncompressed,
+    so a member can still be mapped at its offset inside the zip file.
+    returns None if the member cannot be mapped
+    '''
+    with zipfile.ZipFile(path) as zf:
+        info = zf.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(path, 'rb') as f:
+        # local file header: 30 bytes, then file name and extra field
+        f.seek(info.header_offset)
+        header = f.read(30)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if dtype.hasobject:
+        return None
+    if int(np.prod(shape)) == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape,
+                     order='F' if fortran_order else 'C', offset=offset)
+
+
+class FrameWriter():
+    '''
+    writes a frame of num_rows rows chunk by chunk with bounded memory, e.g.
+        with FrameWriter(path, num_rows) as writer:
+            for df in chunks:
+                writer.write(df)
+    feather: one arrow record batch per chunk
+    npz: every column goes to its own memory-mapped .npy next to path,
+         and the columns are zipped into the .npz on close
+    column dtypes are fixed by the first chunk. object columns are not supported for npz
+    '''
+    def __init__(self, path, num_rows):
+        self.path = path
+        self.num_rows = num_rows
+        self.num_written = 0
+        self.columns = None
+        self._dtypes = None
+        self._arrow_writer = None
+        self._column_files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(discard=exc_type is not None)
+
+    def write(self, df):
+        if self.columns is None:
+            self._open(df)
+        df = df[self.columns].astype(self._dtypes, copy=False)
+        start, end = self.num_written, self.num_written + len(df)
+        if end > self.num_rows:
+            raise Exception('{} expects {} rows, got more'.format(self.path, self.num_rows))
+        if self._arrow_writer is not None:
+            self._arrow_writer.write_batch(pyarrow.RecordBatch.from_pandas(df, schema=self._schema,
+                                                                           preserve_index=False))
+        else:
+            for (_, column), c in zip(self._column_files, self.columns):
+                column[start:end] = df[c].values
+        self.num_written = end
+
+    def close(self, discard=False):
+        if self._arrow_writer is not None:
+            self._arrow_writer.close()
+            self._arrow_writer = None
+            if discard:
+                os.remove(self.path)
+        elif self.columns is not None and not discard:
+            if self.num_written != self.num_rows:
+                raise Exception('{} expects {} rows, got {}'.format(self.path, self.num_rows, self.num_written))
+            for _, column in self._column_files:
+                column.flush()
+            schema = {'columns': [str(c) for c in self.columns], 'index_name': None}
+            with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+                with zf.open('__schema__.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.array(json.dumps(schema)))
+                with zf.open('__index__.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.arange(self.num_rows))
+                for i, (column_path, _) in enumerate(self._column_files):
+                    zf.write(column_path, 'c{}.npy'.format(i))
+        column_paths = [column_path for column_path, _ in self._column_files]
+        # drop the memmaps before their files go away
+        self._column_files = []
+        for column_path in column_paths:
+            os.remove(column_path)
+
+    def _open(self, df):
+        self.columns = list(df.columns)
+        self._dtypes = df.dtypes.to_dict()
+        if self.path.endswith('.feather'):
+            if feather is None:
+                raise Exception('pyarrow is required to write {}'.format(self.path))
+            self._schema = pyarrow.Schema.from_pandas(df, preserve_index=False)
+            self._arrow_writer = pyarrow.ipc.new_file(self.path, self._schema)
+            return
+        for i, c in enumerate(self.columns):
+            if df[c].dtype == object:
+                raise Exception('column {} has object dtype, which FrameWriter cannot stream to npz'.format(c))
+            column_path = '{}.c{}.tmp.npy'.format(self.path, i)
+            column = np.lib.format.open_memmap(column_path, mode='w+', dtype=df[c].dtype,
+                                               shape=(self.num_rows,))
+            self._column_files.append((column_path, column))
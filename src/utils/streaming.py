@@ -0,0 +1,283 @@
+import numpy as np
+import pandas as pd
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import IncrementalPCA
+from constants import *
+from utils.storage import FrameWriter, save_frame
+
+X_COLS = [c for c in ALL_VALUES if c not in OUTCOMES and c not in INTERVENTIONS]
+CLUSTER_COLS = [c for c in X_COLS if c not in COLS_NOT_FOR_CLUSTERING]
+# principal components, as named by utils.apply_pca
+PCA_COLS = ['pc{}'.format(i) for i in range(len(CLUSTER_COLS))]
+NORMALIZED_COLS = [c for c in COLS_TO_BE_NORMALIZED_PLUS if c in X_COLS]
+# INTEGER_COLS without age and SOFA, which are fractional in the raw extract
+INT_COLS = [c for c in ALL_VALUES if c in OUTCOMES + ['bloc', 'icustayid'] or c in COLS_NOT_FOR_CLUSTERING]
+# columns the first pass keeps a reservoir sample of
+STATS_COLS = COLS_TO_BE_LOGGED + ['input_4hourly_tev', 'median_dose_vaso']
+
+
+class StreamingPreprocessor():
+    '''
+    out-of-core version of utils._process_data for extracts that do not fit in memory
+
+    the raw csv files are read in chunks of chunksize rows, several times:
+        1. stats: row counts, a uniform reservoir sample of the columns whose
+           quantiles are needed (1%/99% clip bounds, qcut edges of the actions)
+           and the minima that give the finite min of the logged columns
+        2. moments: exact mean/std of the corrected train columns (Chan's merge of chunk moments).
+           they depend on the clip bounds, so they cannot be collected in pass 1
+        3. fit: MiniBatchKMeans.partial_fit on shuffled mini-batches of every chunk,
+           IncrementalPCA.partial_fit for the pca variant
+        4. fit pca: MiniBatchKMeans.partial_fit on the pca projection
+        5. write: assign states and write every output frame chunk by chunk
+    memory is bounded by chunksize and reservoir_size, not by the extract.
+    an extract with at most reservoir_size train rows gets the exact quantiles,
+    so only the clustering differs from the in-memory pipeline
+    '''
+    def __init__(self, num_states, chunksize=50000, reservoir_size=500000,
+                 batch_size=1024, num_epochs=1, with_pca=True, random_state=0):
+        '''
+        num_epochs: passes over the train data per MiniBatchKMeans fit
+        '''
+        self.num_states = num_states
+        self.chunksize = chunksize
+        self.reservoir_size = reservoir_size
+        self.batch_size = batch_size
+        self.num_epochs = num_epochs
+        self.with_pca = with_pca
+        self.rng = np.random.default_rng(random_state)
+        self.kmeans = MiniBatchKMeans(n_clusters=num_states, batch_size=batch_size,
+                                      init_size=3 * num_states, random_state=random_state)
+        self.kmeans_pca = MiniBatchKMeans(n_clusters=num_states, batch_size=batch_size,
+                                          init_size=3 * num_states, random_state=random_state)
+        self.pca = IncrementalPCA(n_components=len(CLUSTER_COLS))
+
+    def run(self, train_path, val_path, out_paths):
+        '''
+        out_paths: output files of, in order, the cleansed train and val frames, the centroids
+                   and the same three for the pca variant. the format follows the extension
+        '''
+        self.fit(train_path, val_path)
+        self.write(train_path, out_paths[0], out_paths[3], 'train')
+        self.write(val_path, out_paths[1], out_paths[4], 'val')
+        save_frame(self.centroids(), out_paths[2])
+        if self.with_pca:
+            save_frame(self.centroids(pca=True), out_paths[5])
+
+    def fit(self, train_path, val_path):
+        print('streaming pass 1: quantiles and minima')
+        self._collect_stats(train_path, val_path)
+        print('streaming pass 2: moments')
+        self._collect_moments(train_path)
+        print('streaming pass 3: clustering')
+        self._fit_clusters(train_path)
+        if self.with_pca:
+            print('streaming pass 4: clustering pca features')
+            self._fit_pca_clusters(train_path)
+
+    def centroids(self, pca=False):
+        kmeans = self.kmeans_pca if pca else self.kmeans
+        return pd.DataFrame(kmeans.cluster_centers_, columns=PCA_COLS if pca else CLUSTER_COLS)
+
+    def write(self, path, out_path, out_pca_path, split):
+        print('streaming pass 5: writing {}'.format(out_path))
+        num_rows = self.num_rows[split]
+        writer = FrameWriter(out_path, num_rows)
+        pca_writer = FrameWriter(out_pca_path, num_rows) if self.with_pca else None
+        try:
+            for df in self._read_chunks(path):
+                X, mu, y = self._transform(df, split)
+                X_to_cluster = X[CLUSTER_COLS].values
+                state = pd.Series(self.kmeans.predict(X_to_cluster), name='state', index=X.index)
+                writer.write(pd.concat([state, X, mu, y], axis=1))
+                if pca_writer is not None:
+                    X_pca = pd.DataFrame(self.pca.transform(X_to_cluster), columns=PCA_COLS, index=X.index)
+                    state_pca = pd.Series(self.kmeans_pca.predict(X_pca.values), name='state', index=X.index)
+                    pca_writer.write(pd.concat([state_pca, mu, X[COLS_NOT_FOR_CLUSTERING], X_pca, y], axis=1))
+        except BaseException:
+            writer.close(discard=True)
+            if pca_writer is not None:
+                pca_writer.close(discard=True)
+            raise
+        writer.close()
+        if pca_writer is not None:
+            pca_writer.close()
+
+    def _read_chunks(self, path):
+        for df in pd.read_csv(path, chunksize=self.chunksize, usecols=ALL_VALUES):
+            # fixed dtypes so every chunk matches the first one written
+            float_cols = [c for c in ALL_VALUES if c not in INT_COLS]
+            df[INT_COLS] = df[INT_COLS].astype(np.int64)
+            df[float_cols] = df[float_cols].astype(float)
+            assert not df.isnull().values.any(), "there's null values in {}".format(path)
+            yield df
+
+    def _collect_stats(self, train_path, val_path):
+        self.num_rows = {}
+        # raw minimum and minimum positive value of every stats column, per split
+        self.minima = {}
+        reservoir = np.empty((self.reservoir_size, len(STATS_COLS)))
+        for split, path in [('train', train_path), ('val', val_path)]:
+            num_rows = 0
+            min_all = np.full(len(STATS_COLS), np.inf)
+            min_pos = np.full(len(STATS_COLS), np.inf)
+            for df in self._read_chunks(path):
+                values = df[STATS_COLS].values
+                min_all = np.minimum(min_all, values.min(axis=0))
+                min_pos = np.minimum(min_pos, np.where(values > 0, values, np.inf).min(axis=0))
+                if split == 'train':
+                    self._fill_reservoir(reservoir, values, num_rows)
+                num_rows += len(df)
+            self.num_rows[split] = num_rows
+            self.minima[split] = (min_all, min_pos)
+        sample = pd.DataFrame(reservoir[:min(self.num_rows['train'], self.reservoir_size)],
+                              columns=STATS_COLS)
+        # same linear interpolation as describe(percentiles=[.01, .99]) in correct_data
+        bounds = sample[COLS_TO_BE_LOGGED].quantile([.01, .99])
+        self.clip_low = bounds.loc[.01].values
+        self.clip_high = bounds.loc[.99].values
+        num_logged = len(COLS_TO_BE_LOGGED)
+        self.finite_min = {split: self._finite_min(min_all[:num_logged], min_pos[:num_logged])
+                           for split, (min_all, min_pos) in self.minima.items()}
+        # the lowest qcut edge is the exact minimum, the sample may have missed it
+        min_pos_train = dict(zip(STATS_COLS, self.minima['train'][1]))
+        self.iv_bin_edges = _action_bin_edges(sample['input_4hourly_tev'].values,
+                                              min_pos_train['input_4hourly_tev'])
+        self.vaso_bin_edges = _action_bin_edges(sample['median_dose_vaso'].values,
+                                                min_pos_train['median_dose_vaso'])
+
+    def _fill_reservoir(self, reservoir, rows, num_seen):
+        '''
+        algorithm R, vectorized over the rows of a chunk
+        '''
+        size = reservoir.shape[0]
+        num_fill = max(0, min(size - num_seen, rows.shape[0]))
+        reservoir[num_seen:num_seen + num_fill] = rows[:num_fill]
+        rest = rows[num_fill:]
+        if rest.shape[0] == 0:
+            return
+        # row i of the stream replaces a uniform slot with probability size / (i + 1)
+        seen = num_seen + num_fill + np.arange(rest.shape[0])
+        slots = (self.rng.random(rest.shape[0]) * (seen + 1)).astype(np.int64)
+        replace = slots < size
+        reservoir[slots[replace]] = rest[replace]
+
+    def _finite_min(self, min_all, min_pos):
+        '''
+        finite min of log(clip(x, low, high)), i.e. the min over clipped values that are positive
+        '''
+        with np.errstate(divide='ignore'):
+            return np.where(self.clip_low > 0,
+                            np.log(np.clip(min_all, self.clip_low, self.clip_high)),
+                            np.log(np.clip(min_pos, self.clip_low, self.clip_high)))
+
+    def _correct(self, df, split):
+        '''
+        correct_data on a chunk
+        '''
+        df['sedation'] = df['sedation'].clip(0.0)
+        with np.errstate(divide='ignore'):
+            logged = np.log(np.clip(df[COLS_TO_BE_LOGGED].values, self.clip_low, self.clip_high))
+        df[COLS_TO_BE_LOGGED] = np.maximum(logged, self.finite_min[split])
+        return df
+
+    def _collect_moments(self, train_path):
+        n = 0
+        mean = np.zeros(len(NORMALIZED_COLS))
+        m2 = np.zeros(len(NORMALIZED_COLS))
+        for df in self._read_chunks(train_path):
+            values = self._correct(df, 'train')[NORMALIZED_COLS].values
+            n_chunk = values.shape[0]
+            mean_chunk = values.mean(axis=0)
+            m2_chunk = np.sum((values - mean_chunk) ** 2, axis=0)
+            delta = mean_chunk - mean
+            total = n + n_chunk
+            mean = mean + delta * n_chunk / total
+            m2 = m2 + m2_chunk + delta ** 2 * n * n_chunk / total
+            n = total
+        self.norm_means = mean
+        # population std like np.std in normalize_data
+        self.norm_stds = np.sqrt(m2 / n)
+
+    def _transform(self, df, split):
+        '''
+        correct, normalize and separate a chunk like correct_data, normalize_data and separate_X_mu_y
+        '''
+        df = self._correct(df, split)
+        df[NORMALIZED_COLS] = (df[NORMALIZED_COLS].values - self.norm_means) / self.norm_stds
+        mu = df[INTERVENTIONS].copy()
+        bins_vaso = _discretize_actions(mu['median_dose_vaso'].values, self.vaso_bin_edges)
+        bins_iv = _discretize_actions(mu['input_4hourly_tev'].values, self.iv_bin_edges)
+        mu['action'] = bins_vaso * 5 + bins_iv
+        mu['action_vaso'] = bins_vaso
+        mu['action_iv'] = bins_iv
+        return df[X_COLS], mu, df[OUTCOMES]
+
+    def _minibatches(self, X):
+        X = X[self.rng.permutation(X.shape[0])]
+        for start in range(0, X.shape[0], self.batch_size):
+            yield X[start:start + self.batch_size]
+
+    def _partial_fit(self, kmeans, X, buffer):
+        '''
+        the first partial_fit initializes the centroids, so it gets init_size rows at once
+        buffer: rows held back until there are enough of them for the initialization
+        '''
+        if not hasattr(kmeans, 'cluster_centers_'):
+            buffer.append(X)
+            X = np.concatenate(buffer)
+            if X.shape[0] < kmeans.init_size:
+                return
+            del buffer[:]
+            X = X[self.rng.permutation(X.shape[0])]
+            kmeans.partial_fit(X[:kmeans.init_size])
+            X = X[kmeans.init_size:]
+        for batch in self._minibatches(X):
+            kmeans.partial_fit(batch)
+
+    def _fit_clusters(self, train_path):
+        buffer = []
+        pca_buffer = []
+        for epoch in range(self.num_epochs):
+            for df in self._read_chunks(train_path):
+                X_to_cluster = self._transform(df, 'train')[0][CLUSTER_COLS].values
+                self._partial_fit(self.kmeans, X_to_cluster, buffer)
+                if self.with_pca and epoch == 0:
+                    # every batch needs at least n_components rows
+                    pca_buffer.append(X_to_cluster)
+                    if sum(X.shape[0] for X in pca_buffer) >= self.pca.n_components:
+                        self.pca.partial_fit(np.concatenate(pca_buffer))
+                        pca_buffer = []
+        if len(buffer) > 0:
+            raise Exception('{} train rows are too few to initialize {} clusters'.format(
+                            self.num_rows['train'], self.num_states))
+
+    def _fit_pca_clusters(self, train_path):
+        buffer = []
+        for epoch in range(self.num_epochs):
+            for df in self._read_chunks(train_path):
+                X_to_cluster = self._transform(df, 'train')[0][CLUSTER_COLS].values
+                self._partial_fit(self.kmeans_pca, self.pca.transform(X_to_cluster), buffer)
+        if len(buffer) > 0:
+            raise Exception('{} train rows are too few to initialize {} clusters'.format(
+                            self.num_rows['train'], self.num_states))
+
+
+def _action_bin_edges(values, min_positive, num_bins=5):
+    '''
+    bounds of get_action_discretization_rules: the qcut edges of the positive
+    values with 0 prepended and the last edge opened up to inf
+    '''
+    edges = np.quantile(values[values > 0], np.linspace(0, 1, num_bins))
+    edges[0] = min_positive
+    edges = np.insert(edges, 0, 0.0)
+    edges[-1] = np.inf
+    return edges
+
+
+def _discretize_actions(values, bin_edges):
+    '''
+    discretize_actions without pandas: right-closed bins, the lowest edge included
+    '''
+    bins = np.searchsorted(bin_edges, values, side='left') - 1
+    return np.clip(bins, 0, len(bin_edges) - 2)
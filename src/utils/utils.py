@@ -1,16 +1,26 @@
 import os, errno
+import glob
 import datetime
+import functools
+from collections.abc import Mapping
 import numpy as np
 import numba as nb
 import pandas as pd
 
 from scipy import stats
+from scipy import sparse
 from sklearn.decomposition import PCA
-from sklearn.cluster import MiniBatchKMeans
+from sklearn.cluster import MiniBatchKMeans, KMeans
+from sklearn.metrics import adjusted_rand_score
+from threadpoolctl import threadpool_limits
+from multiprocessing import Pool
 from sklearn import preprocessing
 from constants import *
 import pickle
 from kmodes.kprototypes import KPrototypes
+from utils.storage import save_frame, load_frame, frame_path
+from utils.streaming import StreamingPreprocessor
+from utils.state_encoder import StateEncoder
 
 def check_numerical_categorical(all_cols, categorical_cols, numerical_cols):
     check1 = (set(numerical_cols) - set(all_cols))
@@ -40,158 +50,95 @@ def detect_binary_value_columns(df):
 
 
 def load_data(generate_new_data=False,
-              num_states=(NUM_STATES-NUM_TERMINAL_STATES)):
-    # @todo append num_states to filename
-    if not generate_new_data and os.path.isfile(TRAIN_CLEANSED_DATA_FILEPATH) and os.path.isfile(VALIDATE_CLEANSED_DATA_FILEPATH):
+              num_states=(NUM_STATES-NUM_TERMINAL_STATES),
+              cache=None,
+              mmap=False,
+              chunksize=None,
+              num_seeds=1):
+    '''
+    returns {variant: {split: df}} for the variants 'kmeans' and 'kmeans_pca' and the
+    splits 'train', 'val', 'centroids' and 'full' (train and val concatenated).
+    each variant is a LazyFrames, so a frame is only read on first access
+    cache: utils.cache.ArtifactCache. if given, the processed frames are keyed on
+           num_states and the raw csv files instead of the fixed file names in constants.py
+    processed frames are kept in typed columnar files (see utils.storage)
+    mmap: memory-map them instead of reading them into memory
+    chunksize: process the raw csv files out of core in chunks of this many rows
+               (see utils.streaming). the frames are then never held in memory during processing
+    num_seeds: k-means seeds fitted in parallel, the one with the lowest held-out inertia is kept
+    the fitted k-means estimators and the utils.state_encoder.StateEncoder of each variant are pickled
+    next to the frames (constants.KMEANS_MODEL_FILEPATH, STATE_ENCODER_FILEPATH, ... or <key>_kmeans.pkl,
+    <key>_encoder.pkl, ... in the cache) so states can be assigned without rerunning the preprocessing
+    '''
+    splits = ['train', 'val', 'centroids']
+    if cache is not None:
+        # version 2: the kmeans_pca frames hold the pca states and features
+        params = {'num_states': num_states, 'version': 2}
+        deps = [cache.file_dep(TRAIN_FILEPATH), cache.file_dep(VALIDATE_FILEPATH)]
+        if chunksize is not None:
+            # streamed frames differ slightly from the in-memory ones (sampled quantiles, online k-means)
+            params['chunksize'] = chunksize
+        elif num_seeds > 1:
+            params['num_seeds'] = num_seeds
+        key = cache.key('load_data', params, deps)
+        model_paths = [os.path.join(cache.root, key + suffix) for suffix in
+                       ['_kmeans.pkl', '_kmeans_pca.pkl', '_encoder.pkl', '_encoder_pca.pkl']]
+        if chunksize is not None:
+            cache.get_or_write('load_data',
+                               functools.partial(_process_data_streaming, num_states, chunksize, model_paths=model_paths),
+                               ['frame'] * 6, params=params, deps=deps, force=generate_new_data)
+            loaders = [functools.partial(cache.load_part, key, i) for i in range(6)]
+        elif generate_new_data or key not in cache:
+            frames = cache.get_or_compute('load_data', lambda: _process_data(num_states, num_seeds, model_paths),
+                                          params=params, deps=deps, force=generate_new_data)
+            loaders = [functools.partial(_identity, df) for df in frames]
+        else:
+            print('loading preprocessed data as they already exist')
+            loaders = [functools.partial(cache.load_part, key, i) for i in range(6)]
+    elif not generate_new_data and _has_data(TRAIN_CLEANSED_DATA_FILEPATH) and _has_data(VALIDATE_CLEANSED_DATA_FILEPATH):
         print('loading preprocessed data as they already exist')
-        df_cleansed_train = _load_data(TRAIN_CLEANSED_DATA_FILEPATH)
-        df_cleansed_val = _load_data(VALIDATE_CLEANSED_DATA_FILEPATH)
-        df_centroids_train = _load_data(TRAIN_CENTROIDS_DATA_FILEPATH)
+        loaders = [functools.partial(_load_data, path, mmap) for path in
+                   [TRAIN_CLEANSED_DATA_FILEPATH, VALIDATE_CLEANSED_DATA_FILEPATH, TRAIN_CENTROIDS_DATA_FILEPATH]] + \
+                  [functools.partial(_load_pca_data, path, mmap) for path in
+                   [TRAIN_CLEANSED_PCA_DATA_FILEPATH, VALIDATE_CLEANSED_PCA_DATA_FILEPATH,
+                    TRAIN_CENTROIDS_PCA_DATA_FILEPATH]]
 
         #df_cleansed_train_kp = _load_data(TRAIN_CLEANSED_KP_DATA_FILEPATH)
         #df_cleansed_val_kp = _load_data(VALIDATE_CLEANSED_KP_DATA_FILEPATH)
         #df_centroids_train_kp = _load_data(TRAIN_CENTROIDS_KP_DATA_FILEPATH)
-
-        df_cleansed_pca_train = _load_data(TRAIN_CLEANSED_PCA_DATA_FILEPATH)
-        df_cleansed_pca_val = _load_data(VALIDATE_CLEANSED_PCA_DATA_FILEPATH)
-        df_centroids_pca_train = _load_data(TRAIN_CENTROIDS_PCA_DATA_FILEPATH)
+    elif chunksize is not None:
+        paths = [frame_path(path) for path in
+                 [TRAIN_CLEANSED_DATA_FILEPATH, VALIDATE_CLEANSED_DATA_FILEPATH, TRAIN_CENTROIDS_DATA_FILEPATH,
+                  TRAIN_CLEANSED_PCA_DATA_FILEPATH, VALIDATE_CLEANSED_PCA_DATA_FILEPATH,
+                  TRAIN_CENTROIDS_PCA_DATA_FILEPATH]]
+        _process_data_streaming(num_states, chunksize, paths, model_paths=MODEL_FILEPATHS)
+        loaders = [functools.partial(load_frame, path, mmap) for path in paths]
     else:
-        print('processing data from scratch')
-        df_train = _load_data(TRAIN_FILEPATH)
-        df_val = _load_data(VALIDATE_FILEPATH)
-        assert not df_train.isnull().values.any(), "there's null values in df_train"
-        assert not df_val.isnull().values.any(), "there's null values in df_val"
-        print('correcting obvious errors')
-        df_corrected_train, df_corrected_val = correct_data(df_train, df_val)
-        assert not df_corrected_train.isnull().values.any(), "there's null values in df_corrected_train"
-        assert not df_corrected_val.isnull().values.any(), "there's null values in df_corrected_val"
-        print('standardizing data')
-        df_norm_train, df_norm_val = normalize_data(df_corrected_train,
-                                                    df_corrected_val)
-        assert not df_norm_train.isnull().values.any(), "there's null values in df_norm_train"
-        assert not df_norm_val.isnull().values.any(), "there's null values in df_norm_val"
-        # separate x mu y from df
-        X_train, mu_train, y_train, X_val, mu_val, y_val = \
-                separate_X_mu_y(df_norm_train, df_norm_val, ALL_VALUES)
-
-        # save for for pca before clustering
-        X_pca_train = X_train.copy()
-        X_pca_val = X_val.copy()
-
-        # k-means clustering to consturct discrete states
-        print('clustering for states')
-        X_to_cluster_train = X_train.drop(COLS_NOT_FOR_CLUSTERING, axis=1)
-        X_to_cluster_val = X_val.drop(COLS_NOT_FOR_CLUSTERING, axis=1)
-        df_centroids_train, X_clustered_train, X_clustered_val = \
-            clustering(X_to_cluster_train, X_to_cluster_val, k=num_states, batch_size=300)
-
-        # k-means stitching up
+        df_cleansed_train, df_cleansed_val, df_centroids_train, \
+            df_cleansed_pca_train, df_cleansed_pca_val, df_centroids_pca_train = \
+                _process_data(num_states, num_seeds, MODEL_FILEPATHS)
         print('saving processed data')
-        to_concat_train = [X_clustered_train, X_train, mu_train, y_train]
-        to_concat_val = [X_clustered_val, X_val, mu_val, y_val]
-
-        df_cleansed_train = pd.concat(to_concat_train, axis=1)
-        df_cleansed_val = pd.concat(to_concat_val, axis=1)
-        df_centroids_train.to_csv(TRAIN_CENTROIDS_DATA_FILEPATH, index=False)
-        df_cleansed_train.to_csv(TRAIN_CLEANSED_DATA_FILEPATH, index=False)
-        df_cleansed_val.to_csv(VALIDATE_CLEANSED_DATA_FILEPATH, index=False)
-
-        # k-prototyp separate x mu y from df
-        #df_norm_train_kp, df_norm_val_kp = normalize_data(df_corrected_train,
-        #                                                  df_corrected_val,
-        #                                                  normalize_categorical=False)
-        #assert not df_norm_train_kp.isnull().values.any(), "there's null values in df_norm_train"
-        #assert not df_norm_val_kp.isnull().values.any(), "there's null values in df_norm_val"
-
-
-        #X_train_kp, mu_train_kp, y_train_kp, X_val_kp, mu_val_kp, y_val_kp = \
-        #        separate_X_mu_y(df_norm_train_kp, df_norm_val_kp, ALL_VALUES)
-
-        ## k-prototype clustering (Cao) to construct discrete states
-        #print('k prototype clustering')
-        #X_to_cluster_train_kp = X_train_kp.drop(COLS_NOT_FOR_CLUSTERING, axis=1)
-        #X_to_cluster_val_kp = X_val_kp.drop(COLS_NOT_FOR_CLUSTERING, axis=1)
-        ## k-prototyp separate x mu y from df
-        #df_centroids_train_kp, X_clustered_train_kp, X_clustered_val_kp = \
-        #    clustering_kp(X_to_cluster_train_kp, X_to_cluster_val_kp, num_states=num_states)
-
-        ## k-prototype stitching up
-        #print('k prototype stitching up')
-        #to_concat_train_kp = [X_clustered_train_kp, X_train_kp, mu_train_kp, y_train_kp]
-        #to_concat_val_kp = [X_clustered_val_kp, X_val_kp, mu_val_kp, y_val_kp]
-
-        #df_cleansed_train_kp = pd.concat(to_concat_train_kp, axis=1)
-        #df_cleansed_val_kp = pd.concat(to_concat_val_kp, axis=1)
-        #df_centroids_train_kp.to_csv(TRAIN_CENTROIDS_KP_DATA_FILEPATH, index=False)
-        #df_cleansed_train_kp.to_csv(TRAIN_CLEANSED_KP_DATA_FILEPATH, index=False)
-        #df_cleansed_val_kp.to_csv(VALIDATE_CLEANSED_KP_DATA_FILEPATH, index=False)
-
-        # PCA
-        print('applying pca')
-        # remove columns not relevant for pca or clustering
-        X_meta_train = X_pca_train[COLS_NOT_FOR_CLUSTERING].copy().astype(int)
-        X_meta_val = X_pca_val[COLS_NOT_FOR_CLUSTERING].copy().astype(int)
-
-        X_pca_train = X_pca_train.drop(COLS_NOT_FOR_CLUSTERING, axis=1)
-        #X_pca_train.to_csv('pca_train_df', index=False)
-        X_pca_val = X_pca_val.drop(COLS_NOT_FOR_CLUSTERING, axis=1)
-        #X_pca_val.to_csv('pca_val_df', index=False)
-        X_pca_train, X_pca_val  = apply_pca([X_pca_train, X_pca_val])
-
-        # k-means clustering to consturct discrete states
-        print('clustering for pca features')
-        df_centroids_pca_train, X_pca_clustered_train, X_pca_clustered_val = \
-                clustering(X_pca_train, X_pca_val, k=num_states, batch_size=300)
-
-        # stitching up
-        print('saving processed pca data')
-        to_concat_pca_train = [X_pca_clustered_train, mu_train, X_meta_train, X_pca_train, y_train]
-        to_concat_pca_val = [X_pca_clustered_val, mu_val, X_meta_val, X_pca_val, y_val]
-
-        # add one standard deviation stuff
-        df_cleansed_pca_train = pd.concat(to_concat_train, axis=1)
-        df_cleansed_pca_val = pd.concat(to_concat_val, axis=1)
-        df_centroids_pca_train.to_csv(TRAIN_CENTROIDS_PCA_DATA_FILEPATH, index=False)
-        df_cleansed_pca_train.to_csv(TRAIN_CLEANSED_PCA_DATA_FILEPATH, index=False)
-        df_cleansed_pca_val.to_csv(VALIDATE_CLEANSED_PCA_DATA_FILEPATH, index=False)
-
-    assert not df_cleansed_train.isnull().values.any(), "there's null values in df_cleansed_train"
-    assert not df_cleansed_val.isnull().values.any(), "there's null values in df_cleansed_val"
-    assert not df_centroids_train.isnull().values.any(), "there's null values in df_centroids_train"
-
-    assert not df_cleansed_pca_train.isnull().values.any(), "there's null values in df_cleansed_pca_train"
-    assert not df_cleansed_pca_val.isnull().values.any(), "there's null values in df_cleansed_pca_val"
-    assert not df_centroids_pca_train.isnull().values.any(), "there's null values in df_centroids_pca_train"
-
-
-    #assert not df_cleansed_train_kp.isnull().values.any(), "there's null values in df_cleansed_train_kp"
-    #assert not df_cleansed_val_kp.isnull().values.any(), "there's null values in df_cleansed_val_kp"
-    #assert not df_centroids_train_kp.isnull().values.any(), "there's null values in df_centroids_train_kp"
+        save_frame(df_centroids_train, frame_path(TRAIN_CENTROIDS_DATA_FILEPATH))
+        save_frame(df_cleansed_train, frame_path(TRAIN_CLEANSED_DATA_FILEPATH))
+        save_frame(df_cleansed_val, frame_path(VALIDATE_CLEANSED_DATA_FILEPATH))
+        save_frame(df_centroids_pca_train, frame_path(TRAIN_CENTROIDS_PCA_DATA_FILEPATH))
+        save_frame(df_cleansed_pca_train, frame_path(TRAIN_CLEANSED_PCA_DATA_FILEPATH))
+        save_frame(df_cleansed_pca_val, frame_path(VALIDATE_CLEANSED_PCA_DATA_FILEPATH))
+        loaders = [functools.partial(_identity, df) for df in
+                   [df_cleansed_train, df_cleansed_val, df_centroids_train,
+                    df_cleansed_pca_train, df_cleansed_pca_val, df_centroids_pca_train]]
 
     # we don't load full data
     # if need be, it's easy to add them
-    df_full = pd.concat([df_cleansed_train, df_cleansed_val], axis=0, ignore_index=True)
-    #df_full_kp = pd.concat([df_cleansed_train_kp, df_cleansed_val_kp], axis=0, ignore_index=True)
-    df_pca_full = pd.concat([df_cleansed_pca_train, df_cleansed_pca_val], axis=0, ignore_index=True)
     data = {
-        'kmeans': {
-            'train': df_cleansed_train,
-            'val' : df_cleansed_val,
-            'centroids': df_centroids_train,
-            'full': df_full
-           },
+        'kmeans': LazyFrames(dict(zip(splits, loaders[:3]))),
         'kprototype': {
             #'train': df_cleansed_train_kp,
             #'val' : df_cleansed_val_kp,
             #'centroids': df_centroids_train_kp,
             #'full': df_full_kp
         },
-        'kmeans_pca': {
-            'train': df_cleansed_pca_train,
-            'val' : df_cleansed_pca_val,
-            'centroids': df_centroids_pca_train,
-            'full': df_pca_full
-        },
+        'kmeans_pca': LazyFrames(dict(zip(splits, loaders[3:]))),
         'kprototype_pca': {
             # @todo
         }
@@ -199,12 +146,180 @@ def load_data(generate_new_data=False,
 
     return data
 
-def _load_data(path):
+
+class LazyFrames(Mapping):
+    '''
+    the splits of one data variant, each loaded on first access and kept afterwards
+    loaders: {split: callable returning the frame}
+    'full' is the memoized concatenation of 'train' and 'val'
+    '''
+    def __init__(self, loaders):
+        self._loaders = loaders
+        self._frames = {}
+
+    def __getitem__(self, split):
+        if split not in self._frames:
+            if split == 'full':
+                df = pd.concat([self['train'], self['val']], axis=0, ignore_index=True)
+            else:
+                df = self._loaders[split]()
+                assert not df.isnull().values.any(), "there's null values in {}".format(split)
+            self._frames[split] = df
+        return self._frames[split]
+
+    def __iter__(self):
+        return iter(list(self._loaders) + ['full'])
+
+    def __len__(self):
+        return len(self._loaders) + 1
+
+    def is_loaded(self, split):
+        return split in self._frames
+
+
+def _identity(x):
+    return x
+
+def _process_data(num_states, num_seeds=1, model_paths=(None, None, None, None)):
+    '''
+    model_paths: where to pickle the k-means of both variants and their state encoders
+    '''
+    print('processing data from scratch')
+    df_train = _load_data(TRAIN_FILEPATH)
+    df_val = _load_data(VALIDATE_FILEPATH)
+    assert not df_train.isnull().values.any(), "there's null values in df_train"
+    assert not df_val.isnull().values.any(), "there's null values in df_val"
+    # correct_data works in place, so the train-time transforms are taken from the raw frame first
+    encoder = StateEncoder.fit(df_train)
+    print('correcting obvious errors')
+    df_corrected_train, df_corrected_val = correct_data(df_train, df_val)
+    assert not df_corrected_train.isnull().values.any(), "there's null values in df_corrected_train"
+    assert not df_corrected_val.isnull().values.any(), "there's null values in df_corrected_val"
+    print('standardizing data')
+    df_norm_train, df_norm_val = normalize_data(df_corrected_train,
+                                                df_corrected_val)
+    assert not df_norm_train.isnull().values.any(), "there's null values in df_norm_train"
+    assert not df_norm_val.isnull().values.any(), "there's null values in df_norm_val"
+    # separate x mu y from df
+    X_train, mu_train, y_train, X_val, mu_val, y_val = \
+            separate_X_mu_y(df_norm_train, df_norm_val, ALL_VALUES)
+
+    # save for for pca before clustering
+    X_pca_train = X_train.copy()
+    X_pca_val = X_val.copy()
+
+    # k-means clustering to consturct discrete states
+    print('clustering for states')
+    X_to_cluster_train = X_train.drop(COLS_NOT_FOR_CLUSTERING, axis=1)
+    X_to_cluster_val = X_val.drop(COLS_NOT_FOR_CLUSTERING, axis=1)
+    df_centroids_train, X_clustered_train, X_clustered_val = \
+        clustering(X_to_cluster_train, X_to_cluster_val, k=num_states, batch_size=300,
+                   seeds=range(num_seeds), model_path=model_paths[0])
+
+    # k-means stitching up
+    to_concat_train = [X_clustered_train, X_train, mu_train, y_train]
+    to_concat_val = [X_clustered_val, X_val, mu_val, y_val]
+
+    df_cleansed_train = pd.concat(to_concat_train, axis=1)
+    df_cleansed_val = pd.concat(to_concat_val, axis=1)
+
+    # k-prototyp separate x mu y from df
+    #df_norm_train_kp, df_norm_val_kp = normalize_data(df_corrected_train,
+    #                                                  df_corrected_val,
+    #                                                  normalize_categorical=False)
+    #assert not df_norm_train_kp.isnull().values.any(), "there's null values in df_norm_train"
+    #assert not df_norm_val_kp.isnull().values.any(), "there's null values in df_norm_val"
+
+
+    #X_train_kp, mu_train_kp, y_train_kp, X_val_kp, mu_val_kp, y_val_kp = \
+    #        separate_X_mu_y(df_norm_train_kp, df_norm_val_kp, ALL_VALUES)
+
+    ## k-prototype clustering (Cao) to construct discrete states
+    #print('k prototype clustering')
+    #X_to_cluster_train_kp = X_train_kp.drop(COLS_NOT_FOR_CLUSTERING, axis=1)
+    #X_to_cluster_val_kp = X_val_kp.drop(COLS_NOT_FOR_CLUSTERING, axis=1)
+    ## k-prototyp separate x mu y from df
+    #df_centroids_train_kp, X_clustered_train_kp, X_clustered_val_kp = \
+    #    clustering_kp(X_to_cluster_train_kp, X_to_cluster_val_kp, num_states=num_states)
+
+    ## k-prototype stitching up
+    #print('k prototype stitching up')
+    #to_concat_train_kp = [X_clustered_train_kp, X_train_kp, mu_train_kp, y_train_kp]
+    #to_concat_val_kp = [X_clustered_val_kp, X_val_kp, mu_val_kp, y_val_kp]
+
+    #df_cleansed_train_kp = pd.concat(to_concat_train_kp, axis=1)
+    #df_cleansed_val_kp = pd.concat(to_concat_val_kp, axis=1)
+    #df_centroids_train_kp.to_csv(TRAIN_CENTROIDS_KP_DATA_FILEPATH, index=False)
+    #df_cleansed_train_kp.to_csv(TRAIN_CLEANSED_KP_DATA_FILEPATH, index=False)
+    #df_cleansed_val_kp.to_csv(VALIDATE_CLEANSED_KP_DATA_FILEPATH, index=False)
+
+    # PCA
+    print('applying pca')
+    # remove columns not relevant for pca or clustering
+    X_meta_train = X_pca_train[COLS_NOT_FOR_CLUSTERING].copy().astype(int)
+    X_meta_val = X_pca_val[COLS_NOT_FOR_CLUSTERING].copy().astype(int)
+
+    X_pca_train = X_pca_train.drop(COLS_NOT_FOR_CLUSTERING, axis=1)
+    #X_pca_train.to_csv('pca_train_df', index=False)
+    X_pca_val = X_pca_val.drop(COLS_NOT_FOR_CLUSTERING, axis=1)
+    #X_pca_val.to_csv('pca_val_df', index=False)
+    X_pca_train, X_pca_val, pca = apply_pca([X_pca_train, X_pca_val], return_model=True)
+
+    # k-means clustering to consturct discrete states
+    print('clustering for pca features')
+    df_centroids_pca_train, X_pca_clustered_train, X_pca_clustered_val = \
+            clustering(X_pca_train, X_pca_val, k=num_states, batch_size=300,
+                       seeds=range(num_seeds), model_path=model_paths[1])
+
+    # stitching up
+    print('stitching up pca data')
+    to_concat_pca_train = [X_pca_clustered_train, mu_train, X_meta_train, X_pca_train, y_train]
+    to_concat_pca_val = [X_pca_clustered_val, mu_val, X_meta_val, X_pca_val, y_val]
+
+    # add one standard deviation stuff
+    df_cleansed_pca_train = pd.concat(to_concat_pca_train, axis=1)
+    df_cleansed_pca_val = pd.concat(to_concat_pca_val, axis=1)
+    for e, path in [(encoder.with_centroids(df_centroids_train), model_paths[2]),
+                    (encoder.with_centroids(df_centroids_pca_train, pca), model_paths[3])]:
+        if path is not None:
+            e.save(path)
+    return df_cleansed_train, df_cleansed_val, df_centroids_train, \
+            df_cleansed_pca_train, df_cleansed_pca_val, df_centroids_pca_train
+
+def _process_data_streaming(num_states, chunksize, out_paths, model_paths=(None, None, None, None)):
+    print('processing data from scratch in chunks of {} rows'.format(chunksize))
+    preprocessor = StreamingPreprocessor(num_states, chunksize=chunksize)
+    preprocessor.run(TRAIN_FILEPATH, VALIDATE_FILEPATH, out_paths)
+    for model, path in zip([preprocessor.kmeans, preprocessor.kmeans_pca], model_paths[:2]):
+        if path is not None:
+            save_data(model, path)
+    for pca, path in zip([False, True], model_paths[2:]):
+        if path is not None:
+            StateEncoder.from_preprocessor(preprocessor, pca=pca).save(path)
+
+def _has_data(path):
+    return os.path.isfile(frame_path(path)) or os.path.isfile(path)
+
+def _load_data(path, mmap=False):
+    '''
+    reads the columnar copy of the csv at path (see utils.storage).
+    a csv without an up-to-date columnar copy is parsed once and the copy written next to it
+    '''
+    binary_path = frame_path(path)
+    if os.path.isfile(binary_path) and \
+            (not os.path.isfile(path) or os.path.getmtime(binary_path) >= os.path.getmtime(path)):
+        return load_frame(binary_path, mmap)
+    # no integer cast: age and SOFA of INTEGER_COLS are z-scored in the processed csvs
     df = pd.read_csv(path)
-    valid_int_cols = list(set(df.columns) & set(INTEGER_COLS))
-    df[valid_int_cols].astype(np.int)
+    save_frame(df, binary_path)
     return df
 
+def _load_pca_data(path, mmap=False):
+    if not _has_data(path):
+        raise FileNotFoundError('{} not found. the kmeans_pca frames changed layout, '
+                                'rerun with generate_new_data to rebuild them'.format(path))
+    return _load_data(path, mmap)
+
 def initialize_save_data_folder():
     date = datetime.datetime.now().strftime('%Y_%m_%d')
     save_path = DATA_PATH + date + '/'
@@ -218,57 +333,96 @@ def initialize_save_data_folder():
             raise Exception('could not initialize save data folder')
     return save_path
 
-def extract_trajectories(df, num_states, trajectory_filepath, action_column='action'):
+def find_save_data_folder(run_name):
+    '''
+    save folder of an earlier run, found by its checkpoints (see irl.max_margin.run_max_margin)
+    '''
+    paths = sorted(glob.glob('{}*/checkpoints/{}_*'.format(DATA_PATH, run_name)))
+    if len(paths) == 0:
+        raise Exception('no checkpoints of run {} under {}'.format(run_name, DATA_PATH))
+    return os.path.dirname(os.path.dirname(paths[-1])) + '/'
+
+def extract_trajectories(df, num_states, trajectory_filepath, action_column='action', cache=None):
+    '''
+    cache: utils.cache.ArtifactCache. if given, trajectories are keyed on df and the
+           parameters, and trajectory_filepath is ignored
+    '''
     # check if df for binary variables are okay
+    if cache is not None:
+        return cache.get_or_compute('trajectories',
+                                    lambda: _extract_trajectories(df, num_states, action_column),
+                                    params={'num_states': num_states, 'action_column': action_column},
+                                    deps=[df])
     if os.path.isfile(trajectory_filepath):
         trajectories = np.load(trajectory_filepath)
     else:
         print('extract trajectories')
         trajectories = _extract_trajectories(df, num_states, action_column)
         np.save(trajectory_filepath, trajectories)
-    trajectories = trajectories.astype(np.int)
+    trajectories = trajectories.astype(int)
     return trajectories
 
+def extract_multi_action_trajectories(df, num_states, action_columns, cache=None):
+    '''
+    extract_trajectories for several action columns of the same df at once,
+    e.g. ['action', 'action_vaso', 'action_iv']. states, rewards and next states
+    are shared, so the sort and episode boundaries are computed only once
+    returns: a tuple with one trajectory array per action column
+    '''
+    if cache is not None:
+        return cache.get_or_compute('trajectories_multi',
+                                    lambda: _extract_multi_action_trajectories(df, num_states, action_columns),
+                                    params={'num_states': num_states, 'action_columns': list(action_columns)},
+                                    deps=[df])
+    return _extract_multi_action_trajectories(df, num_states, action_columns)
+
 def _extract_trajectories(df, num_states, action_column):
     '''
     a few strong assumptions are made here.
     1. we consider those who died in 90 days but not in hopsital to have the same status as alive. hence we give reward of one. Worry not. we can change back. this assumption was to be made to account for uncertainty in the cause of dealth after leaving the hospital
     '''
-    cols = ['icustayid', 's', 'a', 'r', 'new_s']
-    df = df.sort_values(['icustayid', 'bloc'])
-    groups = df.groupby('icustayid')
-    trajectories = pd.DataFrame(np.zeros((df.shape[0], len(cols))), columns=cols)
-    trajectories.loc[:, 'icustayid'] = df['icustayid']
-    trajectories.loc[:, 's'] = df['state']
-    trajectories.loc[:, 'a'] = df[action_column]
+    return _extract_multi_action_trajectories(df, num_states, [action_column])[0]
 
-    # reward function
-    DEFAULT_REWARD = 0
-    trajectories.loc[:, 'r'] = DEFAULT_REWARD
-    terminal_steps = groups.tail(1).index
-    is_terminal = df.isin(df.iloc[terminal_steps, :]).iloc[:, 0]
-    died_in_hosp = df[OUTCOMES[0]] == 1
-    died_in_90d = df[OUTCOMES[1]] == 1
-    # reward for those who survived (order matters)
-    trajectories.loc[is_terminal, 'r'] = 1
-    trajectories.loc[is_terminal & died_in_hosp, 'r'] = -1
-
-    # TODO: vectorize this
-    new_s = pd.Series([])
-    for name, g in groups:
-        # add three imaginary states
-        # to simplify, we use died_in_hosp_only
-        if np.any(g['died_in_hosp'] == 1):
-            terminal_marker = TERMINAL_STATE_DEAD
-        else:
-            # survived
-            terminal_marker = TERMINAL_STATE_ALIVE
-        new_s_sequence = g['state'].shift(-1)
-        new_s_sequence.iloc[-1] = terminal_marker
-        new_s = pd.concat([new_s, new_s_sequence])
-    trajectories.loc[:, 'new_s'] = new_s.astype(np.int)
+def _extract_multi_action_trajectories(df, num_states, action_columns):
+    '''
+    one pass over df sorted by (icustayid, bloc):
+        new_s: the next row's state within the same stay, shift(-1) on the sorted frame
+        the last row of a stay moves to TERMINAL_STATE_DEAD if the patient died in hospital
+        during the stay, else to TERMINAL_STATE_ALIVE, and gets reward -1 or 1 respectively
+    rows of the returned (icustayid, s, a, r, new_s) int arrays follow the row order of df
+    '''
+    order = np.lexsort((df['bloc'].values, df['icustayid'].values))
+    icustayid = df['icustayid'].values[order]
+    state = df['state'].values[order].astype(int)
+    died_in_hosp = df[OUTCOMES[0]].values[order] == 1
+
+    is_last = np.ones(len(order), dtype=bool)
+    is_last[:-1] = icustayid[1:] != icustayid[:-1]
+    stay_start = np.flatnonzero(np.concatenate([[True], is_last[:-1]]))
+    stay_id = np.cumsum(np.concatenate([[0], is_last[:-1]]))
+    # to simplify, we use died_in_hosp_only
+    stay_died = np.maximum.reduceat(died_in_hosp, stay_start) if len(order) > 0 else died_in_hosp
+
+    new_s = np.empty_like(state)
+    new_s[:-1] = state[1:]
+    terminal_marker = np.where(stay_died[stay_id], TERMINAL_STATE_DEAD, TERMINAL_STATE_ALIVE)
+    new_s[is_last] = terminal_marker[is_last]
 
-    return trajectories.as_matrix()
+    # reward for those who survived (order matters)
+    DEFAULT_REWARD = 0
+    r = np.full(len(order), DEFAULT_REWARD)
+    r[is_last] = 1
+    r[is_last & died_in_hosp] = -1
+
+    trajectories = []
+    for action_column in action_columns:
+        sorted_trajectories = np.stack([icustayid.astype(int), state,
+                                        df[action_column].values[order].astype(int), r, new_s], axis=1)
+        # back to the row order of df
+        t = np.empty_like(sorted_trajectories)
+        t[order] = sorted_trajectories
+        trajectories.append(t)
+    return tuple(trajectories)
 
 def normalize_data(df_train, df_val, normalize_categorical=True):
     # divide cols: numerical, categorical, text data
@@ -361,63 +515,73 @@ def separate_X_mu_y(df_train, df_val, cols=None):
     return X_train, mu_train, y_train, X_val, mu_val, y_val
 
 
-def get_sd_away_bins(df):
+def get_sd_away_bins(df, cache=None):
+    '''
+    cache: utils.cache.ArtifactCache. if given, the bins are keyed on df
+           instead of the fixed STD_BINS_*_FILEPATH files
+    '''
+    if cache is not None:
+        return cache.get_or_compute('sd_away_bins', lambda: _compute_sd_away_bins(df), deps=[df])
     if os.path.isfile(STD_BINS_IV_FILEPATH) and os.path.isfile(STD_BINS_VASO_FILEPATH):
         df_iv = pd.read_csv(STD_BINS_IV_FILEPATH)
         df_vaso = pd.read_csv(STD_BINS_VASO_FILEPATH)
     else:
-
-        # bin a data point one s.d. away to the left from the observed  data point
-        # additional analysis to account for binning error
-        state_groups = df.groupby(['state'])
-        # per state standard deviation
-        # find std in the original feature space before binning
-        iv_sd = state_groups['input_4hourly_tev'].std()
-        vaso_sd = state_groups['median_dose_vaso'].std()
-        # find mode in the original feature space before binning
-        iv_mode = state_groups['input_4hourly_tev'].agg(lambda x:x.value_counts().index[0])
-        vaso_mode = state_groups['median_dose_vaso'].agg(lambda x:x.value_counts().index[0])
-        # find binning criteria
-        iv_bin_edges, vaso_bin_edges = get_action_discretization_rules(df['input_4hourly_tev'],
-                                                                       df['median_dose_vaso'])
-        # find std bins
-        vaso_low = df['median_dose_vaso'].min()
-        vaso_high = df['median_dose_vaso'].max()
-        iv_low = df['input_4hourly_tev'].min()
-        iv_high = df['input_4hourly_tev'].max()
-
-        bin_vaso_sd_l, bin_vaso_mode, bin_vaso_sd_r = _get_sd_away_bins(vaso_mode,
-                                                                        vaso_sd,
-                                                                        vaso_low,
-                                                                        vaso_high,
-                                                                        vaso_bin_edges)
-
-        bin_iv_sd_l, bin_iv_mode, bin_iv_sd_r = _get_sd_away_bins(iv_mode,
-                                                                  iv_sd,
-                                                                  iv_low,
-                                                                  iv_high,
-                                                                  iv_bin_edges)
-        bin_vaso_sd_l.name = 'action_vaso_sd_left'
-        bin_vaso_mode.name = 'action_vaso'
-        bin_vaso_sd_r.name = 'action_vaso_sd_right'
-
-        bin_iv_sd_l.name = 'action_iv_sd_left'
-        bin_iv_mode.name = 'action_iv'
-        bin_iv_sd_r.name = 'action_iv_sd_right'
-        df_vaso = pd.concat([bin_vaso_sd_l, bin_vaso_mode, bin_vaso_sd_r], axis=1)
-        df_iv = pd.concat([bin_iv_sd_l, bin_iv_mode, bin_iv_sd_r], axis=1)
-
-        num_bins = 5
-        df_iv.loc[df_iv['action_iv_sd_left'] != df_iv['action_iv'], 'action_iv_sd_left'] = (df_iv['action_iv'].copy() - 1).clip(0, num_bins-1)
-        df_iv.loc[df_iv['action_iv_sd_right'] != df_iv['action_iv'], 'action_iv_sd_right'] = (df_iv['action_iv'].copy() + 1).clip(0, num_bins-1)
-        df_vaso.loc[df_vaso['action_vaso_sd_left'] != df_vaso['action_vaso'], 'action_vaso_sd_left'] = (df_vaso['action_vaso'].copy() - 1).clip(0, num_bins-1)
-        df_vaso.loc[df_vaso['action_vaso_sd_right'] != df_vaso['action_vaso'], 'action_vaso_sd_right'] = (df_vaso['action_vaso'].copy() + 1).clip(0, num_bins-1)
-
+        df_vaso, df_iv = _compute_sd_away_bins(df)
         df_vaso.to_csv(STD_BINS_VASO_FILEPATH, index=False)
         df_iv.to_csv(STD_BINS_IV_FILEPATH, index=False)
     return df_vaso, df_iv
 
 
+def _compute_sd_away_bins(df):
+    # bin a data point one s.d. away to the left from the observed  data point
+    # additional analysis to account for binning error
+    state_groups = df.groupby(['state'])
+    # per state standard deviation
+    # find std in the original feature space before binning
+    iv_sd = state_groups['input_4hourly_tev'].std()
+    vaso_sd = state_groups['median_dose_vaso'].std()
+    # find mode in the original feature space before binning
+    iv_mode = state_groups['input_4hourly_tev'].agg(lambda x:x.value_counts().index[0])
+    vaso_mode = state_groups['median_dose_vaso'].agg(lambda x:x.value_counts().index[0])
+    # find binning criteria
+    iv_bin_edges, vaso_bin_edges = get_action_discretization_rules(df['input_4hourly_tev'],
+                                                                   df['median_dose_vaso'])
+    # find std bins
+    vaso_low = df['median_dose_vaso'].min()
+    vaso_high = df['median_dose_vaso'].max()
+    iv_low = df['input_4hourly_tev'].min()
+    iv_high = df['input_4hourly_tev'].max()
+
+    bin_vaso_sd_l, bin_vaso_mode, bin_vaso_sd_r = _get_sd_away_bins(vaso_mode,
+                                                                    vaso_sd,
+                                                                    vaso_low,
+                                                                    vaso_high,
+                                                                    vaso_bin_edges)
+
+    bin_iv_sd_l, bin_iv_mode, bin_iv_sd_r = _get_sd_away_bins(iv_mode,
+                                                              iv_sd,
+                                                              iv_low,
+                                                              iv_high,
+                                                              iv_bin_edges)
+    bin_vaso_sd_l.name = 'action_vaso_sd_left'
+    bin_vaso_mode.name = 'action_vaso'
+    bin_vaso_sd_r.name = 'action_vaso_sd_right'
+
+    bin_iv_sd_l.name = 'action_iv_sd_left'
+    bin_iv_mode.name = 'action_iv'
+    bin_iv_sd_r.name = 'action_iv_sd_right'
+    df_vaso = pd.concat([bin_vaso_sd_l, bin_vaso_mode, bin_vaso_sd_r], axis=1)
+    df_iv = pd.concat([bin_iv_sd_l, bin_iv_mode, bin_iv_sd_r], axis=1)
+
+    num_bins = 5
+    df_iv.loc[df_iv['action_iv_sd_left'] != df_iv['action_iv'], 'action_iv_sd_left'] = (df_iv['action_iv'].copy() - 1).clip(0, num_bins-1)
+    df_iv.loc[df_iv['action_iv_sd_right'] != df_iv['action_iv'], 'action_iv_sd_right'] = (df_iv['action_iv'].copy() + 1).clip(0, num_bins-1)
+    df_vaso.loc[df_vaso['action_vaso_sd_left'] != df_vaso['action_vaso'], 'action_vaso_sd_left'] = (df_vaso['action_vaso'].copy() - 1).clip(0, num_bins-1)
+    df_vaso.loc[df_vaso['action_vaso_sd_right'] != df_vaso['action_vaso'], 'action_vaso_sd_right'] = (df_vaso['action_vaso'].copy() + 1).clip(0, num_bins-1)
+
+    return df_vaso, df_iv
+
+
 def _get_sd_away_bins(df_mode, df_sd, low, high, bin_edges):
     '''
     binning iv, vaso
@@ -430,7 +594,7 @@ def _get_sd_away_bins(df_mode, df_sd, low, high, bin_edges):
     return l, m, r
 
 
-def apply_pca(dataframes, n_components=None):
+def apply_pca(dataframes, n_components=None, return_model=False):
     if n_components is None:
         n_components = len(dataframes[0].columns)
     pca = PCA(n_components=n_components)
@@ -438,8 +602,10 @@ def apply_pca(dataframes, n_components=None):
     pca.fit(dataframes[0])
     pca_results = []
     for df in dataframes:
-        X_pca = pd.DataFrame(pca.transform(df), columns=df.columns)
+        X_pca = pd.DataFrame(pca.transform(df), columns=['pc{}'.format(i) for i in range(pca.n_components_)])
         pca_results.append(X_pca)
+    if return_model:
+        return pca_results + [pca]
     return pca_results
 
 
@@ -450,15 +616,19 @@ def inverse_pca(df, n_components=None):
     X = p.fit_transform(df)
     return p.inverse_transform(X)
 
-def clustering(X_train, X_val, k=750, batch_size=300, minibatch=True):
-    if minibatch:
-        # pick only numerical columns that make sense
-        mbk = MiniBatchKMeans(n_clusters=k, batch_size=batch_size, init_size=k*3)
-    else:
-        mbk = KMeans(n_clusters=k, random_state=0, n_jobs=7)
+def clustering(X_train, X_val, k=750, batch_size=300, minibatch=True, seeds=(0,),
+               num_processes=None, model_path=None):
+    '''
+    fits one k-means per seed and keeps the one with the lowest held-out inertia (see select_clustering)
+    model_path: pickle the kept estimator there so states can be predicted without refitting
+    '''
+    report, mbk = select_clustering(X_train, X_val, [k], seeds, batch_size=batch_size,
+                                    minibatch=minibatch, num_processes=num_processes)
+    if len(report) > 1:
+        print(report.to_string(index=False))
+    if model_path is not None:
+        save_data(mbk, model_path)
 
-    # fit only on train
-    mbk.fit(X_train)
     X_centroids_train = mbk.cluster_centers_
     df_centroids_train = pd.DataFrame(X_centroids_train, columns=X_train.columns)
 
@@ -466,6 +636,66 @@ def clustering(X_train, X_val, k=750, batch_size=300, minibatch=True):
     X_clustered_val = pd.Series(mbk.predict(X_val), name='state')
     return df_centroids_train, X_clustered_train, X_clustered_val
 
+def select_clustering(X_train, X_val, ks, seeds, batch_size=300, minibatch=True, num_processes=None):
+    '''
+    fits k-means for every (k, seed) pair in a process pool and scores each fit
+        train_inertia, val_inertia: sum of squared distances to the nearest centroid
+        stability: mean adjusted rand index between the val assignments of the fit and
+                   those of the other seeds with the same k. 1 means the states do not
+                   depend on the seed. nan with a single seed
+    returns:
+        report: DataFrame with one row per fit
+        model: the fit with the lowest val inertia, for the k with the highest mean stability
+    '''
+    fits = [(k, seed, batch_size, minibatch) for k in ks for seed in seeds]
+    if num_processes is None:
+        num_processes = min(len(fits), max(os.cpu_count() - 1, 1))
+    if num_processes > 1:
+        # one copy of the data per worker instead of one per fit
+        with Pool(num_processes, initializer=_init_clustering_worker, initargs=(X_train, X_val, True)) as pool:
+            results = pool.map(_fit_kmeans, fits)
+    else:
+        _init_clustering_worker(X_train, X_val)
+        results = [_fit_kmeans(fit) for fit in fits]
+        _init_clustering_worker(None, None)
+
+    rows = []
+    for i, (k, seed, model, train_inertia, val_inertia, val_labels) in enumerate(results):
+        aris = [adjusted_rand_score(val_labels, other[5]) for j, other in enumerate(results)
+                if j != i and other[0] == k]
+        rows.append({'k': k, 'seed': seed, 'train_inertia': train_inertia, 'val_inertia': val_inertia,
+                     'stability': np.mean(aris) if len(aris) > 0 else np.nan})
+    report = pd.DataFrame(rows)
+    if len(ks) > 1 and report['stability'].notnull().any():
+        best_k = report.groupby('k')['stability'].mean().idxmax()
+    else:
+        best_k = ks[0]
+    best = report[report['k'] == best_k]['val_inertia'].idxmin()
+    return report, results[best][2]
+
+_clustering_data = None
+
+def _init_clustering_worker(X_train, X_val, single_threaded=False):
+    global _clustering_data
+    _clustering_data = (X_train, X_val)
+    if single_threaded:
+        # the pool already uses every core, blas threads per worker would oversubscribe them
+        threadpool_limits(1)
+
+def _fit_kmeans(fit):
+    k, seed, batch_size, minibatch = fit
+    X_train, X_val = _clustering_data
+    if minibatch:
+        # pick only numerical columns that make sense
+        mbk = MiniBatchKMeans(n_clusters=k, batch_size=batch_size, init_size=k*3, random_state=seed)
+    else:
+        mbk = KMeans(n_clusters=k, random_state=seed)
+    # fit only on train
+    mbk.fit(X_train)
+    val_labels = mbk.predict(X_val)
+    # score() is the negative inertia
+    return k, seed, mbk, -mbk.score(X_train), -mbk.score(X_val), val_labels
+
 def clustering_kp(X_train, X_val, num_states, init_method='Cao'):
     # @refactor
     # preprocessing to keep things orderly for kp method
@@ -554,34 +784,48 @@ def apply_phi_to_centroids(df_cent, df_train, bins=None, as_matrix=False):
     phi criteria are learned from df_trani
     convert centroid values into quartile-based bins
     create dummy variable so every column is one or zero
+    dense DataFrame version of make_phi_matrix
+    '''
+    phi, features = make_phi_matrix(df_cent, df_train, bins)
+    if as_matrix:
+        return phi.toarray()
+    return pd.DataFrame(phi.toarray().astype(np.uint8), index=df_cent.index, columns=features)
+
+def make_phi_matrix(df_cent, df_train, bins=None):
+    '''
+    phi of apply_phi_to_centroids as a scipy.sparse CSR matrix, with the bins
+    of all columns found at once. every centroid has one nonzero per column
+    returns:
+        (num_centroids, num_features) CSR matrix of ones
+        feature names, '<column>_<bin>' as pd.get_dummies names them
     '''
     if bins is None:
         bins = ['min', '25%', '50%', '75%', 'max']
-    criteria = df_train.describe().loc[bins]
-    # pandas cut does not see to support vectorized version
-    binned_columns = []
-
-    for c in df_cent:
-        uniq_edges = np.unique(criteria[c].tolist())
-        if len(uniq_edges) == 2:
-            # it must be binary variables
-            # shift the edge to the left a bit
-            uniq_edges = uniq_edges - 1e-5
-            # add a new edge
-            uniq_edges = np.append(uniq_edges, 10000)
-            #print(uniq_edges)
-            labels = np.arange(2, dtype=np.int)
-            #print(labels)
-        else:
-            labels = np.arange(len(uniq_edges) - 1, dtype=np.int)
-        bins = pd.cut(df_cent[c], uniq_edges, include_lowest=True, retbins=True, labels=labels)[0]
-        bins.astype(int)
-        binned_columns.append(bins)
-
-    df_binned = pd.concat(binned_columns, axis=1, ignore_index=True)
-    df_binned.columns = df_cent.columns
-    df_phi = pd.get_dummies(df_binned)
-    if as_matrix:
-        return df_phi.as_matrix()
-    else:
-        return df_phi
+    criteria = df_train[df_cent.columns].describe().loc[bins]
+    # per column unique edges, padded with +inf to a (num_columns, len(bins)) table
+    edges = np.sort(criteria.values.T, axis=1)
+    is_new = np.ones(edges.shape, dtype=bool)
+    is_new[:, 1:] = edges[:, 1:] != edges[:, :-1]
+    num_edges = is_new.sum(axis=1)
+    uniq_edges = np.full(edges.shape, np.inf)
+    uniq_edges[np.nonzero(is_new)[0], (np.cumsum(is_new, axis=1) - 1)[is_new]] = edges[is_new]
+    # it must be binary variables: shift the two edges to the left a bit and add a new one
+    is_binary = num_edges == 2
+    uniq_edges[is_binary, :2] -= 1e-5
+    uniq_edges[is_binary, 2] = 10000
+    num_edges[is_binary] = 3
+    num_bins = num_edges - 1
+
+    # bin i is (edge_i, edge_i+1], the first one also takes its left edge
+    values = df_cent.values.astype(float)
+    lowest = uniq_edges[:, 0]
+    highest = uniq_edges[np.arange(len(num_edges)), num_edges - 1]
+    binned = np.maximum(np.sum(values[:, :, np.newaxis] > uniq_edges[np.newaxis], axis=2) - 1, 0)
+    # values outside the train range fall in no bin, as with pd.cut
+    inside = (values >= lowest) & (values <= highest)
+    offsets = np.concatenate([[0], np.cumsum(num_bins)[:-1]])
+    rows, cols = np.nonzero(inside)
+    phi = sparse.csr_matrix((np.ones(rows.shape[0]), (rows, offsets[cols] + binned[rows, cols])),
+                            shape=(values.shape[0], int(np.sum(num_bins))))
+    features = ['{}_{}'.format(c, b) for c, n in zip(df_cent.columns, num_bins) for b in range(n)]
+    return phi, features